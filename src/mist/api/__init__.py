@@ -64,19 +64,21 @@ def main(global_config, **settings):
     """This function returns a Pyramid WSGI application."""
 
     import mist.api.auth.middleware
+    from mist.api.helpers import json_serializer
 
     settings = {}
 
     configurator = Configurator(root_factory=Root, settings=settings)
 
     # Add custom adapter to the JSON renderer to avoid serialization errors
-    json_renderer = JSON()
+    json_renderer = JSON(serializer=json_serializer())
 
     def string_adapter(obj, request):
         return str(obj)
 
     json_renderer.add_adapter(object, string_adapter)
     configurator.add_renderer('json', json_renderer)
+    configurator.add_tween('mist.api.helpers.compression_tween_factory')
 
     configurator.add_static_view('docs', path='../../../docs/build')
 
@@ -287,7 +289,10 @@ def add_routes(configurator):
 
     # Logs & stories.
     configurator.add_route('api_v1_logs', '/api/v1/logs')
+    configurator.add_route('api_v1_logs_export', '/api/v1/logs/export')
     configurator.add_route('api_v1_job', '/api/v1/jobs/{job_id}')
+    configurator.add_route('api_v1_job_output',
+                           '/api/v1/jobs/{job_id}/output/{output_id}')
     configurator.add_route('api_v1_story', '/api/v1/stories/{story_id}')
 
     configurator.add_route('user_invitations', '/user_invitations')
@@ -1,7 +1,21 @@
+import os
+import copy
+import time
 import random
 import string
 import urllib
+import atexit
+import logging
+import hashlib
+import threading
+
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
 from mongoengine import DoesNotExist
+from pymongo import UpdateOne
+
+from mist.api import config
 
 from mist.api.users.models import Organization, User
 
@@ -29,6 +43,247 @@ from mist.api.auth.models import ApiToken
 from mist.api.auth.models import SessionToken
 
 
+log = logging.getLogger(__name__)
+
+
+class SessionToucher(object):
+    """Record the last access of sessions, writing it at most once a window
+
+    A session's `last_accessed_at` is only written once it is at least
+    `config.SESSION_TOUCH_INTERVAL` seconds old, or a quarter of the session's
+    timeout, if that is shorter. Such writes are buffered and flushed in bulk
+    by a daemon thread every `config.SESSION_TOUCH_FLUSH_INTERVAL` seconds.
+    Buffered writes only ever move `last_accessed_at` forward, so they do not
+    interfere with other changes to the session, such as revoking it.
+
+    Sessions that were never accessed before, or that have other unsaved
+    changes, are saved right away. Set the interval to 0 to save sessions on
+    every access.
+
+    """
+
+    def __init__(self):
+        self.pid = None
+        self.pending = {}
+        self.touched = {}
+        self.lock = threading.Lock()
+
+    def _start(self):
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.pending = {}
+            self.touched = {}
+            thread = threading.Thread(target=self._run, name='SessionToucher')
+            thread.daemon = True
+            thread.start()
+            self.pid = os.getpid()
+
+    def touch(self, session):
+        """Update the session's last access, saving it if necessary"""
+        last_accessed_at = session.last_accessed_at
+        session.touch()
+        interval = config.SESSION_TOUCH_INTERVAL
+        if session.timeout:
+            interval = min(interval, session.timeout / 4.0)
+        if not interval or not last_accessed_at or not session.id or \
+                set(session._get_changed_fields()) - {'last_accessed_at'}:
+            session.save()
+            return
+        if self.pid != os.getpid():
+            self._start()
+        # Sessions may come from the token cache, so also consider accesses
+        # recorded since they were loaded.
+        key = (type(session), session.id)
+        with self.lock:
+            last_accessed_at = max(last_accessed_at,
+                                   self.touched.get(key, datetime.min))
+            if session.last_accessed_at - last_accessed_at < \
+                    timedelta(seconds=interval):
+                return
+            self.pending[key] = self.touched[key] = session.last_accessed_at
+
+    def flush(self):
+        """Write the last access of all sessions touched by this process"""
+        if self.pid != os.getpid():
+            return
+        since = datetime.utcnow() - \
+            timedelta(seconds=config.SESSION_TOUCH_INTERVAL)
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            self.touched = dict((key, touched_at) for key, touched_at
+                                in self.touched.iteritems()
+                                if touched_at > since)
+        if not pending:
+            return
+        updates = {}
+        for (cls, session_id), last_accessed_at in pending.iteritems():
+            updates.setdefault(cls, []).append(UpdateOne(
+                {'_id': session_id},
+                {'$max': {'last_accessed_at': last_accessed_at}}
+            ))
+        for cls, cls_updates in updates.iteritems():
+            try:
+                cls._get_collection().bulk_write(cls_updates, ordered=False)
+            except Exception as exc:
+                log.error('Failed to touch %d sessions: %r',
+                          len(cls_updates), exc)
+
+    def _run(self):
+        while True:
+            time.sleep(config.SESSION_TOUCH_FLUSH_INTERVAL)
+            self.flush()
+
+
+SESSION_TOUCHER = SessionToucher()
+atexit.register(SESSION_TOUCHER.flush)
+
+
+def _token_hash(token):
+    return hashlib.sha256(token).hexdigest()
+
+
+class TokenCache(object):
+    """Cache valid tokens looked up by `session_from_request`
+
+    Tokens are cached for `config.TOKEN_CACHE_TTL` seconds, or less if they
+    expire or may time out sooner, and up to `config.TOKEN_CACHE_SIZE` of
+    them are kept, evicting the least recently used. Set the TTL to 0 to
+    disable the cache.
+
+    Revoked tokens, as well as tokens of users whose membership changed, are
+    evicted from the caches of all processes by `invalidate_tokens`, through
+    the TOKENS_EXCHANGE fanout exchange, which each process consumes in a
+    daemon thread. If the connection to the broker is lost, the cache is
+    cleared, since invalidations may have been missed, and the TTL remains
+    the upper bound for how long a revoked token may still be accepted.
+
+    """
+
+    def __init__(self):
+        self.pid = None
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def _start(self):
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.entries = OrderedDict()
+            thread = threading.Thread(target=self._run, name='TokenCache')
+            thread.daemon = True
+            thread.start()
+            self.pid = os.getpid()
+
+    def get(self, token):
+        """Return a copy of the cached session of the given token, if any"""
+        if not config.TOKEN_CACHE_TTL or not token:
+            return
+        if self.pid != os.getpid():
+            self._start()
+        key = _token_hash(token)
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                return
+            if entry['expires_at'] < time.time():
+                return
+            self.entries[key] = entry
+        session = entry['cls']._from_son(copy.deepcopy(entry['son']))
+        if not session.is_valid():
+            self.evict(tokens=[token])
+            return
+        return session
+
+    def put(self, token, session):
+        """Cache the session of the given token"""
+        if not config.TOKEN_CACHE_TTL or not token:
+            return
+        if self.pid != os.getpid():
+            self._start()
+        ttl = config.TOKEN_CACHE_TTL
+        if session.timeout:
+            ttl = min(ttl, session.timeout / 4.0)
+        expires_at = time.time() + ttl
+        if session.ttl:
+            expires_at = min(expires_at, time.time() +
+                             (session.expires() -
+                              datetime.utcnow()).total_seconds())
+        son = copy.deepcopy(session.to_mongo())
+        entry = {
+            'cls': type(session),
+            'son': son,
+            'user_id': session.user_id,
+            'su': session.su,
+            'org_id': son.get('org'),
+            'expires_at': expires_at,
+        }
+        with self.lock:
+            self.entries.pop(_token_hash(token), None)
+            self.entries[_token_hash(token)] = entry
+            while len(self.entries) > config.TOKEN_CACHE_SIZE:
+                self.entries.popitem(last=False)
+
+    def evict(self, tokens=(), token_hashes=(), user_id='', org_id=''):
+        """Evict the given tokens, or those of a user or organization"""
+        keys = set(token_hashes) | set(_token_hash(token) for token in tokens)
+        with self.lock:
+            for key, entry in self.entries.items():
+                if key in keys or \
+                        (user_id and user_id in (entry['user_id'],
+                                                 entry['su'])) or \
+                        (org_id and org_id == entry['org_id']):
+                    del self.entries[key]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def _on_message(self, msg):
+        try:
+            self.evict(token_hashes=msg.body.get('tokens') or (),
+                       user_id=msg.body.get('user_id'),
+                       org_id=msg.body.get('org_id'))
+        except Exception as exc:
+            log.error('Failed to process token invalidation %r: %r',
+                      msg.body, exc)
+
+    def _run(self):
+        while True:
+            try:
+                mist.api.helpers.amqp_subscribe(TOKENS_EXCHANGE,
+                                                self._on_message)
+            except Exception as exc:
+                log.error('Failed to subscribe to %s: %r',
+                          TOKENS_EXCHANGE, exc)
+            self.clear()
+            time.sleep(5)
+
+
+TOKENS_EXCHANGE = 'auth_tokens'
+TOKEN_CACHE = TokenCache()
+
+
+def invalidate_tokens(tokens=(), user_id='', org_id=''):
+    """Evict tokens, or those of a user or org, from the caches of all processes
+
+    This must be called whenever tokens are revoked, or the organizations the
+    user of a token is a member of change.
+
+    """
+    TOKEN_CACHE.evict(tokens=tokens, user_id=user_id, org_id=org_id)
+    data = {
+        'tokens': [_token_hash(token) for token in tokens],
+        'user_id': user_id,
+        'org_id': org_id,
+    }
+    try:
+        mist.api.helpers.amqp_publish(TOKENS_EXCHANGE, 'invalidate', data,
+                                      ex_declare=True)
+    except Exception as exc:
+        log.error('Failed to publish token invalidation: %r', exc)
+
+
 def migrate_old_api_token(request):
     """Migrate old API tokens (aka mist_1: email:token) to new ApiTokens"""
 
@@ -93,30 +348,36 @@ def session_from_request(request):
     if session is None:
         token_from_request = request.headers.get('Authorization', '').lower()
         if token_from_request:
-            try:
-                api_token = ApiToken.objects.get(
-                    token=token_from_request
-                )
-            except DoesNotExist:
-                api_token = None
-            try:
-                if not api_token and SUPER_EXISTS:
-                    api_token = SuperToken.objects.get(
-                                token=token_from_request)
-            except DoesNotExist:
-                pass
+            api_token = TOKEN_CACHE.get(token_from_request)
+            if api_token is None:
+                try:
+                    api_token = ApiToken.objects.get(
+                        token=token_from_request
+                    )
+                except DoesNotExist:
+                    api_token = None
+                try:
+                    if not api_token and SUPER_EXISTS:
+                        api_token = SuperToken.objects.get(
+                                    token=token_from_request)
+                except DoesNotExist:
+                    pass
+                if api_token and api_token.is_valid():
+                    TOKEN_CACHE.put(token_from_request, api_token)
             if api_token and api_token.is_valid():
                 session = api_token
             else:
                 session = ApiToken()
                 session.name = 'dummy_token'
+    if session is None:
+        session_id = request.cookies.get('session.id')
+        session = TOKEN_CACHE.get(session_id)
     if session is None:
         try:
-            session_token = SessionToken.objects.get(
-                token=request.cookies.get('session.id')
-            )
+            session_token = SessionToken.objects.get(token=session_id)
             if session_token.is_valid():
                 session = session_token
+                TOKEN_CACHE.put(session_id, session)
         except DoesNotExist:
             pass
     if session is None:
@@ -213,6 +474,7 @@ def reissue_cookie_session(request, user_id='', su='', org=None, after=0,
     else:
         session.invalidate()
         session.save()
+        invalidate_tokens(tokens=[session.token])
 
     # And then issue the new session
     new_session = SessionToken()
@@ -7,6 +7,7 @@ from mist.api.helpers import params_from_request
 from mist.api.auth.models import ApiToken
 from mist.api.auth.models import SessionToken
 
+from mist.api.auth.methods import SESSION_TOUCHER
 from mist.api.auth.methods import session_from_request
 
 from pyramid.request import Request
@@ -38,8 +39,7 @@ class AuthMiddleware(object):
             # they are to be thrown away, not saved.
             if not (isinstance(session, ApiToken) and
                     'dummy' in session.name):
-                session.touch()
-                session.save()
+                SESSION_TOUCHER.touch(session)
             return start_response(status, headers, exc_info)
 
         return self.app(environ, session_start_response)
@@ -11,6 +11,7 @@ from mist.api.auth.methods import auth_context_from_request
 from mist.api.auth.methods import token_with_name_not_exists
 from mist.api.auth.methods import reissue_cookie_session
 from mist.api.auth.methods import user_from_request
+from mist.api.auth.methods import invalidate_tokens
 
 
 from mist.api.helpers import ip_from_request, send_email
@@ -255,6 +256,7 @@ def revoke_session(request):
         if auth_token.is_valid():
             auth_token.invalidate()
             auth_token.save()
+            invalidate_tokens(tokens=[auth_token.token])
 
     except me.DoesNotExist:
         raise NotFoundError('Session not found')
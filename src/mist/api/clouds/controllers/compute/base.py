@@ -7,13 +7,13 @@ to db etc. Cloud specific controllers are in `mist.api.clouds.controllers`.
 """
 
 import ssl
-import json
 import copy
-import socket
 import logging
 import datetime
 import calendar
 
+from multiprocessing.pool import ThreadPool
+
 import mongoengine as me
 
 from libcloud.common.types import InvalidCredsError
@@ -32,7 +32,10 @@ from mist.api.exceptions import CloudUnavailableError
 from mist.api.exceptions import CloudUnauthorizedError
 from mist.api.exceptions import SSLError
 
+from mist.api.helpers import sanitize
 from mist.api.helpers import get_datetime
+from mist.api.helpers import check_open_ports
+from mist.api.helpers import bump_list_versions
 
 try:
     from mist.core.vpn.methods import destination_nat as dnat
@@ -165,6 +168,8 @@ class BaseComputeController(BaseController):
         # Process each machine in returned list.
         # Store previously unseen machines separately.
         new_machines = []
+        # Whether anything besides when machines were last seen has changed.
+        changed = False
         for node in nodes:
 
             # Fetch machine mongoengine model from db, or initialize one.
@@ -197,13 +202,7 @@ class BaseComputeController(BaseController):
             # Make sure we don't meet any surprises when we try to json encode
             # later on in the HTTP response.
             extra = self._list_machines__get_machine_extra(machine, node)
-
-            for key, val in extra.items():
-                try:
-                    json.dumps(val)
-                except TypeError:
-                    extra[key] = str(val)
-            machine.extra = extra
+            machine.extra = sanitize(extra)
 
             # Set machine hostname
             if machine.extra.get('dns_name'):
@@ -283,6 +282,8 @@ class BaseComputeController(BaseController):
                 machine.cost.monthly = 0
 
             # Save all changes to machine model on the database.
+            if set(machine._get_changed_fields()) - set(['last_seen']):
+                changed = True
             try:
                 machine.save()
             except me.ValidationError as exc:
@@ -296,10 +297,17 @@ class BaseComputeController(BaseController):
             machines.append(machine)
 
         # Append generic-type machines, which aren't handled by libcloud.
-        for machine in self._list_machines__fetch_generic_machines():
+        # Their state is found by checking whether they're accessible, all
+        # of them at once.
+        generic_machines = list(self._list_machines__fetch_generic_machines())
+        accessible = self.check_if_machines_accessible(generic_machines)
+        for machine in generic_machines:
             machine.last_seen = now
             machine.missing_since = None
-            machine.state = config.STATES[NodeState.UNKNOWN]
+            machine.state = config.STATES[
+                NodeState.RUNNING if accessible[machine.id]
+                else NodeState.UNKNOWN
+            ]
             for action in ('start', 'stop', 'reboot', 'destroy', 'rename',
                            'resume', 'suspend', 'undefine'):
                 setattr(machine.actions, action, False)
@@ -307,13 +315,18 @@ class BaseComputeController(BaseController):
             # allow reboot action for bare metal with key associated
             if machine.key_associations:
                 machine.actions.reboot = True
+            if set(machine._get_changed_fields()) - set(['last_seen']):
+                changed = True
             machine.save()
             machines.append(machine)
 
         # Set last_seen on machine models we didn't see for the first time now.
-        Machine.objects(cloud=self.cloud,
-                        id__nin=[m.id for m in machines],
-                        missing_since=None).update(missing_since=now)
+        if Machine.objects(cloud=self.cloud,
+                           id__nin=[m.id for m in machines],
+                           missing_since=None).update(missing_since=now):
+            changed = True
+        if changed:
+            bump_list_versions(self.cloud.owner, ['machines'])
 
         # Update RBAC Mappings given the list of nodes seen for the first time.
         self.cloud.owner.mapper.update(new_machines)
@@ -443,41 +456,68 @@ class BaseComputeController(BaseController):
 
     def check_if_machine_accessible(self, machine):
         """Attempt to port knock and ping the machine"""
-        assert machine.cloud.id == self.cloud.id
-        hostname = machine.hostname or (
-            machine.private_ips[0] if machine.private_ips else '')
-        if not hostname:
-            return False
-        ports_list = [22, 80, 443, 3389]
-        for port in (machine.ssh_port, machine.rdp_port):
-            if port and port not in ports_list:
-                ports_list.insert(0, port)
-        socket_timeout = 3
-        # add timeout for socket
-        for port in ports_list:
-            log.info("Attempting to connect to %s:%d", hostname, port)
+        return self.check_if_machines_accessible([machine])[machine.id]
+
+    def check_if_machines_accessible(self, machines):
+        """Attempt to port knock and ping many machines at once
+
+        All ports of all machines are checked concurrently, sharing a single
+        deadline, while the machines are being pinged in parallel. Returns a
+        dict mapping machine ids to whether they're accessible.
+
+        """
+        results = {}
+        targets = {}
+        hostnames = {}
+        for machine in machines:
+            assert machine.cloud.id == self.cloud.id
+            results[machine.id] = False
+            hostname = machine.hostname or (
+                machine.private_ips[0] if machine.private_ips else '')
+            if not hostname:
+                continue
+            ports_list = [22, 80, 443, 3389]
+            for port in (machine.ssh_port, machine.rdp_port):
+                if port and port not in ports_list:
+                    ports_list.insert(0, port)
+            hostnames[machine.id] = hostname
+            targets[machine.id] = [dnat(self.cloud.owner, hostname, port)
+                                   for port in ports_list]
+        if not targets:
+            return results
+
+        def ping(machine_id):
+            hostname = hostnames[machine_id]
             try:
-                s = socket.create_connection(
-                    dnat(self.cloud.owner, hostname, port),
-                    socket_timeout
-                )
-                s.shutdown(2)
+                log.info("Pinging %s", hostname)
+                ping = super_ping(owner=self.cloud.owner,
+                                  host=hostname, pkts=1)
+                if int((ping or {}).get('packets_rx', 0)) > 0:
+                    log.info("Successfully pinged %s", hostname)
+                    return True
             except:
-                log.info("Failed to connect to %s:%d", hostname, port)
-                continue
-            log.info("Connected to %s:%d", hostname, port)
-            return True
+                log.info("Failed to ping %s", hostname)
+            return False
+
+        # The pool is terminated rather than joined, so that pings of
+        # machines found accessible by the port checks don't have to be
+        # waited for. Pings already started finish in the background.
+        pool = ThreadPool(min(len(targets),
+                              config.ACCESSIBILITY_PING_CONCURRENCY))
         try:
-            log.info("Pinging %s", hostname)
-            ping = super_ping(owner=self.cloud.owner,
-                              host=hostname, pkts=1)
-            if int(ping.get('packets_rx', 0)) > 0:
-                log.info("Successfully pinged %s", hostname)
-                return True
-        except:
-            log.info("Failed to ping %s", hostname)
-            pass
-        return False
+            machine_ids = targets.keys()
+            pings = pool.map_async(ping, machine_ids)
+            pool.close()
+            log.info("Attempting to connect to %d machines", len(targets))
+            for machine_id in check_open_ports(
+                    targets, timeout=config.ACCESSIBILITY_CHECK_TIMEOUT):
+                results[machine_id] = True
+            if not all(results[machine_id] for machine_id in machine_ids):
+                for machine_id, accessible in zip(machine_ids, pings.get()):
+                    results[machine_id] = results[machine_id] or accessible
+        finally:
+            pool.terminate()
+        return results
 
     def list_images(self, search=None):
         """Return list of images for cloud
@@ -532,7 +572,8 @@ class BaseComputeController(BaseController):
                   for img in images]
 
         # Sort images: Starred first, then alphabetically.
-        images.sort(key=lambda image: (not image['star'], image['name']))
+        images.sort(key=lambda image: (not image['star'], image['name'],
+                                       image['id']))
 
         return images
 
@@ -865,6 +906,7 @@ class BaseComputeController(BaseController):
             machine.key_associations.pop()
         machine.state = 'terminated'
         machine.save()
+        bump_list_versions(self.cloud.owner, ['machines', 'keys'])
 
     def _destroy_machine(self, machine, machine_libcloud):
         """Private method to destroy a given machine
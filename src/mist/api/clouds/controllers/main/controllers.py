@@ -28,6 +28,9 @@ import logging
 import mongoengine as me
 
 from libcloud.utils.networking import is_private_subnet
+from libcloud.compute.types import NodeState
+
+from mist.api import config
 
 from mist.api.exceptions import MistError
 from mist.api.exceptions import NotFoundError
@@ -494,4 +497,11 @@ class OtherMainController(BaseMainController):
                     machine.delete()
                 raise
 
+        # Set the initial state of the machine, same as when listing it.
+        if self.cloud.ctl.compute.check_if_machine_accessible(machine):
+            machine.state = config.STATES[NodeState.RUNNING]
+        else:
+            machine.state = config.STATES[NodeState.UNKNOWN]
+        machine.save()
+
         return machine
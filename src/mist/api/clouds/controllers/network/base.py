@@ -8,13 +8,13 @@ are in `mist.api.clouds.controllers.network.controllers`.
 
 """
 
-import json
 import copy
 import logging
 import mongoengine.errors
 
 import mist.api.exceptions
 
+from mist.api.helpers import sanitize
 from mist.api.clouds.utils import LibcloudExceptionHandler
 from mist.api.clouds.controllers.base import BaseController
 
@@ -268,11 +268,7 @@ class BaseNetworkController(BaseController):
                 log.exception('Error post-parsing %s: %s', network, exc)
 
             # Ensure JSON-encoding.
-            for key, value in network.extra.iteritems():
-                try:
-                    json.dumps(value)
-                except TypeError:
-                    network.extra[key] = str(value)
+            network.extra = sanitize(network.extra)
 
             try:
                 network.save()
@@ -379,11 +375,7 @@ class BaseNetworkController(BaseController):
                 log.exception('Error while post-parsing %s: %s', subnet, exc)
 
             # Ensure JSON-encoding.
-            for key, value in subnet.extra.iteritems():
-                try:
-                    json.dumps(value)
-                except TypeError:
-                    subnet.extra[key] = str(value)
+            subnet.extra = sanitize(subnet.extra)
 
             try:
                 subnet.save()
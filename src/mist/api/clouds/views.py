@@ -6,6 +6,7 @@ from mist.api.auth.methods import auth_context_from_request
 
 from mist.api.helpers import trigger_session_update
 from mist.api.helpers import view_config, params_from_request
+from mist.api.helpers import etag_view
 
 from mist.api.exceptions import BadRequestError
 from mist.api.exceptions import RequiredParameterMissingError, NotFoundError
@@ -27,6 +28,7 @@ OK = Response("OK", 200)
 
 
 @view_config(route_name='api_v1_clouds', request_method='GET', renderer='json')
+@etag_view('clouds')
 def list_clouds(request):
     """
     Request a list of all added clouds.
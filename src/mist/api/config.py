@@ -47,6 +47,11 @@ ELASTICSEARCH = {
     'elastic_verify_certs': False
 }
 
+# Elasticsearch clients are shared by all threads of each process, keeping up
+# to POOL_SIZE connections alive. Requests time out after TIMEOUT seconds.
+ELASTICSEARCH_POOL_SIZE = 10
+ELASTICSEARCH_TIMEOUT = 30
+
 UI_TEMPLATE_URL = "http://ui"
 LANDING_TEMPLATE_URL = "http://landing"
 
@@ -81,6 +86,145 @@ DOCKER_TLS_KEY = ""
 DOCKER_TLS_CERT = ""
 DOCKER_TLS_CA = ""
 
+# Shell session captures are flushed to mongo in chunks, whenever either the
+# buffered output exceeds CHUNK_SIZE bytes or FLUSH_INTERVAL seconds pass.
+# Unflushed output is never allowed to exceed MAX_BUFFER bytes per session.
+SHELL_CAPTURE_CHUNK_SIZE = 64 * 1024
+SHELL_CAPTURE_FLUSH_INTERVAL = 5
+SHELL_CAPTURE_MAX_BUFFER = 1024 * 1024
+
+# Shell output read from the SSH channel is coalesced by the hub worker and
+# sent to the client once BATCH_SIZE bytes are buffered or the channel has
+# been idle for BATCH_DELAY seconds. Set BATCH_DELAY to 0 to disable batching.
+SHELL_OUTPUT_BATCH_SIZE = 16 * 1024
+SHELL_OUTPUT_BATCH_DELAY = 0.005
+
+# Hub servers stop taking new worker requests, leaving them to other servers,
+# once they run MAX_WORKERS workers, and delay starting new workers while
+# their CPU usage exceeds MAX_CPU percent. Set either to 0 to disable the
+# respective limit.
+HUB_MAX_WORKERS = 200
+HUB_MAX_CPU = 0
+HUB_STATS_INTERVAL = 5  # seconds between CPU usage samples
+HUB_MANAGER_TIMEOUT = 2  # seconds to wait for hub servers to respond
+
+# Authenticated SSH transports are cached per process and reused by Shells
+# connecting to the same host and port with the same user and key. Set
+# SSH_POOL_MAX_SESSIONS to 0 to disable pooling.
+SSH_POOL_MAX_SESSIONS = 8  # concurrent Shells sharing a transport
+SSH_POOL_MAX_IDLE = 300  # seconds an unused transport is kept open
+SSH_POOL_MAX_SIZE = 64  # transports kept open per process
+
+# Shell autoconfiguration tries that many credential combinations at a time
+# against the same host, per process. Keep it well below sshd's MaxStartups,
+# which defaults to dropping connections beyond 10 unauthenticated ones.
+# Combinations that failed to authenticate are skipped for FAILURE_TTL
+# seconds, unless the keys of the machine change. The last working one for
+# each machine is tried first for SUCCESS_TTL seconds.
+SSH_AUTOCONFIGURE_CONCURRENCY = 3
+SSH_AUTOCONFIGURE_FAILURE_TTL = 60 * 5
+SSH_AUTOCONFIGURE_SUCCESS_TTL = 60 * 60 * 24
+
+# Script output is stored and pushed to the owner's socket in chunks of up to
+# CHUNK_SIZE bytes, at least every FLUSH_INTERVAL seconds. At most MAX_BYTES
+# of it are kept in memory to parse the wrapper's output, and only the last
+# TAIL_SIZE bytes are included in the script_finished event.
+SCRIPT_OUTPUT_CHUNK_SIZE = 16 * 1024
+SCRIPT_OUTPUT_FLUSH_INTERVAL = 2
+SCRIPT_OUTPUT_MAX_BYTES = 10 * 1024 * 1024
+SCRIPT_OUTPUT_TAIL_SIZE = 64 * 1024
+
+# Maximum number of machines a group script run is executed on concurrently,
+# and seconds after which the script is stopped on each of them, same as the
+# soft time limit of the run_script task.
+SCRIPT_GROUP_CONCURRENCY = 10
+SCRIPT_GROUP_TIME_LIMIT = 3600
+
+# Running machines of each cloud are pinged and probed over SSH by a single
+# task, run by the poller after listing the machines, at most once every
+# INTERVAL seconds. Without fping, at most PING_BATCH ping processes are run
+# at a time. Set INTERVAL to 0 to disable the sweep.
+PROBE_SWEEP_INTERVAL = 120
+PROBE_SWEEP_PING_PACKETS = 3
+PROBE_SWEEP_PING_TIMEOUT = 1  # seconds to wait for each ping reply
+PROBE_SWEEP_PING_BATCH = 50
+PROBE_SWEEP_SSH_CONCURRENCY = 10
+
+# Checking whether machines are accessible attempts connections to all their
+# ports at once, giving up after CHECK_TIMEOUT seconds, while pinging them
+# PING_CONCURRENCY at a time. At most PORT_CHECK_BATCH connections are
+# attempted at the same time.
+ACCESSIBILITY_CHECK_TIMEOUT = 3
+ACCESSIBILITY_PING_CONCURRENCY = 10
+PORT_CHECK_BATCH = 512
+
+# Logged events are stored and published in the background, in batches of up
+# to BATCH_SIZE events, at least every FLUSH_INTERVAL seconds. Events are
+# written synchronously once QUEUE_SIZE of them are pending. Set QUEUE_SIZE to
+# 0 to always write events synchronously.
+LOG_EVENT_BATCH_SIZE = 100
+LOG_EVENT_FLUSH_INTERVAL = 1
+LOG_EVENT_QUEUE_SIZE = 10000
+
+# Messages are published over a long-lived connection per process. Exchanges
+# are declared, or checked for existence, at most once every CACHE_TTL
+# seconds. Set PUBLISH_CONFIRMS to wait for the broker to confirm every
+# published message.
+AMQP_EXCHANGE_CACHE_TTL = 30
+AMQP_PUBLISH_CONFIRMS = False
+
+# Socket servers consuming an owner's updates mark it as listening in
+# memcache every HEARTBEAT seconds, for TTL seconds. Each process remembers
+# owners found listening for CACHE_TTL seconds. Set TTL to 0 to look up the
+# owner's exchange on the broker instead.
+OWNER_PRESENCE_TTL = 90
+OWNER_PRESENCE_HEARTBEAT = 30
+OWNER_PRESENCE_CACHE_TTL = 5
+
+# API requests are logged in the background. Once QUEUE_SIZE requests are
+# pending, further ones are dropped, unless they raised unexpected exceptions,
+# and the number of dropped requests is reported at most once every
+# REPORT_INTERVAL seconds. Set QUEUE_SIZE to 0 to log requests synchronously.
+# Logged parameters and response bodies are cut to MAX_BODY_SIZE characters.
+REQUEST_LOG_QUEUE_SIZE = 1000
+REQUEST_LOG_REPORT_INTERVAL = 60
+REQUEST_LOG_MAX_BODY_SIZE = 16 * 1024
+
+# Sessions record their last access at most once every TOUCH_INTERVAL seconds,
+# in writes flushed every FLUSH_INTERVAL seconds. Set TOUCH_INTERVAL to 0 to
+# record every access right away.
+SESSION_TOUCH_INTERVAL = 60
+SESSION_TOUCH_FLUSH_INTERVAL = 5
+
+# Valid tokens are cached by each process for up to TOKEN_CACHE_TTL seconds.
+# At most TOKEN_CACHE_SIZE of them are kept. Set TTL to 0 to disable caching.
+TOKEN_CACHE_TTL = 60
+TOKEN_CACHE_SIZE = 10000
+
+# List views answer conditional requests based on per owner versions of each
+# collection, kept in memcache and bumped on writes and polls. Versions expire
+# after VERSION_TTL seconds, which bounds how long a change that wasn't bumped
+# may go unnoticed. Set VERSION_TTL to 0 to disable conditional requests.
+LIST_VERSION_TTL = 300
+
+# API responses are JSON encoded with the `dumps` function of JSON_ENCODER, if
+# it's installed, falling back to the json module for values it fails on.
+JSON_ENCODER = 'simplejson'
+
+# Text and JSON responses of at least MIN_SIZE bytes are gzip or deflate
+# encoded at LEVEL, if the client accepts it. Set MIN_SIZE to 0 to disable.
+COMPRESS_MIN_SIZE = 1024
+COMPRESS_LEVEL = 6
+
+# Exported events are fetched from Elasticsearch in pages of PAGE_SIZE.
+EVENTS_EXPORT_PAGE_SIZE = 1000
+
+# Stories are stored as documents, updated as their events are written. Only
+# the first MAX_LOGS events of each story are kept in it. Stories requested
+# by sockets are queried by QUERY_THREADS threads, off the IOLoop.
+STORY_MAX_LOGS = 50
+STORY_QUERY_THREADS = 4
+
 MAILER_SETTINGS = {
     'mail.host': "mailmock",
     'mail.port': "8025",
@@ -1041,6 +1185,7 @@ FROM_ENV_STRINGS = [
     'UI_TEMPLATE_URL', 'LANDING_TEMPLATE_URL',
 ]
 FROM_ENV_INTS = [
+    'HUB_MAX_WORKERS',
 ]
 FROM_ENV_BOOLS = [
     'SSL_VERIFY', 'ALLOW_CONNECT_LOCALHOST', 'ALLOW_CONNECT_PRIVATE',
@@ -16,21 +16,31 @@ import re
 import sys
 import uuid
 import json
+import zlib
+import errno
+import select
 import string
 import random
+import hashlib
 import socket
 import shutil
+import subprocess
 import smtplib
 import logging
 import datetime
+import Queue
+import atexit
 import tempfile
+import threading
 import traceback
 import functools
+import importlib
+import itertools
 import jsonpickle
 
 from time import time, strftime, sleep
 
-from base64 import urlsafe_b64encode
+from base64 import urlsafe_b64encode, urlsafe_b64decode
 
 from pymongo import MongoClient
 from bson.objectid import ObjectId
@@ -40,7 +50,7 @@ from email.utils import formatdate, make_msgid
 from mongoengine import DoesNotExist
 
 from pyramid.view import view_config as pyramid_view_config
-from pyramid.httpexceptions import HTTPError
+from pyramid.httpexceptions import HTTPError, HTTPNotModified
 
 import iso8601
 import netaddr
@@ -52,10 +62,15 @@ from Crypto.Hash.SHA256 import SHA256Hash
 from Crypto.Hash.HMAC import HMAC
 from Crypto.Random import get_random_bytes
 
+from memcache import Client as MemcacheClient
+
 from amqp import Message
 from amqp.connection import Connection
+from amqp.exceptions import AMQPError as AmqpError
+from amqp.exceptions import ChannelError as AmqpChannelError
 from amqp.exceptions import NotFound as AmqpNotFound
 
+from distutils.spawn import find_executable
 from distutils.version import LooseVersion
 
 from elasticsearch import Elasticsearch
@@ -65,6 +80,7 @@ import mist.api.users.models
 from mist.api.auth.models import ApiToken, SessionToken, datetime_to_str
 
 from mist.api.exceptions import MistError, NotFoundError
+from mist.api.exceptions import BadRequestError
 from mist.api.exceptions import RequiredParameterMissingError
 
 from mist.api import config
@@ -83,6 +99,24 @@ logging.basicConfig(level=config.PY_LOG_LEVEL,
 log = logging.getLogger(__name__)
 
 
+_MONGO_CLIENT = None
+_MONGO_CLIENT_PID = None
+
+
+def get_mongo_client():
+    """Return a MongoClient shared by all threads of the current process
+
+    MongoClient maintains its own connection pool and is thread safe, but it
+    must not be used across forks, so a new one is created in each child.
+
+    """
+    global _MONGO_CLIENT, _MONGO_CLIENT_PID
+    if _MONGO_CLIENT_PID != os.getpid():
+        _MONGO_CLIENT = MongoClient(config.MONGO_URI, connect=False)
+        _MONGO_CLIENT_PID = os.getpid()
+    return _MONGO_CLIENT
+
+
 @contextmanager
 def get_temp_file(content, dir=None):
     """Creates a temporary file on disk and saves 'content' in it.
@@ -132,6 +166,165 @@ def params_from_request(request):
     return params or {}
 
 
+def encode_cursor(values):
+    """Encode a list of sort values as an opaque pagination cursor"""
+    return urlsafe_b64encode(json.dumps(values, separators=(',', ':')))
+
+
+def decode_cursor(cursor):
+    """Decode a pagination cursor back to its list of sort values"""
+    try:
+        values = json.loads(urlsafe_b64decode(str(cursor)))
+    except (TypeError, ValueError):
+        raise BadRequestError('Invalid cursor: %s' % cursor)
+    if not isinstance(values, list):
+        raise BadRequestError('Invalid cursor: %s' % cursor)
+    return values
+
+
+def list_params_from_request(request):
+    """Get the pagination arguments of a list view from the request
+
+    Return a dict of `limit`, the maximum number of items to return, `after`,
+    the sort values of the last item of the previous page, decoded from the
+    `cursor` param, and `fields`, the set of fields of each item to return,
+    given as a comma separated list, or None to return all of them.
+
+    """
+    params = params_from_request(request)
+    try:
+        limit = int(params.get('limit') or 0)
+    except (TypeError, ValueError):
+        limit = -1
+    if limit < 0:
+        raise BadRequestError('Invalid value: limit=%s' % params['limit'])
+    after = None
+    if params.get('cursor'):
+        after = decode_cursor(params['cursor'])
+    fields = None
+    if params.get('fields'):
+        fields = set(field.strip() for field in params['fields'].split(','))
+        fields.add('id')
+    return {'limit': limit, 'after': after, 'fields': fields}
+
+
+def set_next_cursor(request, items, limit, keys=('id', )):
+    """Set the X-Next-Cursor header, if a full page of items was listed
+
+    The cursor is made up of the `keys` of the last item, by which items
+    are sorted.
+
+    """
+    if limit and len(items) == limit:
+        request.response.headers['X-Next-Cursor'] = encode_cursor(
+            [items[-1][key] for key in keys]
+        )
+
+
+def select_fields(item, fields):
+    """Return only the given `fields` of dict `item`, unless None"""
+    if fields is None:
+        return item
+    return dict((key, value) for key, value in item.iteritems()
+                if key in fields)
+
+
+def paginate_query(query, limit=0, after=None, fields=None, aliases=None):
+    """Return a page of the documents of `query`, sorted by id
+
+    At most `limit` documents are returned, if set, after the one with id
+    `after[0]`. Unless `fields` is None, only the model fields needed for
+    them are loaded. Fields named differently on the model are mapped to
+    their model field by `aliases`.
+
+    """
+    if limit or after:
+        query = query.order_by('id')
+    if after:
+        query = query.filter(id__gt=after[0])
+    if fields is not None:
+        aliases = aliases or {}
+        only = set(aliases.get(field, field) for field in fields)
+        query = query.only(*[field for field in only
+                             if field in query._document._fields])
+    if limit:
+        query = query.limit(limit)
+    return list(query)
+
+
+_JSON_SCALARS = frozenset([unicode, int, long, float, bool, type(None)])
+_JSON_BASES = (unicode, str, int, long, float)
+_DROP = object()
+
+
+def sanitize(obj, default=str, max_depth=16, max_size=10000):
+    """Return a copy of `obj` that can be JSON encoded
+
+    The object is walked once. Byte strings that are not valid UTF-8 are
+    decoded replacing invalid bytes. Any other values that cannot be JSON
+    encoded are replaced by `default(value)`, or dropped, if that raises an
+    exception. So are dicts and lists nested more than `max_depth` levels
+    deep. Only the first `max_size` items of each dict or list are kept.
+
+    """
+
+    def _default(value):
+        try:
+            return default(value)
+        except Exception as exc:
+            log.warning('Dropped value of type %s: %r', type(value), exc)
+            return _DROP
+
+    def _sanitize(value, depth):
+        kind = type(value)
+        if kind in _JSON_SCALARS:
+            return value
+        if kind is str:
+            try:
+                value.decode('utf-8')
+            except UnicodeDecodeError:
+                return value.decode('utf-8', 'replace')
+            return value
+        if kind is dict:
+            if depth >= max_depth:
+                return _default(value)
+            if len(value) > max_size:
+                log.warning('Truncated dict of %d items', len(value))
+            result = {}
+            for key, item in itertools.islice(value.iteritems(), max_size):
+                if type(key) not in _JSON_SCALARS:
+                    key = _sanitize(key, max_depth)
+                    if type(key) not in _JSON_SCALARS and type(key) is not str:
+                        continue
+                item = _sanitize(item, depth + 1)
+                if item is not _DROP:
+                    result[key] = item
+            return result
+        if kind is list or kind is tuple:
+            if depth >= max_depth:
+                return _default(value)
+            if len(value) > max_size:
+                log.warning('Truncated list of %d items', len(value))
+            result = []
+            for item in itertools.islice(value, max_size):
+                item = _sanitize(item, depth + 1)
+                if item is not _DROP:
+                    result.append(item)
+            return result
+        # Subclasses of JSON types are encoded as their base type.
+        if isinstance(value, dict):
+            return _sanitize(dict(value), depth)
+        if isinstance(value, (list, tuple)):
+            return _sanitize(list(value), depth)
+        for base in _JSON_BASES:
+            if isinstance(value, base):
+                return _sanitize(base(value), depth)
+        return _default(value)
+
+    result = _sanitize(obj, 0)
+    return None if result is _DROP else result
+
+
 def b58_encode(num):
     """Returns num in a base58-encoded string."""
     alphabet = '123456789abcdefghijkmnopqrstuvwxyzABCDEFGHJKLMNPQRSTUVWXYZ'
@@ -199,6 +392,153 @@ def parse_ping(stdout):
     return {}
 
 
+def _rtt_stats(packets_tx, rtts):
+    """Return the same metrics as `parse_ping` for a list of round trips"""
+    stats = {
+        "packets_tx": packets_tx,
+        "packets_rx": len(rtts),
+        "packets_loss": float(packets_tx - len(rtts)) / packets_tx,
+    }
+    if rtts:
+        stats.update({
+            "rtt_min": min(rtts),
+            "rtt_avg": sum(rtts) / len(rtts),
+            "rtt_max": max(rtts),
+        })
+    return stats
+
+
+def ping_hosts(hosts, pkts=3, timeout=1):
+    """Ping many hosts at once and return a dict of host to ping metrics
+
+    If `fping` is available, all hosts are pinged by a single process.
+    Otherwise, a `ping` process is spawned for each host, all of them
+    running concurrently, in batches of `config.PROBE_SWEEP_PING_BATCH`.
+    The metrics of each host are the same as those returned by
+    `parse_ping`. Hosts that couldn't be pinged map to an empty dict.
+
+    """
+    hosts = list(set(hosts))
+    results = dict((host, {}) for host in hosts)
+    if not hosts:
+        return results
+    fping = find_executable('fping')
+    if fping:
+        # `fping -C` prints a line per host to stderr, listing the round
+        # trip of each packet in msecs, or "-" for packets that were lost:
+        # 10.0.0.1 : 0.05 0.06 -
+        proc = subprocess.Popen(
+            [fping, '-q', '-C', str(pkts), '-t', str(int(timeout * 1000))] +
+            hosts, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+        )
+        stdout, stderr = proc.communicate()
+        for line in stderr.splitlines():
+            host, sep, rtts = line.partition(' : ')
+            host = host.strip()
+            if not sep or host not in results:
+                continue
+            rtts = [float(rtt) for rtt in rtts.split() if rtt != '-']
+            results[host] = _rtt_stats(pkts, rtts)
+        return results
+    batch = config.PROBE_SWEEP_PING_BATCH
+    for i in range(0, len(hosts), batch):
+        procs = [(host, subprocess.Popen(
+            ['ping', '-n', '-q', '-c', str(pkts), '-i', '0.2',
+             '-W', str(timeout), host],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE
+        )) for host in hosts[i:i + batch]]
+        for host, proc in procs:
+            stdout, stderr = proc.communicate()
+            results[host] = parse_ping(stdout) or _rtt_stats(pkts, [])
+    return results
+
+
+def _check_open_ports(targets, timeout):
+    found = set()
+    pending = {}  # socket: key
+    try:
+        for key, addresses in targets:
+            for host, port in addresses:
+                try:
+                    family, socktype, proto, _, sockaddr = socket.getaddrinfo(
+                        host, port, 0, socket.SOCK_STREAM
+                    )[0]
+                    sock = socket.socket(family, socktype, proto)
+                except (socket.error, socket.gaierror) as exc:
+                    log.info("Failed to connect to %s:%s: %r", host, port, exc)
+                    continue
+                sock.setblocking(0)
+                err = sock.connect_ex(sockaddr)
+                if err in (errno.EINPROGRESS, errno.EWOULDBLOCK,
+                           errno.EALREADY):
+                    pending[sock] = key
+                    continue
+                sock.close()
+                if not err:
+                    found.add(key)
+                    break
+        # poll, unlike select, handles file descriptors above FD_SETSIZE
+        poller = select.poll()
+        socks = {}  # fileno: socket
+        for sock in pending:
+            poller.register(sock, select.POLLOUT)
+            socks[sock.fileno()] = sock
+        deadline = time() + timeout
+        while pending:
+            remaining = deadline - time()
+            if remaining <= 0:
+                break
+            for fileno, _ in poller.poll(remaining * 1000):
+                sock = socks[fileno]
+                poller.unregister(fileno)
+                key = pending.pop(sock, None)
+                if key is None:
+                    continue
+                err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                sock.close()
+                if err or key in found:
+                    continue
+                found.add(key)
+                # no need to wait for the other ports of this key
+                for other in [other for other, other_key in pending.items()
+                              if other_key == key]:
+                    del pending[other]
+                    poller.unregister(other)
+                    other.close()
+    finally:
+        for sock in pending:
+            sock.close()
+    return found
+
+
+def check_open_ports(targets, timeout=3):
+    """Connect to many addresses concurrently, using non-blocking sockets
+
+    `targets` is a dict mapping arbitrary keys to lists of (host, port)
+    addresses. All connections are attempted at once and share a single
+    deadline of `timeout` seconds. As soon as an address of a key accepts a
+    connection, the remaining addresses of that key are abandoned. Returns
+    the set of keys for which a connection was established.
+
+    Targets are processed in batches of up to `config.PORT_CHECK_BATCH`
+    sockets, so that too many file descriptors are never open at once.
+
+    """
+    found = set()
+    batch = []
+    size = 0
+    for key, addresses in targets.iteritems():
+        if batch and size + len(addresses) > config.PORT_CHECK_BATCH:
+            found.update(_check_open_ports(batch, timeout))
+            batch = []
+            size = 0
+        batch.append((key, addresses))
+        size += len(addresses)
+    if batch:
+        found.update(_check_open_ports(batch, timeout))
+    return found
+
+
 def parse_os_release(os_release):
     """
     Extract os name and version from the output of `cat /etc/*release`
@@ -290,16 +630,143 @@ def dirty_cow(os, os_version, kernel_version):
         return False
 
 
+class AmqpPublisher(object):
+    """Publish messages over a long-lived connection
+
+    A single connection is shared by all threads of a process, and reopened
+    whenever the process forks or the connection breaks. Each exchange gets
+    its own channel, so that publishing to an exchange that has been deleted,
+    which makes the broker close the channel, never affects other exchanges.
+
+    Exchanges are declared, or checked for existence if they are not to be
+    declared, when first used and then at most once every
+    `config.AMQP_EXCHANGE_CACHE_TTL` seconds. Channels unused for longer
+    than that are closed. Since the broker drops everything published on a
+    channel it has closed, e.g. after an auto_delete exchange got deleted,
+    anything it has sent in the meantime is processed before each publish
+    and all exchanges are checked again if a channel was closed. If
+    `config.AMQP_PUBLISH_CONFIRMS` is set, every publish also waits for the
+    broker to confirm it.
+
+    """
+
+    def __init__(self):
+        self.pid = None
+        self.lock = None
+        self.connection = None
+        self.channels = {}  # exchange: [channel, declared_at, used_at]
+
+    def _reset(self):
+        # The connection of a parent process must not be used, or closed.
+        self.pid = os.getpid()
+        self.lock = threading.RLock()
+        self.connection = None
+        self.channels = {}
+
+    def close(self):
+        """Close the connection, if open"""
+        connection, self.connection, self.channels = self.connection, None, {}
+        if connection is not None:
+            try:
+                connection.close()
+            except Exception as exc:
+                log.warning("Error closing AMQP connection: %r", exc)
+
+    def _drain(self):
+        # Nothing but errors is sent to a connection only used to publish,
+        # so any pending frame is most likely the closing of a channel.
+        poller = select.poll()
+        poller.register(self.connection.transport.sock, select.POLLIN)
+        while poller.poll(0):
+            try:
+                self.connection.drain_events(timeout=1)
+            except AmqpChannelError as exc:
+                log.info("AMQP channel closed by the broker: %r", exc)
+                for entry in self.channels.values():
+                    entry[1] = 0  # declare, or check, exchange on next use
+
+    def _channel(self, exchange, ex_type, ex_declare, auto_delete):
+        if self.connection is None:
+            self.connection = Connection(
+                config.AMQP_URI, confirm_publish=config.AMQP_PUBLISH_CONFIRMS
+            )
+        else:
+            self._drain()
+        now = time()
+        entry = self.channels.get(exchange)
+        if entry is not None and now - entry[1] < \
+                config.AMQP_EXCHANGE_CACHE_TTL:
+            entry[2] = now
+            return entry[0]
+        for other, (channel, _, used_at) in self.channels.items():
+            if now - used_at > config.AMQP_EXCHANGE_CACHE_TTL:
+                del self.channels[other]
+                try:
+                    channel.close()
+                except AmqpChannelError:
+                    pass
+        if entry is not None:
+            channel = entry[0]
+            del self.channels[exchange]
+        else:
+            channel = self.connection.channel()
+        try:
+            channel.exchange_declare(exchange=exchange, type=ex_type,
+                                     auto_delete=auto_delete,
+                                     passive=not ex_declare)
+        except AmqpChannelError:
+            if entry is None:
+                raise
+            # The channel was closed by the broker since it was last used,
+            # probably because the exchange was deleted. Check again on a
+            # new channel.
+            channel = self.connection.channel()
+            channel.exchange_declare(exchange=exchange, type=ex_type,
+                                     auto_delete=auto_delete,
+                                     passive=not ex_declare)
+        self.channels[exchange] = [channel, now, now]
+        return channel
+
+    def publish(self, exchange, messages,
+                ex_type='fanout', ex_declare=False, auto_delete=True):
+        """Publish a list of (routing_key, data) messages to an exchange"""
+        if self.pid != os.getpid():
+            self._reset()
+        with self.lock:
+            for retry in (False, True):
+                try:
+                    channel = self._channel(exchange, ex_type, ex_declare,
+                                            auto_delete)
+                    for routing_key, data in messages:
+                        channel.basic_publish(Message(json.dumps(data)),
+                                              exchange=exchange,
+                                              routing_key=routing_key)
+                    return
+                except AmqpChannelError:
+                    self.channels.pop(exchange, None)
+                    raise
+                except (AmqpError, socket.error, IOError) as exc:
+                    self.close()
+                    if retry:
+                        raise
+                    log.warning("AMQP connection failed, reconnecting: %r",
+                                exc)
+
+
+AMQP_PUBLISHER = AmqpPublisher()
+
+
 def amqp_publish(exchange, routing_key, data,
                  ex_type='fanout', ex_declare=False, auto_delete=True):
-    connection = Connection(config.AMQP_URI)
-    channel = connection.channel()
-    if ex_declare:
-        channel.exchange_declare(exchange=exchange, type=ex_type, auto_delete=auto_delete)
-    msg = Message(json.dumps(data))
-    channel.basic_publish(msg, exchange=exchange, routing_key=routing_key)
-    channel.close()
-    connection.close()
+    AMQP_PUBLISHER.publish(exchange, [(routing_key, data)], ex_type=ex_type,
+                           ex_declare=ex_declare, auto_delete=auto_delete)
+
+
+def amqp_publish_many(exchange, messages,
+                      ex_type='fanout', ex_declare=False, auto_delete=True):
+    """Publish a list of (routing_key, data) messages in one go"""
+    AMQP_PUBLISHER.publish(exchange, messages, ex_type=ex_type,
+                           ex_declare=ex_declare, auto_delete=auto_delete)
 
 
 def amqp_subscribe(exchange, callback, queue='',
@@ -351,6 +818,7 @@ def amqp_publish_user(owner, routing_key, data):
     try:
         amqp_publish(_amqp_owner_exchange(owner), routing_key, data)
     except AmqpNotFound:
+        _OWNER_PRESENCE.pop(_owner_id(owner), None)
         return False
     except Exception:
         return False
@@ -361,28 +829,177 @@ def amqp_subscribe_user(owner, queue, callback):
     amqp_subscribe(_amqp_owner_exchange(owner), callback, queue)
 
 
+_OWNER_PRESENCE = {}  # owner_id: expires_at
+_MEMCACHE = None
+
+
+def _owner_id(owner):
+    if isinstance(owner, mist.api.users.models.Owner):
+        return owner.id
+    return owner
+
+
+def _memcache():
+    global _MEMCACHE
+    if _MEMCACHE is None:
+        _MEMCACHE = MemcacheClient(config.MEMCACHED_HOST)
+    return _MEMCACHE
+
+
+def _owner_presence_key(owner_id):
+    return 'owner-listening-%s' % owner_id
+
+
+def set_owner_listening(owner):
+    """Mark that the owner's updates are being consumed
+
+    This is meant to be called periodically by whoever consumes them, at
+    least once every `config.OWNER_PRESENCE_TTL` seconds.
+
+    """
+    _memcache().set(_owner_presence_key(_owner_id(owner)), 1,
+                                time=config.OWNER_PRESENCE_TTL)
+
+
 def amqp_owner_listening(owner):
-    connection = Connection(config.AMQP_URI)
-    channel = connection.channel()
-    try:
-        channel.exchange_declare(exchange=_amqp_owner_exchange(owner),
-                                 type='fanout', passive=True)
-    except AmqpNotFound:
-        return False
-    else:
+    """Return whether anyone is consuming the owner's updates
+
+    Presence is determined by the heartbeat set by `set_owner_listening` in
+    memcache. Owners found listening are remembered by each process for
+    `config.OWNER_PRESENCE_CACHE_TTL` seconds, while absent ones are checked
+    again every time, so that new listeners are noticed right away. If
+    `config.OWNER_PRESENCE_TTL` is 0, the owner's exchange is looked up on
+    the broker instead.
+
+    """
+    if not config.OWNER_PRESENCE_TTL:
+        connection = Connection(config.AMQP_URI)
+        channel = connection.channel()
+        try:
+            channel.exchange_declare(exchange=_amqp_owner_exchange(owner),
+                                     type='fanout', passive=True)
+        except AmqpNotFound:
+            return False
+        else:
+            return True
+        finally:
+            channel.close()
+            connection.close()
+    owner_id = _owner_id(owner)
+    now = time()
+    if _OWNER_PRESENCE.get(owner_id, 0) > now:
         return True
-    finally:
-        channel.close()
-        connection.close()
+    if _memcache().get(_owner_presence_key(owner_id)):
+        _OWNER_PRESENCE[owner_id] = now + config.OWNER_PRESENCE_CACHE_TTL
+        return True
+    _OWNER_PRESENCE.pop(owner_id, None)
+    return False
 
 
 def trigger_session_update(owner, sections=['clouds', 'keys', 'monitoring',
                                             'scripts', 'templates', 'stacks',
                                             'schedules', 'user', 'org',
                                             'zones']):
+    bump_list_versions(owner, sections)
     amqp_publish_user(owner, routing_key='update', data=sections)
 
 
+def _list_versions_key(owner_id, collection):
+    return 'list-version-%s-%s' % (owner_id, collection)
+
+
+def _new_list_version():
+    # Versions are initialized to the current time in microseconds, so that
+    # a version that expired is never reused, unless bumped a million times
+    # per second.
+    return int(time() * 1000000)
+
+
+def bump_list_versions(owner, collections):
+    """Bump the owner's versions of the given collections
+
+    This is meant to be called whenever the listing of any of the collections
+    may have changed, so that list views stop answering their conditional
+    requests with 304, see `etag_view`.
+
+    """
+    if not config.LIST_VERSION_TTL:
+        return
+    owner_id = _owner_id(owner)
+    cache = _memcache()
+    for collection in collections:
+        key = _list_versions_key(owner_id, collection)
+        if cache.incr(key) is None:
+            cache.set(key, _new_list_version(), time=config.LIST_VERSION_TTL)
+
+
+def get_list_versions(owner, collections):
+    """Return the owner's versions of the given collections
+
+    Missing versions are initialized. If memcache is unavailable, None is
+    returned.
+
+    """
+    if not config.LIST_VERSION_TTL:
+        return None
+    owner_id = _owner_id(owner)
+    cache = _memcache()
+    keys = [_list_versions_key(owner_id, collection)
+            for collection in collections]
+    versions = cache.get_multi(keys)
+    missing = [key for key in keys if key not in versions]
+    if missing:
+        for key in missing:
+            cache.add(key, _new_list_version(), time=config.LIST_VERSION_TTL)
+        versions.update(cache.get_multi(missing))
+        if len(versions) < len(keys):
+            return None
+    return [str(versions[key]) for key in keys]
+
+
+def etag_view(*collections):
+    """Decorator answering a list view's conditional requests
+
+    The ETag of a response is derived from the versions of `collections` and
+    of the 'org' section, the requesting user and the request itself. If it
+    matches the request's If-None-Match header, 304 is returned right away,
+    without calling the view.
+
+    The ETag is computed before calling the view, so that any changes made
+    while it runs result in a different ETag next time.
+
+    """
+    collections = list(collections) + ['org']
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(request):
+            if request.method not in ('GET', 'HEAD'):
+                return func(request)
+            session = request.environ.get('session')
+            if session is None or not session.user_id:
+                return func(request)
+            owner_id = session.to_mongo().get('org')
+            if not owner_id:
+                return func(request)
+            versions = get_list_versions(owner_id, collections)
+            if versions is None:
+                return func(request)
+            etag = hashlib.sha1('\n'.join(
+                [str(config.VERSION.get('sha')), str(owner_id),
+                 str(session.user_id), str(session.su)] + versions +
+                [request.path_qs, request.body]
+            )).hexdigest()
+            if etag in request.if_none_match:
+                response = HTTPNotModified()
+                response.etag = etag
+                return response
+            request.response.etag = etag
+            return func(request)
+        return wrapper
+    return decorator
+
+
 def amqp_log(msg):
     return
     msg = "[%s] %s" % (strftime("%Y-%m-%d %H:%M:%S %Z"), msg)
@@ -821,6 +1438,332 @@ def decrypt(ciphertext, key=config.SECRET, key_salt='', no_iv=False):
     return plaintext
 
 
+class RequestLogPipeline(object):
+    """Log API requests in a background thread
+
+    `logging_view_decorator` only captures a record of each request to be
+    logged, made of plain values, see `_request_log_record`. Censoring
+    parameters, logging the event and logging exceptions happen in a daemon
+    thread, so that responses are never held back by them.
+
+    The queue is bounded by `config.REQUEST_LOG_QUEUE_SIZE`. When it's full,
+    records are dropped, unless they concern unexpected exceptions, which are
+    then processed synchronously instead. The number of queued, dropped and
+    failed records is kept, and reported at most once every
+    `config.REQUEST_LOG_REPORT_INTERVAL` seconds when records are dropped.
+    Set the queue size to 0 to always process records synchronously.
+
+    """
+
+    def __init__(self):
+        self.pid = None
+        self.queue = None
+        self.lock = threading.Lock()
+        self.queued = 0
+        self.dropped = 0
+        self.failed = 0
+        self.reported_at = 0
+
+    def _start(self):
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.queue = Queue.Queue(config.REQUEST_LOG_QUEUE_SIZE)
+            thread = threading.Thread(target=self._run, args=(self.queue, ),
+                                      name='RequestLogPipeline')
+            thread.daemon = True
+            thread.start()
+            self.pid = os.getpid()
+
+    def put(self, record):
+        """Queue a request record to be logged"""
+        if not config.REQUEST_LOG_QUEUE_SIZE:
+            return self.process(record)
+        if self.pid != os.getpid():
+            self._start()
+        try:
+            self.queue.put_nowait(record)
+        except Queue.Full:
+            if record['exc_flag']:
+                return self.process(record)
+            self.dropped += 1
+            if time() - self.reported_at >= \
+                    config.REQUEST_LOG_REPORT_INTERVAL:
+                self.reported_at = time()
+                log.warning("Request log queue is full, dropping records: "
+                            "%s", self.stats())
+        else:
+            self.queued += 1
+
+    def stats(self):
+        return {
+            'queued': self.queued,
+            'dropped': self.dropped,
+            'failed': self.failed,
+            'pending': self.queue.qsize() if self.queue is not None else 0,
+        }
+
+    def flush(self):
+        """Block until all queued records have been logged"""
+        if self.pid == os.getpid():
+            self.queue.join()
+            # Make sure the resulting events get written too.
+            from mist.api.logs.methods import EVENT_WRITER
+            EVENT_WRITER.flush()
+
+    def _run(self, queue):
+        while True:
+            record = queue.get()
+            try:
+                self.process(record)
+            finally:
+                queue.task_done()
+
+    def process(self, record):
+        try:
+            _log_request(record)
+        except Exception as exc:
+            self.failed += 1
+            log.error("Failed to log request %s %s: %r",
+                      record['request_method'], record['request_path'], exc)
+
+
+def _truncated(value, size):
+    """Return a copy of `value` with strings cut to `size` characters"""
+    if isinstance(value, basestring):
+        if len(value) > size:
+            return value[:size] + '...'
+        return value
+    if isinstance(value, dict):
+        return dict((key, _truncated(item, size))
+                    for key, item in value.iteritems())
+    if isinstance(value, (list, tuple)):
+        return [_truncated(item, size) for item in value]
+    return value
+
+
+def _request_log_record(request, response, exc_flag):
+    """Capture what's needed to log a request, as plain values
+
+    The record doesn't refer to the request, the response or the session,
+    so that they can be freed while it's queued. Parameters and the response
+    body are cut to `config.REQUEST_LOG_MAX_BODY_SIZE` characters.
+
+    """
+    size = config.REQUEST_LOG_MAX_BODY_SIZE
+    params = params_from_request(request)
+    if not isinstance(params, dict):
+        params = request.params
+    record = {
+        'event_type': 'request',
+        'action': request.real_view_name,
+        'request_path': request.path_info,
+        'request_method': request.method,
+        'request_ip': ip_from_request(request),
+        'user_agent': request.user_agent,
+        'response_code': response.status_code,
+        'error': response.status_code >= 400,
+        'matchdict': dict(request.matchdict or {}),
+        'params': _truncated(dict(params), size),
+        'response_body': _truncated(response.body, size),
+        'exc_flag': exc_flag,
+    }
+
+    # capture session, without looking up its users
+    session = request.environ['session']
+    if session:
+        record['session_id'] = str(session.id)
+        for key in ('fingerprint', 'experiment', 'choice'):
+            # in case of ApiToken, these don't exist
+            if getattr(session, key, None):
+                record[key] = getattr(session, key)
+    if session and session.user_id:
+        record['user_id'] = session.user_id
+        if session.su and session.su != session.user_id:
+            record['sudoer_id'] = session.su
+        record['owner_id'] = session.org.id if session.org else None
+    else:
+        record['user_id'] = None
+        record['owner_id'] = None
+
+    if isinstance(session, ApiToken):
+        if not 'dummy' in session.name:
+            record['api_token_id'] = str(session.id)
+            record['api_token_name'] = session.name
+            record['api_token'] = session.token[:4] + '***CENSORED***'
+            record['token_expires'] = datetime_to_str(session.expires())
+
+    # Log special Token.
+    if SUPER_EXISTS and isinstance(session, SuperToken):
+        record['setuid'] = True
+        record['api_token_id'] = str(session.id)
+        record['api_token_name'] = session.name
+
+    return record
+
+
+def _log_request(record):
+    """Log an API request, given the record captured by the view decorator"""
+    log_dict = dict((key, record[key])
+                    for key in ('event_type', 'action', 'request_path',
+                                'request_method', 'request_ip', 'user_agent',
+                                'response_code', 'error', 'user_id',
+                                'owner_id'))
+
+    # log original exception, session and token
+    for key in ('_exc', '_exc_type', '_traceback', 'session_id',
+                'fingerprint', 'experiment', 'choice', 'sudoer_id',
+                'api_token_id', 'api_token_name', 'api_token',
+                'token_expires', 'setuid'):
+        if record.get(key):
+            log_dict[key] = record[key]
+
+    # log matchdict and params
+    params = dict(record['params'])
+    for key in ['email', 'cloud', 'machine', 'rule', 'script_id',
+                'tunnel_id', 'story_id', 'stack_id', 'template_id']:
+        if key != 'email' and key in record['matchdict']:
+            if not key.endswith('_id'):
+                log_dict[key + '_id'] = record['matchdict'][key]
+            else:
+                log_dict[key] = record['matchdict'][key]
+            continue
+        if key != 'email':
+            key += '_id'
+        if key in params:
+            log_dict[key] = params.pop(key)
+        if snake_to_camel(key) in params:
+            log_dict[key] = params.pop(snake_to_camel(key))
+
+    for key in ('priv', 'password', 'new_password', 'apikey', 'apisecret',
+                'cert_file', 'key_file'):
+        if params.get(key):
+            params[key] = '***CENSORED***'
+    if log_dict['action'] == 'add_cloud':
+        provider = params.get('provider')
+        censor = {'vcloud': 'password',
+                  'indonesian_vcloud': 'password',
+                  'ec2': 'api_secret',
+                  'rackspace': 'api_key',
+                  'nephoscale': 'password',
+                  'softlayer': 'api_key',
+                  'onapp': 'api_key',
+                  'digitalocean': 'token',
+                  'gce': 'private_key',
+                  'azure': 'certificate',
+                  'linode': 'api_key',
+                  'docker': 'auth_password',
+                  'hp': 'password',
+                  'openstack': 'password'}.get(provider)
+        if censor and censor in params:
+            params[censor] = '***CENSORED***'
+    log_dict['request_params'] = params
+
+    # log response body
+    try:
+        bdict = json.loads(record['response_body'])
+        for key in ('job_id', 'job',):
+            if key in bdict and key not in log_dict:
+                log_dict[key] = bdict[key]
+        if 'cloud' in bdict and 'cloud_id' not in log_dict:
+            log_dict['cloud_id'] = bdict['cloud']
+        if 'machine' in bdict and 'machine_id' not in log_dict:
+            log_dict['machine_id'] = bdict['machine']
+        # Match resource type based on the action performed.
+        for rtype in ['cloud', 'machine', 'key', 'script', 'tunnel',
+                      'stack', 'template', 'schedule']:
+            if rtype in log_dict['action']:
+                if 'id' in bdict and '%s_id' % rtype not in log_dict:
+                    log_dict['%s_id' % rtype] = bdict['id']
+                    break
+        if log_dict['action'] == 'update_rule':
+            if 'id' in bdict and 'rule_id' not in log_dict:
+                log_dict['rule_id'] = bdict['id']
+        for key in ('priv', ):
+            if key in bdict:
+                bdict[key] = '***CENSORED***'
+        if 'token' in bdict:
+            bdict['token'] = bdict['token'][:4] + '***CENSORED***'
+        log_dict['response_body'] = json.dumps(bdict)
+    except:
+        log_dict['response_body'] = record['response_body']
+
+    # override logged action for specific views
+    if log_dict['action'] == 'machine_actions':
+        action = log_dict['request_params'].pop('action', None)
+        if action:
+            log_dict['action'] = '%s_machine' % action
+    elif log_dict['action'] == 'toggle_cloud':
+        state = log_dict['request_params'].pop('new_state', None)
+        if state == '1':
+            log_dict['action'] = 'enable_cloud'
+        elif state == '0':
+            log_dict['action'] = 'disable_cloud'
+    elif log_dict['action'] == 'update_monitoring':
+        if log_dict['request_params'].pop('action', None) == 'enable':
+            log_dict['action'] = 'enable_monitoring'
+        else:
+            log_dict['action'] = 'disable_monitoring'
+
+    # we save log_dict in mongo logging collection
+    from mist.api.logs.methods import log_event as log_event_to_es
+    log_event_to_es(**log_dict)
+
+    # if a bad exception didn't occur then return, else log it to file
+    if not record['exc_flag']:
+        return
+
+    # Publish traceback in rabbitmq, for heka to parse and forward to elastic
+    log.info("Bad exception occured, logging to rabbitmq")
+    es_dict = log_dict.copy()
+    es_dict.pop('_exc_type')
+    es_dict['time'] = time()
+    es_dict['traceback'] = es_dict.pop('_traceback')
+    es_dict['exception'] = es_dict.pop('_exc')
+    es_dict['type'] = 'exception'
+    routing_key = "%s.%s" % (es_dict['owner_id'], es_dict['action'])
+    pickler = jsonpickle.pickler.Pickler()
+    amqp_publish('exceptions', routing_key, pickler.flatten(es_dict),
+                 ex_type='topic', ex_declare=True,
+                 auto_delete=False)
+
+    # log bad exception to file
+    log.info("Bad exception occured, logging to file")
+    lines = []
+    lines.append("Exception: %s" % log_dict.pop('_exc'))
+    lines.append("Exception type: %s" % log_dict.pop('_exc_type'))
+    lines.append("Time: %s" % strftime("%Y-%m-%d %H:%M %Z"))
+    lines += (
+        ["%s: %s" % (key, value) for key, value in log_dict.items()
+         if value and key != '_traceback']
+    )
+    for key in ('owner', 'user', 'sudoer'):
+        _id = log_dict.get('%s_id' % key)
+        if _id:
+            try:
+                value = mist.api.users.models.Owner.objects.get(id=_id)
+                lines.append("%s: %s" % (key, value))
+            except mist.api.users.models.Owner.DoesNotExist:
+                pass
+            except Exception as exc:
+                log.error("Error finding user in logged exc: %r", exc)
+    lines.append("-" * 10)
+    lines.append(log_dict['_traceback'])
+    lines.append("=" * 10)
+    msg = "\n".join(lines) + "\n"
+    directory = "var/log/exceptions"
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    filename = "%s/%s" % (directory, int(time()))
+    with open(filename, 'w+') as f:
+        f.write(msg)
+        # traceback.print_exc(file=f)
+
+
+REQUEST_LOG_PIPELINE = RequestLogPipeline()
+atexit.register(REQUEST_LOG_PIPELINE.flush)
+
+
 def logging_view_decorator(func):
     """Decorator that logs a view function's request and response."""
     def logging_view(context, request):
@@ -830,6 +1773,9 @@ def logging_view_decorator(func):
         view will be activated and the request along with its error response
         will be handled there.
 
+        Only a record of the request is captured here. The actual logging
+        happens in the background, see `RequestLogPipeline`.
+
         """
 
         # hack to preserve view function's name if an exception is raised
@@ -860,212 +1806,22 @@ def logging_view_decorator(func):
                                         'enable_insights', 'register'):
             # don't log these views no matter what
             return response
-        # log request #
-        log_dict = {
-            'event_type': 'request',
-            'action': request.real_view_name,
-            'request_path': request.path_info,
-            'request_method': request.method,
-            'request_ip': ip_from_request(request),
-            'user_agent': request.user_agent,
-            'response_code': response.status_code,
-            'error': response.status_code >= 400,
-        }
+        # capture request #
+        record = _request_log_record(request, response, exc_flag)
 
-        # log original exception
+        # capture original exception, while it's being handled
         if isinstance(context, MistError):
             if context.orig_exc:
-                log_dict['_exc'] = repr(context.orig_exc)
-                log_dict['_exc_type'] = type(context.orig_exc)
+                record['_exc'] = repr(context.orig_exc)
+                record['_exc_type'] = type(context.orig_exc)
                 if context.orig_traceback:
-                    log_dict['_traceback'] = context.orig_traceback
+                    record['_traceback'] = context.orig_traceback
         elif isinstance(context, Exception):
-            log_dict['_exc'] = repr(context)
-            log_dict['_exc_type'] = type(context)
-            log_dict['_traceback'] = traceback.format_exc()
-
-        # log session
-        session = request.environ['session']
-        if session:
-            log_dict['session_id'] = str(session.id)
-            try:
-                if session.fingerprint:
-                    log_dict['fingerprint'] = session.fingerprint
-                if session.experiment:
-                    log_dict['experiment'] = session.experiment
-                if session.choice:
-                    log_dict['choice'] = session.choice
-            except AttributeError: # in case of ApiToken
-                pass
-
-        # log user
-        user = session.get_user(effective=False)
-        if user is not None:
-            log_dict['user_id'] = user.id
-            sudoer = session.get_user()
-            if sudoer != user:
-                log_dict['sudoer_id'] = sudoer.id
-            auth_context = mist.api.auth.methods.auth_context_from_request(
-                request)
-            log_dict['owner_id'] = auth_context.owner.id
-        else:
-            log_dict['user_id'] = None
-            log_dict['owner_id'] = None
-
-        if isinstance(session, ApiToken):
-            if not 'dummy' in session.name:
-                log_dict['api_token_id'] = str(session.id)
-                log_dict['api_token_name'] = session.name
-                log_dict['api_token'] = session.token[:4] + '***CENSORED***'
-                log_dict['token_expires'] = datetime_to_str(session.expires())
-
-        # Log special Token.
-        if SUPER_EXISTS and isinstance(session, SuperToken):
-            log_dict['setuid'] = True
-            log_dict['api_token_id'] = str(session.id)
-            log_dict['api_token_name'] = session.name
-
-        # log matchdict and params
-        params = dict(params_from_request(request))
-        for key in ['email', 'cloud', 'machine', 'rule', 'script_id',
-                    'tunnel_id', 'story_id', 'stack_id', 'template_id']:
-            if key != 'email' and key in request.matchdict:
-                if not key.endswith('_id'):
-                    log_dict[key + '_id'] = request.matchdict[key]
-                else:
-                    log_dict[key] = request.matchdict[key]
-                continue
-            if key != 'email':
-                key += '_id'
-            if key in params:
-                log_dict[key] = params.pop(key)
-            if snake_to_camel(key) in params:
-                log_dict[key] = params.pop(snake_to_camel(key))
-
-        for key in ('priv', 'password', 'new_password', 'apikey', 'apisecret',
-                    'cert_file', 'key_file'):
-            if params.get(key):
-                params[key] = '***CENSORED***'
-        if log_dict['action'] == 'add_cloud':
-            provider = params.get('provider')
-            censor = {'vcloud': 'password',
-                      'indonesian_vcloud': 'password',
-                      'ec2': 'api_secret',
-                      'rackspace': 'api_key',
-                      'nephoscale': 'password',
-                      'softlayer': 'api_key',
-                      'onapp': 'api_key',
-                      'digitalocean': 'token',
-                      'gce': 'private_key',
-                      'azure': 'certificate',
-                      'linode': 'api_key',
-                      'docker': 'auth_password',
-                      'hp': 'password',
-                      'openstack': 'password'}.get(provider)
-            if censor and censor in params:
-                params[censor] = '***CENSORED***'
-        log_dict['request_params'] = params
-
-        # log response body
-        try:
-            bdict = json.loads(response.body)
-            for key in ('job_id', 'job',):
-                if key in bdict and key not in log_dict:
-                    log_dict[key] = bdict[key]
-            if 'cloud' in bdict and 'cloud_id' not in log_dict:
-                log_dict['cloud_id'] = bdict['cloud']
-            if 'machine' in bdict and 'machine_id' not in log_dict:
-                log_dict['machine_id'] = bdict['machine']
-            # Match resource type based on the action performed.
-            for rtype in ['cloud', 'machine', 'key', 'script', 'tunnel',
-                          'stack', 'template', 'schedule']:
-                if rtype in log_dict['action']:
-                    if 'id' in bdict and '%s_id' % rtype not in log_dict:
-                        log_dict['%s_id' % rtype] = bdict['id']
-                        break
-            if log_dict['action'] == 'update_rule':
-                if 'id' in bdict and 'rule_id' not in log_dict:
-                    log_dict['rule_id'] = bdict['id']
-            for key in ('priv', ):
-                if key in bdict:
-                    bdict[key] = '***CENSORED***'
-            if 'token' in bdict:
-                bdict['token'] = bdict['token'][:4] + '***CENSORED***'
-            log_dict['response_body'] = json.dumps(bdict)
-        except:
-            log_dict['response_body'] = response.body
-
-        # override logged action for specific views
-        if log_dict['action'] == 'machine_actions':
-            action = log_dict['request_params'].pop('action', None)
-            if action:
-                log_dict['action'] = '%s_machine' % action
-        elif log_dict['action'] == 'toggle_cloud':
-            state = log_dict['request_params'].pop('new_state', None)
-            if state == '1':
-                log_dict['action'] = 'enable_cloud'
-            elif state == '0':
-                log_dict['action'] = 'disable_cloud'
-        elif log_dict['action'] == 'update_monitoring':
-            if log_dict['request_params'].pop('action', None) == 'enable':
-                log_dict['action'] = 'enable_monitoring'
-            else:
-                log_dict['action'] = 'disable_monitoring'
-
-        # we save log_dict in mongo logging collection
-        from mist.api.logs.methods import log_event as log_event_to_es
-        log_event_to_es(**log_dict)
-
-        # if a bad exception didn't occur then return, else log it to file
-        if not exc_flag:
-            return response
-
-        # Publish traceback in rabbitmq, for heka to parse and forward to elastic
-        log.info("Bad exception occured, logging to rabbitmq")
-        es_dict = log_dict.copy()
-        es_dict.pop('_exc_type')
-        es_dict['time'] = time()
-        es_dict['traceback'] = es_dict.pop('_traceback')
-        es_dict['exception'] = es_dict.pop('_exc')
-        es_dict['type'] = 'exception'
-        routing_key = "%s.%s" % (es_dict['owner_id'], es_dict['action'])
-        pickler = jsonpickle.pickler.Pickler()
-        amqp_publish('exceptions', routing_key, pickler.flatten(es_dict),
-                     ex_type='topic', ex_declare=True,
-                     auto_delete=False)
-
-        # log bad exception to file
-        log.info("Bad exception occured, logging to file")
-        lines = []
-        lines.append("Exception: %s" % log_dict.pop('_exc'))
-        lines.append("Exception type: %s" % log_dict.pop('_exc_type'))
-        lines.append("Time: %s" % strftime("%Y-%m-%d %H:%M %Z"))
-        lines += (
-            ["%s: %s" % (key, value) for key, value in log_dict.items()
-             if value and key != '_traceback']
-        )
-        for key in ('owner', 'user', 'sudoer'):
-            _id = log_dict.get('%s_id' % key)
-            if _id:
-                try:
-                    value = mist.api.users.models.Owner.objects.get(id=_id)
-                    lines.append("%s: %s" % (key, value))
-                except mist.api.users.models.Owner.DoesNotExist:
-                    pass
-                except Exception as exc:
-                    log.error("Error finding user in logged exc: %r", exc)
-        lines.append("-" * 10)
-        lines.append(log_dict['_traceback'])
-        lines.append("=" * 10)
-        msg = "\n".join(lines) + "\n"
-        directory = "var/log/exceptions"
-        if not os.path.exists(directory):
-            os.makedirs(directory)
-        filename = "%s/%s" % (directory, int(time()))
-        with open(filename, 'w+') as f:
-            f.write(msg)
-            # traceback.print_exc(file=f)
+            record['_exc'] = repr(context)
+            record['_exc_type'] = type(context)
+            record['_traceback'] = traceback.format_exc()
 
+        REQUEST_LOG_PIPELINE.put(record)
         return response
 
     return logging_view
@@ -1078,6 +1834,97 @@ def view_config(*args, **kwargs):
                                **kwargs)
 
 
+# Arguments making each JSON encoder encode values as the json module does.
+_JSON_ENCODER_KWARGS = {
+    'simplejson': {'namedtuple_as_object': False, 'use_decimal': False},
+}
+
+
+def json_serializer(name=None):
+    """Return a function that JSON encodes values, like `json.dumps`
+
+    The `dumps` function of module `name`, `config.JSON_ENCODER` by default,
+    is used, if it can be imported. Values it fails to encode are encoded by
+    the json module instead. Either way, values of unknown types are passed
+    to the `default` callback, so this may serve as the serializer of
+    pyramid's JSON renderer, keeping its adapters.
+
+    """
+    if name is None:
+        name = config.JSON_ENCODER
+    if not name or name == 'json':
+        return json.dumps
+    try:
+        module = importlib.import_module(name)
+    except ImportError:
+        log.warning("Can't import JSON encoder %s, using json instead", name)
+        return json.dumps
+    encoder_kwargs = _JSON_ENCODER_KWARGS.get(name, {})
+
+    def dumps(value, **kwargs):
+        try:
+            return module.dumps(value, **dict(encoder_kwargs, **kwargs))
+        except Exception as exc:
+            log.warning("JSON encoder %s failed, using json instead: %r",
+                        name, exc)
+            return json.dumps(value, **kwargs)
+
+    return dumps
+
+
+_COMPRESSED_CONTENT_TYPES = ('application/json', 'application/javascript')
+
+
+def compress(body, encoding, level=6):
+    """Compress `body` with the 'gzip' or 'deflate' content encoding"""
+    if encoding == 'gzip':
+        wbits = 16 + zlib.MAX_WBITS
+    else:
+        wbits = zlib.MAX_WBITS
+    compressor = zlib.compressobj(level, zlib.DEFLATED, wbits)
+    return compressor.compress(body) + compressor.flush()
+
+
+def compression_tween_factory(handler, registry):
+    """Tween compressing responses, as accepted by the client
+
+    Text and JSON responses of at least `config.COMPRESS_MIN_SIZE` bytes are
+    gzip or deflate encoded, according to the Accept-Encoding header of the
+    request. Streamed or already encoded responses are left alone. All text
+    and JSON responses vary on Accept-Encoding, whether they were compressed
+    or not, so that caches don't hand one kind to clients asking for another.
+
+    """
+    def compression_tween(request):
+        response = handler(request)
+        if not config.COMPRESS_MIN_SIZE or request.method == 'HEAD':
+            return response
+        if response.content_encoding or response.content_length is None:
+            return response
+        content_type = response.content_type or ''
+        if not (content_type.startswith('text/') or
+                content_type in _COMPRESSED_CONTENT_TYPES):
+            return response
+        vary = tuple(response.vary or ())
+        if 'Accept-Encoding' not in vary:
+            response.vary = vary + ('Accept-Encoding', )
+        if response.content_length < config.COMPRESS_MIN_SIZE:
+            return response
+        encoding = request.accept_encoding.best_match(['gzip', 'deflate'])
+        if encoding not in ('gzip', 'deflate'):
+            return response
+        response.body = compress(response.body, encoding,
+                                 config.COMPRESS_LEVEL)
+        response.content_encoding = encoding
+        # The encoded body is no longer byte for byte the same.
+        etag = response.headers.get('ETag')
+        if etag and not etag.startswith('W/'):
+            response.headers['ETag'] = 'W/' + etag
+        return response
+
+    return compression_tween
+
+
 class AsyncElasticsearch(EsClient):
     """Tornado-compatible Elasticsearch client."""
 
@@ -1092,12 +1939,16 @@ class AsyncElasticsearch(EsClient):
         })
         for param in ('connect_timeout', 'request_timeout'):
             if param not in kwargs:
-                kwargs[param] = 30.0  # Increase default timeout by 10 sec.
+                kwargs[param] = float(config.ELASTICSEARCH_TIMEOUT)
         return super(AsyncElasticsearch, self).mk_req(url, **kwargs)
 
 
-def es_client(async=False):
-    """Returns an initialized Elasticsearch client."""
+_ES_CLIENTS = {}
+_ES_CLIENTS_PID = None
+
+
+def _new_es_client(async=False):
+    """Returns a new, initialized Elasticsearch client."""
     if not async:
         return Elasticsearch(
             config.ELASTICSEARCH['elastic_host'],
@@ -1106,6 +1957,11 @@ def es_client(async=False):
                        config.ELASTICSEARCH['elastic_password']),
             use_ssl=config.ELASTICSEARCH['elastic_use_ssl'],
             verify_certs=config.ELASTICSEARCH['elastic_verify_certs'],
+            maxsize=config.ELASTICSEARCH_POOL_SIZE,
+            timeout=config.ELASTICSEARCH_TIMEOUT,
+            sniff_on_start=False,
+            sniff_on_connection_fail=False,
+            sniffer_timeout=None,
         )
     else:
         method = 'https' if config.ELASTICSEARCH['elastic_use_ssl'] else 'http'
@@ -1115,6 +1971,23 @@ def es_client(async=False):
         )
 
 
+def es_client(async=False):
+    """Returns an Elasticsearch client shared by the current process
+
+    Clients are thread safe and keep their connections alive, so a single
+    one of each kind is created per process, including forked children.
+
+    """
+    global _ES_CLIENTS_PID
+    if _ES_CLIENTS_PID != os.getpid():
+        _ES_CLIENTS.clear()
+        _ES_CLIENTS_PID = os.getpid()
+    client = _ES_CLIENTS.get(async)
+    if client is None:
+        client = _ES_CLIENTS.setdefault(async, _new_es_client(async))
+    return client
+
+
 def get_file(url, filename, update=True):
     """Get file from url and store it to directory relative to src/mist/api
 
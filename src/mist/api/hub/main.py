@@ -1,7 +1,10 @@
+import os
 import sys
+import time
 import uuid
 import json
 import signal
+import socket
 import logging
 import argparse
 import traceback
@@ -219,7 +222,16 @@ class AmqpGeventBase(object):
 
 
 class HubServer(AmqpGeventBase):
-    """Hub Server"""
+    """Hub Server
+
+    Requests for new workers are consumed from a queue shared by all hub
+    servers. Each request is only acked once its worker stops, so with a
+    prefetch count of `config.HUB_MAX_WORKERS` the broker stops delivering
+    requests to a server that has reached its capacity and hands them to
+    the other servers instead. Management requests, such as `list_workers`,
+    are broadcast to all hub servers.
+
+    """
 
     def __init__(self, exchange=EXCHANGE, key=REQUESTS_KEY, workers=None):
         """Initialize a Hub Server"""
@@ -228,22 +240,120 @@ class HubServer(AmqpGeventBase):
         self.worker_cls = {'echo': EchoHubWorker}
         self.worker_cls.update(workers or {})
         self.workers = {}
+        self.cpu = 0.0
+        self.requests_chan = None
+
+    def start(self):
+        """Call super and also start CPU usage sampling greenlet"""
+        if not self.started:
+            self.greenlets['stats'] = gevent.spawn(self.sample_cpu)
+        super(HubServer, self).start()
 
     def amqp_consume(self):
         # initialize amqp connection and channel, declare exchange
         self.chan.exchange_declare(self.exchange, 'topic')
         log.info("%s: Will use exchange '%s'.", self.lbl, self.exchange)
 
-        # declare, bind, set consumer for rpc calls
-        self.chan.basic_qos(0, 1, False)  # prefetch count = 1
-        self.chan.queue_declare(self.key, exclusive=True)
-        self.chan.queue_bind(self.key, self.exchange, '%s.#' % self.key)
-        self.chan.basic_consume(self.key, callback=self.amqp_handle_msg,
+        # declare, bind, set consumer for rpc calls shared by all servers,
+        # worker requests are acked when their worker stops, so the prefetch
+        # count caps the number of workers
+        self.requests_chan = self.chan
+        self.chan.basic_qos(0, config.HUB_MAX_WORKERS, False)
+        self.chan.queue_declare(self.key, auto_delete=True)
+        for action in ('worker.#', 'stop'):
+            self.chan.queue_bind(self.key, self.exchange,
+                                 '%s.%s' % (self.key, action))
+        self.chan.basic_consume(self.key, callback=self.amqp_handle_request)
+        log.info("%s: RPC queue '%s' with routing keys '%s.worker.#' and "
+                 "'%s.stop'.", self.lbl, self.key, self.key, self.key)
+
+        # declare, bind, set consumer for rpc calls broadcast to all servers
+        self.chan.queue_declare(self.uuid, exclusive=True)
+        for action in ('list_workers', 'stop_worker'):
+            self.chan.queue_bind(self.uuid, self.exchange,
+                                 '%s.%s' % (self.key, action))
+        self.chan.basic_consume(self.uuid, callback=self.amqp_handle_msg,
                                 no_ack=True)
-        log.info("%s: RPC queue '%s' with routing key '%s.#'.",
-                 self.lbl, self.key, self.key)
+        log.info("%s: Broadcast queue '%s'.", self.lbl, self.uuid)
         super(HubServer, self).amqp_consume()
 
+    def amqp_handle_request(self, msg):
+        """Handle msg from the shared queue, acking it when done
+
+        Worker requests are acked when their worker stops. Other requests,
+        such as `stop`, are acked before being handled.
+
+        """
+        delivery_tag = msg.delivery_info['delivery_tag']
+        routing_key = msg.delivery_info.get('routing_key', '')
+        if not routing_key.startswith('%s.worker.' % self.key):
+            self.ack_request(delivery_tag)
+            return self.amqp_handle_msg(msg)
+        if config.HUB_MAX_CPU and self.cpu >= config.HUB_MAX_CPU:
+            log.warning("%s: CPU usage at %.1f%%, delaying request.",
+                        self.lbl, self.cpu)
+            gevent.spawn(self.handle_delayed_request, msg)
+            return
+        self.handle_worker_request(msg)
+
+    def handle_delayed_request(self, msg):
+        """Handle a worker request once CPU usage drops below the limit"""
+        while not self.stopped and config.HUB_MAX_CPU and \
+                self.cpu >= config.HUB_MAX_CPU:
+            gevent.sleep(config.HUB_STATS_INTERVAL)
+        if not self.stopped:
+            self.handle_worker_request(msg)
+
+    def handle_worker_request(self, msg):
+        worker = self.amqp_handle_msg(msg)
+        if worker is None or worker.stopped:
+            self.ack_request(msg.delivery_info['delivery_tag'])
+        else:
+            worker.delivery_tag = msg.delivery_info['delivery_tag']
+
+    def ack_request(self, delivery_tag):
+        """Ack a request of the shared queue, from any greenlet"""
+        if self.stopped or self.requests_chan is None:
+            return
+        try:
+            self.requests_chan.basic_ack(delivery_tag)
+        except Exception as exc:
+            log.warning("%s: Error acking request %s: %r",
+                        self.lbl, delivery_tag, exc)
+
+    def at_capacity(self):
+        """Check whether this server should refuse to start new workers"""
+        if config.HUB_MAX_WORKERS and \
+                len(self.workers) >= config.HUB_MAX_WORKERS:
+            return True
+        if config.HUB_MAX_CPU and self.cpu >= config.HUB_MAX_CPU:
+            return True
+        return False
+
+    def sample_cpu(self):
+        """Periodically compute this process' CPU usage percentage"""
+        times, tstamp = os.times(), time.time()
+        while True:
+            gevent.sleep(config.HUB_STATS_INTERVAL)
+            new_times, new_tstamp = os.times(), time.time()
+            used = sum(new_times[:2]) - sum(times[:2])
+            self.cpu = 100.0 * used / max(new_tstamp - tstamp, 0.001)
+            times, tstamp = new_times, new_tstamp
+
+    def get_stats(self):
+        """Return this server's load and capacity"""
+        return {
+            'uuid': self.uuid,
+            'hostname': socket.gethostname(),
+            'pid': os.getpid(),
+            'active_workers': len(self.workers),
+            'max_workers': config.HUB_MAX_WORKERS,
+            'cpu': round(self.cpu, 1),
+            'max_cpu': config.HUB_MAX_CPU,
+            'load': os.getloadavg(),
+            'at_capacity': self.at_capacity(),
+        }
+
     def get_resp_details(self, msg):
         """Find correlation_id and reply_to key for RPC response"""
         if not (msg.properties.get('correlation_id') and
@@ -281,6 +391,7 @@ class HubServer(AmqpGeventBase):
                             self.exchange)
         self.workers[worker.uuid] = worker
         worker.start()
+        return worker
 
     def list_workers(self):
         types_to_names = {val: key for key, val in self.worker_cls.items()}
@@ -292,7 +403,9 @@ class HubServer(AmqpGeventBase):
         return workers_list
 
     def on_list_workers(self, msg):
-        self.send_rpc_response(msg, self.list_workers())
+        stats = self.get_stats()
+        stats['workers'] = self.list_workers()
+        self.send_rpc_response(msg, stats)
 
     def on_stop(self, msg=''):
         log.info("%s: Received STOP message, stopping.", self.lbl)
@@ -301,9 +414,10 @@ class HubServer(AmqpGeventBase):
 
     def on_stop_worker(self, msg):
         log.info("%s: Received STOP %s message, stopping.", self.lbl, msg.body)
-        if msg.body in self.workers:
+        found = msg.body in self.workers
+        if found:
             self.workers[msg.body].stop()
-        self.send_rpc_response(msg)
+        self.send_rpc_response(msg, found)
 
     def stop(self):
         """Stop all workers and then call super"""
@@ -329,6 +443,7 @@ class HubWorker(AmqpGeventBase):
         self.reply_to = reply_to
         self.correlation_id = correlation_id
         self.params = params
+        self.delivery_tag = None  # of the request, acked when stopped
 
     def send_ready(self):
         """Send RPC response back to client when worker is ready"""
@@ -367,6 +482,9 @@ class HubWorker(AmqpGeventBase):
     def stop(self):
         if self.uuid in self.server.workers:
             self.server.workers.pop(self.uuid)
+        if self.delivery_tag is not None:
+            self.server.ack_request(self.delivery_tag)
+            self.delivery_tag = None
         super(HubWorker, self).stop()
 
     def on_close(self, msg=''):
@@ -510,7 +628,8 @@ class Manager():
     def __init__(self, exchange=EXCHANGE, key=REQUESTS_KEY):
         self.exchange = exchange
         self.key = key
-        self.response = None
+        self.responses = []
+        self.broadcast = False
         self.correlation_id = ''
 
         self.conn = amqp.Connection()
@@ -523,12 +642,20 @@ class Manager():
                                 no_ack=True)
         log.debug("Initialized amqp connection, channel, queue.")
 
-    def _send(self, command, payload=None):
+    def _send(self, command, payload=None, broadcast=False):
+        """Send RPC request and wait for response
+
+        If `broadcast` is True, the request is expected to reach all hub
+        servers and a list of all responses received until no more arrive
+        within `config.HUB_MANAGER_TIMEOUT` seconds is returned.
+
+        """
 
         # send rpc request
         if self.correlation_id:
             raise Exception("Can't send second request while already waiting.")
-        self.response = None
+        self.responses = []
+        self.broadcast = broadcast
         self.correlation_id = uuid.uuid4().hex
         routing_key = '%s.%s' % (self.key, command)
         msg = amqp.Message(json.dumps(payload),
@@ -540,18 +667,27 @@ class Manager():
         self.chan.basic_publish(msg, self.exchange, routing_key)
         log.info("Sent RPC request, will wait for response.")
 
-        # wait for rpc response
+        # wait for rpc response(s)
         try:
-            while self.correlation_id:
-                log.debug("Waiting for RPC response.")
-                self.chan.wait()
+            if broadcast:
+                while True:
+                    log.debug("Waiting for RPC responses.")
+                    self.conn.drain_events(timeout=config.HUB_MANAGER_TIMEOUT)
+            else:
+                while self.correlation_id:
+                    log.debug("Waiting for RPC response.")
+                    self.chan.wait()
+        except socket.timeout:
+            log.debug("Received %d RPC responses.", len(self.responses))
         except BaseException as exc:
             log.error("Amqp consumer received %r while waiting for RPC "
                       "response. Stopping.", exc)
         log.info("Finished waiting for RPC response.")
-        response = self.response
-        self.response = None
-        return response
+        self.correlation_id = ''
+        responses, self.responses = self.responses, []
+        if broadcast:
+            return responses
+        return responses[0] if responses else None
 
     def _recv(self, msg):
         routing_key = msg.delivery_info.get('routing_key', '')
@@ -577,14 +713,16 @@ class Manager():
                 msg.properties.get('correlation_id'), self.correlation_id
             )
             return
-        self.response = body
-        self.correlation_id = ''
+        self.responses.append(body)
+        if not self.broadcast:
+            self.correlation_id = ''
 
     def list_workers(self):
-        return self._send('list_workers')
+        """Return capacity stats and workers of every running hub server"""
+        return self._send('list_workers', broadcast=True)
 
     def stop_worker(self, worker_uuid):
-        return self._send('stop_worker', worker_uuid)
+        return any(self._send('stop_worker', worker_uuid, broadcast=True))
 
     def stop(self):
         return self._send('stop')
@@ -3,6 +3,7 @@ import time
 import logging
 
 import gevent
+import gevent.lock
 import gevent.socket
 
 import mist.api.exceptions
@@ -10,7 +11,8 @@ import mist.api.shell
 import mist.api.hub.main
 import mist.api.users.models
 import mist.api.logs.methods
-from mist.api.misc.shell import ShellCapture
+from mist.api import config
+from mist.api.misc.shell import ShellCapture, ShellCaptureChunk
 
 
 log = logging.getLogger(__name__)
@@ -21,6 +23,8 @@ class ShellHubWorker(mist.api.hub.main.HubWorker):
         super(ShellHubWorker, self).__init__(*args, **kwargs)
         self.shell = None
         self.channel = None
+        self.output_buffer = []
+        self.output_buffer_size = 0
         for key in ('owner_id', 'cloud_id', 'machine_id', 'host',
                     'columns', 'rows'):
             # HACK:FIXME: Temporary fix for Orchestration shell.
@@ -97,7 +101,20 @@ class ShellHubWorker(mist.api.hub.main.HubWorker):
                                 self.lbl, columns, rows, exc)
 
     def emit_shell_data(self, data):
-        self.send_to_client('data', data)
+        """Buffer shell output, sending it once enough has accumulated"""
+        self.output_buffer.append(data)
+        self.output_buffer_size += len(data)
+        if (self.output_buffer_size >= config.SHELL_OUTPUT_BATCH_SIZE or
+                not config.SHELL_OUTPUT_BATCH_DELAY):
+            self.flush_shell_data()
+
+    def flush_shell_data(self):
+        """Send all buffered shell output to the client as one message"""
+        if self.output_buffer:
+            data = ''.join(self.output_buffer)
+            self.output_buffer = []
+            self.output_buffer_size = 0
+            self.send_to_client('data', data)
 
     def get_ssh_data(self):
         try:
@@ -107,19 +124,34 @@ class ShellHubWorker(mist.api.hub.main.HubWorker):
                 except:
                     pass
             while True:
-                gevent.socket.wait_read(self.channel.fileno())
+                # Flush buffered output as soon as the channel goes idle.
+                timeout = None
+                if self.output_buffer:
+                    timeout = config.SHELL_OUTPUT_BATCH_DELAY
+                try:
+                    gevent.socket.wait_read(self.channel.fileno(), timeout)
+                except gevent.socket.timeout:
+                    self.flush_shell_data()
+                    continue
                 try:
                     data = self.channel.recv(1024).decode('utf-8', 'ignore')
                 except TypeError:
                     data = self.channel.recv().decode('utf-8', 'ignore')
 
                 if not len(data):
+                    self.flush_shell_data()
                     return
                 self.emit_shell_data(data)
         finally:
             self.channel.close()
 
     def stop(self):
+        if not self.stopped:
+            try:
+                self.flush_shell_data()
+            except Exception as exc:
+                log.warning("%s: Error flushing shell output: %r",
+                            self.lbl, exc)
         super(ShellHubWorker, self).stop()
         if self.channel is not None:
             self.channel.close()
@@ -133,48 +165,122 @@ class LoggingShellHubWorker(ShellHubWorker):
     def __init__(self, *args, **kwargs):
         super(LoggingShellHubWorker, self).__init__(*args, **kwargs)
         self.capture = []
+        self.capture_size = 0
         self.capture_started_at = 0
+        self.capture_doc = None
+        self.capture_seq = 0
+        self.capture_truncated = False
+        # flushes by the periodic greenlet and by record_capture, which both
+        # yield while saving, must not interleave
+        self.capture_lock = gevent.lock.RLock()
         self.stopped = False
 
     def on_ready(self, msg=''):
+        self.capture_started_at = time.time()
         super(LoggingShellHubWorker, self).on_ready(msg)
+        if self.shell is not None:
+            self.greenlets['flush_capture'] = gevent.spawn(
+                self.flush_capture_periodically
+            )
         # Don't log cfy container log views
         if self.params.get('provider') != 'docker' or not self.params.get('job_id'):
             mist.api.logs.methods.log_event(action='open', event_type='shell',
                                             shell_id=self.uuid, **self.params)
 
     def emit_shell_data(self, data):
-        self.capture.append((time.time(), 'data', data))
+        self.record_capture('data', data, len(data))
         super(LoggingShellHubWorker, self).emit_shell_data(data)
 
     def on_resize(self, msg):
         res = super(LoggingShellHubWorker, self).on_resize(msg)
         if res:
-            self.capture.append((time.time(), 'resize', res))
+            self.record_capture('resize', res)
+
+    def record_capture(self, event, data, size=0):
+        """Buffer a captured event, flushing to storage when needed"""
+        if size > config.SHELL_CAPTURE_CHUNK_SIZE:
+            # record large output in pieces, which always fit in the buffer
+            # once flushed
+            for i in range(0, size, config.SHELL_CAPTURE_CHUNK_SIZE):
+                piece = data[i:i + config.SHELL_CAPTURE_CHUNK_SIZE]
+                self.record_capture(event, piece, len(piece))
+            return
+        if self.capture_size + size > config.SHELL_CAPTURE_MAX_BUFFER:
+            if not self.flush_capture():
+                log.warning("%s: Capture buffer full, dropping %d bytes.",
+                            self.lbl, size)
+                self.capture_truncated = True
+                return
+        self.capture.append((time.time(), event, data))
+        self.capture_size += size
+        if self.capture_size >= config.SHELL_CAPTURE_CHUNK_SIZE:
+            self.flush_capture()
+
+    def flush_capture_periodically(self):
+        while True:
+            gevent.sleep(config.SHELL_CAPTURE_FLUSH_INTERVAL)
+            self.flush_capture()
+
+    def flush_capture(self, finished=False):
+        """Store buffered events as the next chunk of this session's capture
+
+        The capture document is created on the first flush and kept up to
+        date afterwards, so that a partial capture survives the worker dying.
+        Returns False if storing failed, in which case the buffer is kept.
+
+        """
+        with self.capture_lock:
+            return self._flush_capture(finished)
+
+    def _flush_capture(self, finished):
+        if not self.capture and not finished:
+            return True
+        events, size = self.capture, self.capture_size
+        self.capture, self.capture_size = [], 0
+        try:
+            if self.capture_doc is None:
+                self.capture_doc = ShellCapture(
+                    owner=mist.api.users.models.Owner(
+                        id=self.params['owner_id']
+                    ),
+                    capture_id=self.uuid,
+                    cloud_id=self.params['cloud_id'],
+                    machine_id=self.params['machine_id'],
+                    key_id=self.params.get('key_id'),
+                    host=self.params['host'],
+                    ssh_user=self.params.get('ssh_user'),
+                    started_at=self.capture_started_at,
+                    columns=self.params['columns'],
+                    rows=self.params['rows'],
+                )
+            if events:
+                ShellCaptureChunk(
+                    capture_id=self.uuid, sequence=self.capture_seq, size=size,
+                    events=[(tstamp - self.capture_started_at, event, data)
+                            for tstamp, event, data in events],
+                ).save()
+                self.capture_seq += 1
+                self.capture_doc.chunks = self.capture_seq
+                self.capture_doc.size += size
+            self.capture_doc.truncated = self.capture_truncated
+            if finished:
+                self.capture_doc.finished_at = time.time()
+            self.capture_doc.save()
+        except Exception as exc:
+            log.error("%s: Error storing shell capture chunk %d: %r",
+                      self.lbl, self.capture_seq, exc)
+            self.capture = events + self.capture
+            self.capture_size += size
+            return False
+        return True
 
     def stop(self):
         if self.shell and not self.stopped:
             # if not self.shell then namespace initialized
             # but shell_open has happened
-            if self.capture:
-                # save captured data
-                capture = ShellCapture()
-                capture.owner = mist.api.users.models.Owner(
-                    id=self.params['owner_id']
-                )
-                capture.capture_id = self.uuid
-                capture.cloud_id = self.params['cloud_id']
-                capture.machine_id = self.params['machine_id']
-                capture.key_id = self.params.get('key_id')
-                capture.host = self.params['host']
-                capture.ssh_user = self.params.get('ssh_user')
-                capture.started_at = self.capture_started_at
-                capture.finished_at = time.time()
-                capture.columns = self.params['columns']
-                capture.rows = self.params['rows']
-                capture.capture = [(tstamp - self.capture[0][0], event, data)
-                                   for tstamp, event, data in self.capture]
-                capture.save()
+            if self.capture or self.capture_doc is not None:
+                # save remaining captured data
+                self.flush_capture(finished=True)
             # Don't log cfy container log views
             if self.params.get('provider') != 'docker' or not self.params.get('job_id'):
                 mist.api.logs.methods.log_event(action='close',
@@ -102,6 +102,7 @@ class BaseKeyController(object):
         """Associates a key with a machine."""
 
         from mist.api.machines.models import KeyAssociation
+        from mist.api.shell import forget_failed_credentials
 
         log.info("Associating key %s to machine %s", self.key.id,
                  machine.machine_id)
@@ -137,6 +138,7 @@ class BaseKeyController(object):
                                    port=port)
         machine.key_associations.append(key_assoc)
         machine.save()
+        forget_failed_credentials(machine.cloud.id, machine.machine_id)
         trigger_session_update(self.key.owner, ['keys'])
 
         return key_assoc
@@ -49,6 +49,7 @@ class SSHKeyController(BaseKeyController):
 
         # FIXME
         from mist.api.methods import ssh_command
+        from mist.api.shell import forget_failed_credentials
 
         deploy_error = False
 
@@ -58,6 +59,8 @@ class SSHKeyController(BaseKeyController):
                         machine.hostname, command,
                         username=username, port=port)
             log.info("Key associated and deployed successfully.")
+            # the key may have failed to connect before being deployed
+            forget_failed_credentials(machine.cloud.id, machine.machine_id)
         except MachineUnauthorizedError:
             # Couldn't deploy key, maybe key was already deployed?
             deploy_error = True
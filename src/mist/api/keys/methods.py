@@ -4,10 +4,11 @@ from mist.api.keys.models import Key
 from mist.api.clouds.models import Cloud
 from mist.api.machines.models import Machine
 
-from mist.api.tag.methods import get_tags_for_resource
+from mist.api.tag.methods import get_tags_for_resources
 
 from mist.api.helpers import trigger_session_update
 from mist.api.helpers import transform_key_machine_associations
+from mist.api.helpers import paginate_query, select_fields
 
 from mist.api import config
 
@@ -41,36 +42,51 @@ def delete_key(owner, key_id):
     trigger_session_update(owner, ['keys'])
 
 
-def list_keys(owner):
+def list_keys(owner, limit=0, after=None, fields=None, ids=None):
     """List owner's keys
-    :param owner:
-    :return:
+
+    If `limit` is set, at most that many keys are returned, sorted by id,
+    after the key with id `after[0]`. Unless `fields` is None, only those
+    fields of each key are returned. Unless `ids` is None, only the keys
+    with those ids are listed.
+
     """
     keys = Key.objects(owner=owner, deleted=None)
-    clouds = Cloud.objects(owner=owner, deleted=None)
+    if ids is not None:
+        keys = keys.filter(id__in=ids)
+    keys = paginate_query(keys, limit, after, fields,
+                          aliases={'isDefault': 'default'})
+    if fields is None or 'machines' in fields:
+        clouds = Cloud.objects(owner=owner, deleted=None)
+    if fields is None or 'tags' in fields:
+        tags = get_tags_for_resources(owner, keys)
     key_objects = []
     # FIXME: This must be taken care of in Keys.as_dict
     for key in keys:
         key_object = {}
-        machines = Machine.objects(cloud__in=clouds,
-                                   key_associations__keypair__exact=key)
         key_object["id"] = key.id
         key_object['name'] = key.name
         key_object["isDefault"] = key.default
-        key_object["machines"] = transform_key_machine_associations(machines,
-                                                                    key)
-        key_object['tags'] = get_tags_for_resource(owner, key)
-        key_objects.append(key_object)
+        if fields is None or 'machines' in fields:
+            machines = Machine.objects(cloud__in=clouds,
+                                       key_associations__keypair__exact=key)
+            key_object["machines"] = transform_key_machine_associations(
+                machines, key
+            )
+        if fields is None or 'tags' in fields:
+            key_object['tags'] = tags[key.id]
+        key_objects.append(select_fields(key_object, fields))
     return key_objects
 
 
 # SEC
-def filter_list_keys(auth_context, perm='read'):
+def filter_list_keys(auth_context, perm='read', **kwargs):
     """Returns of a list of keys. The list is filtered for non-Owners based on
     the permissions granted.
+
+    Any keyword arguments, such as `limit`, `after` and `fields`, are passed
+    to `list_keys`.
     """
-    keys = list_keys(auth_context.owner)
     if not auth_context.is_owner():
-        keys = [key for key in keys if key['id'] in
-                auth_context.get_allowed_resources(rtype='keys')]
-    return keys
+        kwargs['ids'] = list(auth_context.get_allowed_resources(rtype='keys'))
+    return list_keys(auth_context.owner, **kwargs)
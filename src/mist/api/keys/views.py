@@ -8,6 +8,8 @@ from mist.api.keys.models import SignedSSHKey, SSHKey, Key
 from mist.api.auth.methods import auth_context_from_request
 
 from mist.api.helpers import view_config, params_from_request
+from mist.api.helpers import etag_view
+from mist.api.helpers import list_params_from_request, set_next_cursor
 from mist.api.helpers import transform_key_machine_associations
 
 from mist.api.keys.methods import filter_list_keys
@@ -23,15 +25,32 @@ OK = Response("OK", 200)
 
 
 @view_config(route_name='api_v1_keys', request_method='GET', renderer='json')
+@etag_view('keys')
 def list_keys(request):
     """
     List keys
-    Retrieves a list of all added keys
+    Retrieves a list of all added keys. If there are more keys, the cursor of
+    the next page is returned in the X-Next-Cursor header.
     READ permission required on key.
     ---
+    limit:
+      type: integer
+      required: false
+      description: limit the number of keys returned
+    cursor:
+      type: string
+      required: false
+      description: the X-Next-Cursor header of the previous page
+    fields:
+      type: string
+      required: false
+      description: comma separated list of the fields of each key to return
     """
     auth_context = auth_context_from_request(request)
-    return filter_list_keys(auth_context)
+    kwargs = list_params_from_request(request)
+    keys = filter_list_keys(auth_context, **kwargs)
+    set_next_cursor(request, keys, kwargs['limit'])
+    return keys
 
 
 @view_config(route_name='api_v1_keys', request_method='PUT', renderer='json')
@@ -23,6 +23,14 @@ FIELDS = (
     'incident_id',
 )
 
+# Log fields returned in stories that are not expanded.
+COMPACT_LOG_FIELDS = (
+    'log_id',
+    'stories',
+    'error',
+    'time',
+)
+
 # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
 # Variables and relationship definitions required in order to create stories
 # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
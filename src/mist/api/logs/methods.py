@@ -1,19 +1,34 @@
+import os
 import uuid
 import json
 import time
+import Queue
+import atexit
 import logging
+import threading
 
-from pymongo import MongoClient
+import mongoengine as me
+
+from multiprocessing.pool import ThreadPool
+
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
 
 from mist.api import config
 
 from mist.api.helpers import es_client as es
-from mist.api.helpers import amqp_publish
+from mist.api.helpers import sanitize
+from mist.api.helpers import amqp_publish_many
+from mist.api.helpers import get_mongo_client
 
 from mist.api.exceptions import NotFoundError
+from mist.api.exceptions import BadRequestError
 
 from mist.api.users.models import User
 
+from mist.api.logs.models import Story
+from mist.api.logs.models import OpenIncident
+
 from mist.api.logs.helpers import _filtered_query
 from mist.api.logs.helpers import _on_response_callback
 
@@ -33,6 +48,108 @@ logging.getLogger('elasticsearch').setLevel(logging.ERROR)
 log = logging.getLogger(__name__)
 
 
+class EventWriter(object):
+    """Store and publish logged events in batches, in the background
+
+    Events are queued and written by a daemon thread, once
+    `config.LOG_EVENT_BATCH_SIZE` of them have been collected or
+    `config.LOG_EVENT_FLUSH_INTERVAL` seconds have passed since the first
+    one. If the queue, bounded by `config.LOG_EVENT_QUEUE_SIZE`, is full,
+    the event is written synchronously instead. Set the queue size to 0 to
+    always write events synchronously.
+
+    The thread is started lazily in each process, so that forked processes
+    get their own. Events queued before a fork are left to the parent.
+
+    """
+
+    def __init__(self):
+        self.pid = None
+        self.queue = None
+        self.lock = threading.Lock()
+
+    def _start(self):
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.queue = Queue.Queue(config.LOG_EVENT_QUEUE_SIZE)
+            thread = threading.Thread(target=self._run, args=(self.queue, ),
+                                      name='EventWriter')
+            thread.daemon = True
+            thread.start()
+            self.pid = os.getpid()
+
+    def put(self, event, routing_key):
+        """Queue an event to be stored and published to `routing_key`"""
+        if not config.LOG_EVENT_QUEUE_SIZE:
+            return self.write([(event, routing_key)])
+        if self.pid != os.getpid():
+            self._start()
+        try:
+            self.queue.put_nowait((event, routing_key))
+        except Queue.Full:
+            log.warning('Event queue is full, writing event %s synchronously',
+                        event['log_id'])
+            self.write([(event, routing_key)])
+
+    def flush(self):
+        """Block until all events queued by this process have been written"""
+        if self.pid == os.getpid():
+            self.queue.put(None)
+            self.queue.join()
+
+    def _run(self, queue):
+        while True:
+            items = [queue.get()]
+            deadline = time.time() + config.LOG_EVENT_FLUSH_INTERVAL
+            while items[-1] is not None and \
+                    len(items) < config.LOG_EVENT_BATCH_SIZE:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    items.append(queue.get(timeout=timeout))
+                except Queue.Empty:
+                    break
+            try:
+                self.write([item for item in items if item is not None])
+            finally:
+                for _ in items:
+                    queue.task_done()
+
+    def write(self, batch):
+        """Store and publish a list of (event, routing_key) tuples"""
+        if not batch:
+            return
+        # FIXME: Deprecate
+        try:
+            coll = get_mongo_client()['mist'].logging
+            coll.insert_many([event.copy() for event, _ in batch],
+                             ordered=False)
+        except Exception as exc:
+            log.error('Failed to store %d events: %r', len(batch), exc)
+
+        # Update the stories the events belong to.
+        try:
+            update_stories([event for event, _ in batch])
+        except Exception as exc:
+            log.error('Failed to update stories of %d events: %r',
+                      len(batch), exc)
+
+        # Broadcast events to RabbitMQ's "events" exchange.
+        try:
+            amqp_publish_many('events', [(routing_key, event)
+                                         for event, routing_key in batch],
+                              ex_type='topic', ex_declare=True,
+                              auto_delete=False)
+        except Exception as exc:
+            log.error('Failed to publish %d events: %r', len(batch), exc)
+
+
+EVENT_WRITER = EventWriter()
+atexit.register(EVENT_WRITER.flush)
+
+
 def log_event(owner_id, event_type, action, error=None, **kwargs):
     """Log a new event.
 
@@ -56,6 +173,7 @@ def log_event(owner_id, event_type, action, error=None, **kwargs):
 
     try:
         # Prepare the base event to be logged.
+        extra = sanitize(kwargs, default=_default)
         event = {
             'owner_id': owner_id or None,
             'log_id': uuid.uuid4().hex,
@@ -63,7 +181,7 @@ def log_event(owner_id, event_type, action, error=None, **kwargs):
             'type': event_type,
             'time': time.time(),
             'error': error if error else False,
-            'extra': json.dumps(kwargs, default=_default)
+            'extra': json.dumps(extra)
         }
         # Bring more key-value pairs to the top level.
         for key in FIELDS:
@@ -83,7 +201,7 @@ def log_event(owner_id, event_type, action, error=None, **kwargs):
                 continue
             if event.get(key):
                 event.update({'story_id': event[key], 'stories': []})
-                associate_stories(event)
+                associate_stories(event, extra)
                 break
         else:
             # Special case for closing stories unless an error has been raised,
@@ -98,6 +216,7 @@ def log_event(owner_id, event_type, action, error=None, **kwargs):
                 except Exception as exc:
                     log.error('Event %s failed to close open incidents: %s',
                               event['log_id'], exc)
+            update_open_incidents(event)
         # Cross populate session-log data.
         try:
             cross_populate_session_data(event, kwargs)
@@ -106,20 +225,13 @@ def log_event(owner_id, event_type, action, error=None, **kwargs):
     except Exception as exc:
         log.error('Failed to log event %s: %s', event, exc)
     else:
-        # FIXME: Deprecate
-        conn = MongoClient(config.MONGO_URI)
-        coll = conn['mist'].logging
-        coll.save(event.copy())
-        conn.close()
-
         # Construct RabbitMQ routing key.
         keys = [str(owner_id), str(event_type), str(action)]
         keys.append('true' if error else 'false')
         routing_key = '.'.join(map(str.lower, keys))
 
-        # Broadcast event to RabbitMQ's "events" exchange.
-        amqp_publish('events', routing_key, event,
-                     ex_type='topic', ex_declare=True, auto_delete=False)
+        # Store and broadcast event in the background.
+        EVENT_WRITER.put(event.copy(), routing_key)
 
         event.pop('extra')
         event.update(kwargs)
@@ -138,6 +250,28 @@ def get_events(auth_context, owner_id='', user_id='', event_type='', action='',
 
     All Elasticsearch indices are in the form of <app|ui>-logs-<date>.
 
+    """
+    events, _ = search_events(auth_context, owner_id=owner_id,
+                              user_id=user_id, event_type=event_type,
+                              action=action, limit=limit, start=start,
+                              stop=stop, newest=newest, error=error, **kwargs)
+    for event in events:
+        yield event
+
+
+def search_events(auth_context, owner_id='', user_id='', event_type='',
+                  action='', limit=0, start=0, stop=0, newest=True, error=None,
+                  after=None, **kwargs):
+    """Fetch a page of logged events.
+
+    Query Elasticsearch for up to `limit` events, just like `get_events`.
+    Events are sorted by their `@timestamp` and `log_id`, whose values for
+    the last event of the page may be passed as `after` in order to fetch
+    the next page, no matter how deep.
+
+    Returns a list of events and the sort values of the last one, or None,
+    if there are no more events.
+
     """
     # Restrict access to UI logs to Admins only.
     is_admin = auth_context and auth_context.user.role == 'Admin'
@@ -172,10 +306,18 @@ def get_events(auth_context, owner_id='', user_id='', event_type='', action='',
                 "@timestamp": {
                     "order": ("desc" if newest else "asc")
                 }
+            },
+            {
+                "log_id": {
+                    "order": ("desc" if newest else "asc")
+                }
             }
         ],
         "size": (limit or 50)
     }
+    # Continue after the last event of the previous page.
+    if after:
+        query["search_after"] = after
     # Match action.
     if action:
         query["query"]["bool"]["filter"]["bool"]["must"].append(
@@ -226,7 +368,9 @@ def get_events(auth_context, owner_id='', user_id='', event_type='', action='',
     # Query Elasticsearch.
     result = es().search(index=index, doc_type=event_type, body=query)
 
-    for hit in result['hits']['hits']:
+    events = []
+    hits = result['hits']['hits']
+    for hit in hits:
         event = hit['_source']
         if not event.get('action'):
             log.error('Skipped event %s, missing action', event['log_id'])
@@ -239,14 +383,146 @@ def get_events(auth_context, owner_id='', user_id='', event_type='', action='',
         else:
             for key, value in extra.iteritems():
                 event[key] = value
-        yield event
+        events.append(event)
+
+    if len(hits) < query["size"]:
+        return events, None
+    return events, hits[-1]['sort']
+
+
+def export_events(auth_context, after=None, **kwargs):
+    """Yield all logged events matching the given arguments.
+
+    Events are fetched from Elasticsearch page by page, by `search_events`,
+    so that only `config.EVENTS_EXPORT_PAGE_SIZE` of them are held in memory
+    at a time, however many of them there are.
+
+    """
+    kwargs['limit'] = config.EVENTS_EXPORT_PAGE_SIZE
+    while True:
+        events, after = search_events(auth_context, after=after, **kwargs)
+        for event in events:
+            yield event
+        if after is None:
+            break
+
+
+_STORY_QUERY_POOL = None
+
+
+def _story_query_pool():
+    global _STORY_QUERY_POOL
+    if _STORY_QUERY_POOL is None:
+        _STORY_QUERY_POOL = ThreadPool(config.STORY_QUERY_THREADS)
+    return _STORY_QUERY_POOL
 
 
 def get_stories(story_type='', owner_id='', user_id='', sort_order=-1, limit=0,
-                error=None, range=None, pending=None, expand=False,
+                error=None, range=None, pending=None, expand=False, after='',
                 tornado_callback=None, tornado_async=False, **kwargs):
     """Fetch stories.
 
+    Query the stored stories based on the provided arguments. By default, the
+    logs of the stories are returned in a compact format. If `expand=True`,
+    the logs are returned in full.
+
+    Stories are sorted by their `started_at` timestamp, in the given
+    `sort_order`, and may be paginated by passing the `story_id` of the last
+    story of the previous page as `after`. A `range` on `@timestamp`, given
+    in milliseconds, is applied to the time each story was last updated.
+
+    Stories are stored as their events are written. Use `search_stories` to
+    aggregate them out of the logs in Elasticsearch instead.
+
+    If `tornado_callback` is provided, it is invoked with the stories and the
+    `pending` argument. If `tornado_async` is also True, stories are queried
+    in a thread of a pool of `config.STORY_QUERY_THREADS`, so as not to block
+    the IOLoop, and the callback is run on the IOLoop afterwards.
+
+    """
+    if tornado_async and tornado_callback is not None:
+        import tornado.ioloop
+        ioloop = tornado.ioloop.IOLoop.current()
+
+        def query():
+            try:
+                stories = get_stories(
+                    story_type=story_type, owner_id=owner_id,
+                    user_id=user_id, sort_order=sort_order, limit=limit,
+                    error=error, range=range, pending=pending, expand=expand,
+                    after=after, **kwargs
+                )
+            except Exception as exc:
+                log.error("Error fetching stories: %r", exc)
+                stories = []
+            ioloop.add_callback(tornado_callback, stories, pending)
+
+        _story_query_pool().apply_async(query)
+        return
+
+    if story_type:
+        assert story_type in TYPES
+        kwargs['type'] = story_type
+    if owner_id:
+        kwargs['owner_id'] = owner_id
+    if user_id:
+        kwargs['user_id'] = user_id
+
+    stories = Story.objects()
+    for key, value in kwargs.iteritems():
+        if value in (None, ''):
+            log.debug('Got key "%s" with empty value', key)
+            continue
+        if key not in Story._fields:
+            raise BadRequestError('Cannot filter stories by %s' % key)
+        stories = stories(**{key: value})
+
+    # Filter pending and failed stories.
+    if pending:
+        stories = stories(finished_at=0)
+    elif pending is False:
+        stories = stories(finished_at__gt=0)
+    if error:
+        stories = stories(error__nin=[False, None])
+    elif error is False:
+        stories = stories(error__in=[False, None])
+
+    # Specify the time range of the stories.
+    for op, value in (range or {}).get('@timestamp', {}).iteritems():
+        if op in ('gt', 'gte', 'lt', 'lte') and \
+                isinstance(value, (int, long, float)):
+            stories = stories(**{'updated_at__%s' % op: value / 1000.0})
+
+    # Start after the last story of the previous page.
+    op = 'lt' if sort_order == -1 else 'gt'
+    if after:
+        last = Story.objects(story_id=after)
+        if owner_id:
+            last = last(owner_id=owner_id)
+        last = last.only('started_at').first()
+        if last is None:
+            raise NotFoundError('Story %s' % after)
+        stories = stories(
+            me.Q(**{'started_at__%s' % op: last.started_at}) |
+            me.Q(started_at=last.started_at, **{'story_id__%s' % op: after})
+        )
+
+    order = '-' if sort_order == -1 else '+'
+    stories = stories.order_by(order + 'started_at', order + 'story_id')
+    if limit:
+        stories = stories.limit(limit)
+    stories = [story.as_dict(expand=expand) for story in stories]
+
+    if tornado_callback is not None:
+        return tornado_callback(stories, pending)
+    return stories
+
+
+def search_stories(story_type='', owner_id='', user_id='', sort_order=-1,
+                   limit=0, error=None, range=None, pending=None, expand=False,
+                   tornado_callback=None, tornado_async=False, **kwargs):
+    """Aggregate stories out of the logs stored in Elasticsearch.
+
     Query Elasticsearch for story documents based on the provided arguments.
     By default, the stories are not fully expanded, but rather returned in a
     simple, compact format. On the other hand, if `expand=True`, the stories'
@@ -501,12 +777,18 @@ def process_filters(query, filters, close=None, error=None):
             )
 
 
-def associate_stories(event):
-    """Associate potential stories to the event provided."""
+def associate_stories(event, extra=None):
+    """Associate potential stories to the event provided.
+
+    The event's `extra` is parsed, unless already provided.
+
+    """
     story_id = event['story_id']
     story_type = event['type'] if event['type'] != 'request' else 'job'
     try:
-        job = json.loads(event['extra']).pop('job', None)
+        if extra is None:
+            extra = json.loads(event['extra'])
+        job = extra.get('job')
     except Exception as exc:
         job = None
         log.warn('Failed to extract job param from extra: %s', exc)
@@ -525,6 +807,109 @@ def associate_stories(event):
 
     # Append metadata to the event's `stories`.
     event['stories'].append((action, story_type, story_id))
+    update_open_incidents(event)
+
+
+def update_open_incidents(event):
+    """Register or unregister the incidents opened or closed by the event"""
+    for action, story_type, story_id in event.get('stories', []):
+        if story_type != 'incident':
+            continue
+        try:
+            if action == 'opens':
+                OpenIncident.objects(incident_id=story_id).update_one(
+                    set__owner_id=event['owner_id'],
+                    set__rule_id=event.get('rule_id'),
+                    set__cloud_id=event.get('cloud_id'),
+                    set__machine_id=event.get('machine_id'),
+                    set__started_at=event['time'],
+                    upsert=True
+                )
+            elif action == 'closes':
+                OpenIncident.objects(incident_id=story_id).delete()
+        except Exception as exc:
+            log.error('Failed to update open incident %s from event %s: %r',
+                      story_id, event['log_id'], exc)
+
+
+def _story_log(event, parse=True):
+    """Return the event as a log of a story, with its extra parsed"""
+    story_log = dict((key, value) for key, value in event.iteritems()
+                     if key not in ('_id', '_traceback', '_exc'))
+    if parse and 'extra' in story_log:
+        try:
+            extra = json.loads(story_log.pop('extra'))
+        except Exception as exc:
+            log.error('Error parsing log %s: %s', event['log_id'], exc)
+        else:
+            for key, value in extra.iteritems():
+                if key not in ('_traceback', '_exc'):
+                    story_log[key] = value
+    return story_log
+
+
+def _story_updates(event, parse=True):
+    """Return the updates to the stories the event belongs to"""
+    updates = []
+    story_log = _story_log(event, parse=parse)
+    for action, story_type, story_id in event.get('stories', []):
+        on_insert = {'type': story_type, 'error': event['error']}
+        for key in FIELDS:
+            if event.get(key) is not None:
+                on_insert[key] = event[key]
+        update = {
+            '$setOnInsert': on_insert,
+            '$min': {'started_at': event['time']},
+            '$max': {'updated_at': event['time']},
+            '$push': {
+                'logs': {
+                    '$each': [story_log],
+                    '$sort': {'time': 1},
+                    '$slice': config.STORY_MAX_LOGS,
+                }
+            },
+        }
+        if action == 'closes':
+            update['$max']['finished_at'] = event['time']
+        else:
+            on_insert['finished_at'] = 0
+        updates.append(UpdateOne({'_id': story_id}, update, upsert=True))
+        # Keep the first error of stories that already exist.
+        if event['error']:
+            updates.append(UpdateOne({'_id': story_id, 'error': False},
+                                     {'$set': {'error': event['error']}}))
+    return updates
+
+
+def update_stories(events):
+    """Apply a list of events to the stored stories they belong to, in order
+
+    If the updates of an event fail, they are retried once with the event's
+    `extra` left unparsed, since its keys may not be valid in MongoDB,
+    followed by the updates of the rest of the events.
+
+    """
+    updates, owners = [], []
+    for index, event in enumerate(events):
+        for update in _story_updates(event):
+            updates.append(update)
+            owners.append(index)
+    if not updates:
+        return
+
+    coll = Story._get_collection()
+    try:
+        coll.bulk_write(updates, ordered=True)
+    except BulkWriteError as exc:
+        error = exc.details['writeErrors'][0]
+        failed = error['index']
+        event = events[owners[failed]]
+        first = owners.index(owners[failed])
+        log.warning('Failed to update stories of event %s, will retry with '
+                    'its extra unparsed: %s', event['log_id'], error['errmsg'])
+        retries = _story_updates(event, parse=False)[failed - first:]
+        retries += updates[first + owners.count(owners[failed]):]
+        coll.bulk_write(retries, ordered=True)
 
 
 def close_open_incidents(event):
@@ -532,38 +917,81 @@ def close_open_incidents(event):
     if 'stories' not in event:
         event['stories'] = []
 
-    kwargs = {
-        'story_type': 'incident',
-        'owner_id': event['owner_id'],
-        'pending': True,
-    }
+    kwargs = {'owner_id': event['owner_id']}
     for key in ('rule_id', 'cloud_id', 'machine_id'):
         if key in event:
             kwargs[key] = event[key]
 
-    incidents = get_stories(**kwargs)
-    for inc in incidents:
-        event['stories'].append(('closes', 'incident', inc['story_id']))
+    incidents = OpenIncident.objects(**kwargs).only('incident_id')
+    incidents = [incident.incident_id for incident in incidents]
+    for incident_id in incidents:
+        event['stories'].append(('closes', 'incident', incident_id))
 
     log.warn('%s incident(s) closed by %s', len(incidents), event['log_id'])
 
 
+def rebuild_open_incidents(owner_id=''):
+    """Register the pending incidents found in Elasticsearch
+
+    The registry of open incidents is maintained as events are logged. This
+    is meant to be run once, in order to register any incidents opened
+    before that, by `bin/rebuild-stories`.
+
+    """
+    incidents = search_stories(story_type='incident', owner_id=owner_id,
+                               pending=True)
+    for incident in incidents:
+        OpenIncident.objects(incident_id=incident['story_id']).update_one(
+            set__owner_id=incident['owner_id'],
+            set__rule_id=incident.get('rule_id'),
+            set__cloud_id=incident.get('cloud_id'),
+            set__machine_id=incident.get('machine_id'),
+            set__started_at=incident['started_at'],
+            upsert=True
+        )
+    log.warn('Registered %d open incident(s)', len(incidents))
+    return len(incidents)
+
+
+def rebuild_stories(owner_id=''):
+    """Store the stories found in Elasticsearch
+
+    Stories are stored as their events are written. This is meant to be run
+    once, in order to store any stories logged before that, by
+    `bin/rebuild-stories`.
+
+    """
+    stories = search_stories(owner_id=owner_id, expand=True)
+    for story in stories:
+        if not story['type']:
+            continue
+        logs = sorted(story['logs'], key=lambda log: log['time'])
+        fields = dict((key, story[key]) for key in FIELDS if key in story)
+        Story(story_id=story['story_id'], type=story['type'],
+              started_at=story['started_at'], updated_at=logs[-1]['time'],
+              finished_at=story['finished_at'], error=story['error'],
+              logs=logs[:config.STORY_MAX_LOGS], **fields).save()
+    log.warn('Stored %d stories', len(stories))
+    return len(stories)
+
+
 def get_story(owner_id, story_id, story_type=None, expand=True):
     """Fetch a single story given its story_id."""
-    story = get_stories(owner_id=owner_id, story_id=story_id,
-                        story_type=story_type, expand=expand)
-    if not story:
+    story = Story.objects(owner_id=owner_id, story_id=story_id)
+    if story_type:
+        story = story(type=story_type)
+    story = story.first()
+    if story is None:
         msg = 'Story %s' % story_id
         if story_type:
             msg += ' [%s]' % story_type
         raise NotFoundError(msg)
-    if len(story) > 1:
-        log.error('Found multiple stories with story_id %s', story_id)
-    return story[0]
+    return story.as_dict(expand=expand)
 
 
 def delete_story(owner_id, story_id):
     """Delete a story."""
+    Story.objects(owner_id=owner_id, story_id=story_id).delete()
     index = 'app-logs-*'
     query = {
         'query': {
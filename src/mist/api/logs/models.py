@@ -0,0 +1,136 @@
+"""Log related models."""
+import mongoengine as me
+
+from mist.api.logs.constants import FIELDS, COMPACT_LOG_FIELDS
+
+
+class OpenIncident(me.Document):
+    """An incident that has been opened, but not closed yet
+
+    Open incidents are registered and unregistered as logged events open and
+    close them, so that the incidents to be closed by an event can be found
+    with an indexed query, instead of an Elasticsearch aggregation.
+
+    """
+    incident_id = me.StringField(primary_key=True)
+    owner_id = me.StringField(required=True)
+    rule_id = me.StringField()
+    cloud_id = me.StringField()
+    machine_id = me.StringField()
+    started_at = me.FloatField()
+
+    meta = {
+        'collection': 'open_incidents',
+        'indexes': [
+            {
+                'fields': ['owner_id', 'rule_id'],
+                'sparse': False,
+                'unique': False,
+                'cls': False,
+            },
+            {
+                'fields': ['owner_id', 'cloud_id', 'machine_id'],
+                'sparse': False,
+                'unique': False,
+                'cls': False,
+            },
+        ],
+    }
+
+    def __str__(self):
+        return 'OpenIncident %s of %s' % (self.incident_id, self.owner_id)
+
+
+class Story(me.Document):
+    """A story, materialized from the events that make it up
+
+    Stories are updated as their events are written, so that they may be
+    listed and fetched with indexed queries, instead of Elasticsearch
+    aggregations. Only the first `config.STORY_MAX_LOGS` events of a story
+    are kept in its `logs`, sorted by time.
+
+    A story is pending until an event closes it, which sets `finished_at`.
+    The first error reported by any of its events is kept in `error`.
+
+    """
+    story_id = me.StringField(primary_key=True)
+    type = me.StringField(required=True)
+    owner_id = me.StringField()
+    started_at = me.FloatField()
+    updated_at = me.FloatField()
+    finished_at = me.FloatField(default=0)
+    error = me.DynamicField(default=False)
+    logs = me.ListField(me.DictField())
+
+    user_id = me.StringField()
+    cloud_id = me.StringField()
+    machine_id = me.StringField()
+    script_id = me.StringField()
+    rule_id = me.StringField()
+    stack_id = me.StringField()
+    template_id = me.StringField()
+    job_id = me.StringField()
+    shell_id = me.StringField()
+    session_id = me.StringField()
+    incident_id = me.StringField()
+
+    meta = {
+        'collection': 'stories',
+        'indexes': [
+            {
+                'fields': ['owner_id', 'type', 'finished_at', '-started_at'],
+                'sparse': False,
+                'unique': False,
+                'cls': False,
+            },
+            {
+                'fields': ['owner_id', 'type', '-started_at'],
+                'sparse': False,
+                'unique': False,
+                'cls': False,
+            },
+            {
+                # stories of all owners updated recently, see sock.py
+                'fields': ['type', 'finished_at', '-updated_at'],
+                'sparse': False,
+                'unique': False,
+                'cls': False,
+            },
+            {
+                'fields': ['owner_id', 'script_id'],
+                'sparse': False,
+                'unique': False,
+                'cls': False,
+            },
+        ],
+    }
+
+    def as_dict(self, expand=True):
+        """Return the story in the format of `process_stories`
+
+        Unless expanded, only the fields needed to describe each log in the
+        story are returned, except for incidents.
+
+        """
+        story = {
+            'story_id': self.story_id,
+            'type': self.type,
+            'error': self.error or False,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at or 0,
+        }
+        for key in FIELDS:
+            if self[key] is not None:
+                story[key] = self[key]
+        if expand or self.type == 'incident':
+            story['logs'] = self.logs
+        else:
+            story['logs'] = [
+                dict((key, log[key]) for key in COMPACT_LOG_FIELDS
+                     if key in log) for log in self.logs
+            ]
+        return story
+
+    def __str__(self):
+        return 'Story %s [%s] of %s' % (self.story_id, self.type,
+                                        self.owner_id)
@@ -1,7 +1,10 @@
+import json
+
 from pyramid.response import Response
 
 from mist.api.helpers import view_config
 from mist.api.helpers import params_from_request
+from mist.api.helpers import encode_cursor, decode_cursor
 
 from mist.api.exceptions import NotFoundError
 from mist.api.exceptions import BadRequestError
@@ -9,7 +12,8 @@ from mist.api.exceptions import PolicyUnauthorizedError
 
 from mist.api.logs.constants import FIELDS as _FIELDS
 from mist.api.logs.methods import get_story
-from mist.api.logs.methods import get_events
+from mist.api.logs.methods import search_events
+from mist.api.logs.methods import export_events
 from mist.api.auth.methods import auth_context_from_request
 
 
@@ -19,10 +23,63 @@ FIELDS.remove('owner_id')  # SEC
 LOG_TYPES = ('ui', 'job', 'shell', 'session', 'incident', 'request', )
 
 
+def _events_kwargs_from_request(request, auth_context):
+    """Get the arguments of `search_events` from the request's parameters."""
+    params = params_from_request(request)
+
+    kwargs = {}
+    # Get the type of the events to fetch.
+    event_type = params.get('type', params.get('event_type'))
+    if event_type:
+        if event_type not in LOG_TYPES:
+            raise BadRequestError('Invalid event type: %s' % event_type)
+        kwargs['event_type'] = event_type
+
+    # Specify ordering and whether to fetch stories that ended with an error.
+    for key in ('error', 'newest', ):
+        value = params.get(key)
+        if value is None:
+            continue
+        if value is False or value in ('false', 'False', '0', ):
+            kwargs[key] = False
+        else:
+            kwargs[key] = True
+
+    # Specify start/stop timestamps and limit the number of returned results.
+    for key in ('start', 'stop', 'limit', ):
+        if key in params:
+            try:
+                kwargs[key] = int(params[key])
+            except ValueError:
+                raise BadRequestError('Invalid value: %s=%s' % (key,
+                                                                params[key]))
+
+    # Continue after the previous page.
+    if params.get('cursor'):
+        kwargs['after'] = decode_cursor(params['cursor'])
+
+    # Provide additional key-value pairs.
+    for key in FIELDS:
+        if key in params:
+            kwargs[key] = params[key]
+
+    # Enforce owner_id, if necessary.
+    if auth_context.user.role == 'Admin':
+        if 'owner_id' in params:
+            kwargs['owner_id'] = params['owner_id']
+    else:
+        kwargs['owner_id'] = auth_context.owner.id
+
+    return kwargs
+
+
 @view_config(route_name='api_v1_logs', request_method='GET', renderer='json')
 def get_logs(request):
     """Get the latest logs.
 
+    If there are more logs, the cursor of the next page is returned in the
+    X-Next-Cursor header.
+
     ---
 
     event_type:
@@ -53,53 +110,70 @@ def get_logs(request):
       type: integer
       required: false
       description: the timestamp of the last log in the sequence
+    cursor:
+      type: string
+      required: false
+      description: the X-Next-Cursor header of the previous page
 
     """
     auth_context = auth_context_from_request(request)
-    params = params_from_request(request)
+    kwargs = _events_kwargs_from_request(request, auth_context)
+    if not 0 < kwargs.get('limit', 0) <= 100:
+        kwargs['limit'] = 100
 
-    kwargs = {}
-    # Get the type of the events to fetch.
-    event_type = params.get('type', params.get('event_type'))
-    if event_type:
-        if event_type not in LOG_TYPES:
-            raise BadRequestError('Invalid event type: %s' % event_type)
-        kwargs['event_type'] = event_type
+    events, after = search_events(auth_context, **kwargs)
+    if after is not None:
+        request.response.headers['X-Next-Cursor'] = encode_cursor(after)
+    return events
 
-    # Specify ordering and whether to fetch stories that ended with an error.
-    for key in ('error', 'newest', ):
-        value = params.get(key)
-        if value is None:
-            continue
-        if value is False or value in ('false', 'False', '0', ):
-            kwargs[key] = False
-        else:
-            kwargs[key] = True
 
-    # Specify start/stop timestamps and limit the number of returned results.
-    for key in ('start', 'stop', 'limit', ):
-        if key in params:
-            try:
-                kwargs[key] = int(params[key])
-            except ValueError:
-                raise BadRequestError('Invalid value: %s=%s' % (key,
-                                                                params[key]))
-    if not 0 < kwargs.get('limit', 0) <= 100:
-        kwargs['limit'] = 100
+@view_config(route_name='api_v1_logs_export', request_method='GET')
+def export_logs(request):
+    """Export logs.
 
-    # Provide additional key-value pairs.
-    for key in FIELDS:
-        if key in params:
-            kwargs[key] = params[key]
+    Stream all logs matching the given parameters as newline-delimited JSON.
 
-    # Enforce owner_id, if necessary.
-    if auth_context.user.role == 'Admin':
-        if 'owner_id' in params:
-            kwargs['owner_id'] = params['owner_id']
-    else:
-        kwargs['owner_id'] = auth_context.owner.id
+    ---
+
+    event_type:
+      type: string
+      required: false
+      description: the type of the events to fetch - one of LOG_TYPES or None
+    action:
+      type: string
+      required: false
+      description: the action described by the log
+    newest:
+      type: boolean
+      required: false
+      description: the sorting order
+    error:
+      type: boolean
+      required: false
+      description: specify whether to fetch logs that contain an error message
+    start:
+      type: integer
+      required: false
+      description: the timestamp of the first log
+    stop:
+      type: integer
+      required: false
+      description: the timestamp of the last log in the sequence
+    cursor:
+      type: string
+      required: false
+      description: the X-Next-Cursor header of a page of logs to start after
+
+    """
+    auth_context = auth_context_from_request(request)
+    kwargs = _events_kwargs_from_request(request, auth_context)
+    kwargs.pop('limit', None)
+
+    def app_iter():
+        for event in export_events(auth_context, **kwargs):
+            yield json.dumps(event) + '\n'
 
-    return list(get_events(auth_context, **kwargs))
+    return Response(app_iter=app_iter(), content_type='application/x-ndjson')
 
 
 # TODO: Do not use only for incidents.
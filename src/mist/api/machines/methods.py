@@ -1,8 +1,14 @@
 import re
+import time
 import random
 import base64
 import mongoengine as me
 
+from multiprocessing.pool import ThreadPool
+
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
 from libcloud.compute.base import NodeSize, NodeImage, NodeLocation
 from libcloud.compute.types import Provider
 from libcloud.compute.base import NodeAuthSSHKey
@@ -11,7 +17,7 @@ from tempfile import NamedTemporaryFile
 import mist.api.tasks
 
 from mist.api.clouds.models import Cloud
-from mist.api.machines.models import Machine
+from mist.api.machines.models import Machine, PingProbe, SSHProbe
 from mist.api.keys.models import Key
 
 from mist.api.exceptions import PolicyUnauthorizedError
@@ -20,16 +26,28 @@ from mist.api.exceptions import BadRequestError, MachineCreationError
 from mist.api.exceptions import CloudUnavailableError, InternalServerError
 
 from mist.api.helpers import get_temp_file
+from mist.api.helpers import ping_hosts
+from mist.api.helpers import amqp_publish_user
+from mist.api.helpers import bump_list_versions
+from mist.api.helpers import paginate_query
+from mist.api.helpers import amqp_owner_listening
 
 from mist.api.methods import connect_provider
+from mist.api.methods import probe_ssh_only
 from mist.api.networks.methods import list_networks
 from mist.api.tag.methods import resolve_id_and_set_tags
+from mist.api.tag.methods import get_tags_for_resources
 
 try:
     from mist.core.methods import disable_monitoring
 except ImportError:
     from mist.api.dummy.methods import disable_monitoring
 
+try:
+    from mist.core.vpn.methods import super_ping
+except ImportError:
+    from mist.api.dummy.methods import super_ping
+
 from mist.api import config
 
 import logging
@@ -110,6 +128,164 @@ def list_machines(owner, cloud_id):
     return [machine.as_dict() for machine in machines]
 
 
+def _host_from_ips(public_ips, private_ips):
+    """Return the first IPv4 address, preferring public ones"""
+    for ips in (public_ips, private_ips):
+        ips = [ip for ip in ips or [] if ':' not in ip]
+        if ips:
+            return ips[0]
+    return ''
+
+
+def find_machine_hosts(owner, machines):
+    """Find an address to connect to for each of the given machines
+
+    The addresses stored in the Machine documents are used when available.
+    The providers are only queried for the remaining machines, with one
+    listing per cloud. Returns a dict mapping machine uuids to hosts, with
+    an empty host for machines no address could be found for.
+
+    """
+    hosts = {}
+    missing = {}
+    for machine in machines:
+        hosts[machine.id] = _host_from_ips(machine.public_ips,
+                                           machine.private_ips)
+        if not hosts[machine.id]:
+            cloud_machines = missing.setdefault(machine.cloud.id, {})
+            cloud_machines[machine.machine_id] = machine.id
+    for cloud_id, cloud_machines in missing.iteritems():
+        try:
+            listed = list_machines(owner, cloud_id)
+        except Exception as exc:
+            log.error("Error listing machines of cloud %s: %r", cloud_id, exc)
+            continue
+        for machine in listed:
+            if machine['machine_id'] in cloud_machines:
+                hosts[cloud_machines[machine['machine_id']]] = \
+                    _host_from_ips(machine['public_ips'],
+                                   machine['private_ips'])
+    return hosts
+
+
+def probe_machines(cloud):
+    """Ping and probe over SSH all running machines of a cloud
+
+    Machines are pinged on their public IPv4 address, all of them at once.
+    Machines with only private addresses are pinged through `super_ping`,
+    since it may have to go through the owner's VPN tunnels. Machines with
+    associated keys are also probed over SSH. Each machine is handled by one
+    of `config.PROBE_SWEEP_SSH_CONCURRENCY` threads.
+
+    The results are stored in the Machine documents with a single bulk write
+    and, if the owner is listening, published in the same format as those of
+    the `Ping` and `ProbeSSH` tasks. Returns the number of updated machines.
+
+    """
+    owner = cloud.owner
+    hosts = {}
+    machines = []
+    for machine in Machine.objects(cloud=cloud, state='running',
+                                   missing_since=None):
+        host = _host_from_ips(machine.public_ips, machine.private_ips)
+        if host:
+            hosts[machine.id] = host
+            machines.append(machine)
+    if not machines:
+        return 0
+
+    pings = ping_hosts([hosts[machine.id] for machine in machines
+                        if hosts[machine.id] in machine.public_ips],
+                       pkts=config.PROBE_SWEEP_PING_PACKETS,
+                       timeout=config.PROBE_SWEEP_PING_TIMEOUT)
+
+    def probe_machine(machine):
+        host = hosts[machine.id]
+        ping = pings.get(host)
+        if ping is None:
+            try:
+                ping = super_ping(owner=owner, host=host,
+                                  pkts=config.PROBE_SWEEP_PING_PACKETS)
+            except Exception as exc:
+                log.info("Failed to ping %s: %r", host, exc)
+            ping = ping or {}
+        ssh = None
+        if machine.key_associations:
+            try:
+                ssh = probe_ssh_only(owner, cloud.id, machine.machine_id, host)
+            except Exception as exc:
+                log.info("Failed to probe %s over SSH: %r", host, exc)
+                ssh = {}
+        return machine, ping, ssh
+
+    pool = ThreadPool(min(config.PROBE_SWEEP_SSH_CONCURRENCY, len(machines)))
+    try:
+        results = pool.map(probe_machine, machines)
+    finally:
+        pool.close()
+        pool.join()
+
+    now = int(time.time())
+    updates = []
+    updated_ids = []
+    listening = amqp_owner_listening(owner.id)
+    for machine, ping, ssh in results:
+        fields = {}
+        host = hosts[machine.id]
+        if ping:
+            ping_probe = PingProbe(updated_at=now, **dict(
+                (key, value) for key, value in ping.iteritems()
+                if key in PingProbe._fields
+            ))
+            if not ping.get('packets_rx'):
+                previous = machine.ping_probe
+                ping_probe.unreachable_since = (
+                    previous and previous.unreachable_since or now
+                )
+            fields['ping_probe'] = ping_probe.to_mongo()
+            if listening:
+                amqp_publish_user(owner.id, routing_key='ping',
+                                  data={'cloud_id': cloud.id,
+                                        'machine_id': machine.machine_id,
+                                        'host': host,
+                                        'result': ping})
+        if ssh:
+            ssh_probe = SSHProbe(updated_at=now, **dict(
+                (key, value) for key, value in ssh.iteritems()
+                if key in SSHProbe._fields and key != 'macs'
+            ))
+            ssh_probe.macs = [{'ip': ip, 'mac': mac}
+                              for ip, mac in (ssh.get('macs') or {}).items()]
+            fields['ssh_probe'] = ssh_probe.to_mongo()
+            if listening:
+                amqp_publish_user(owner.id, routing_key='probe',
+                                  data={'cloud_id': cloud.id,
+                                        'machine_id': machine.machine_id,
+                                        'machine_uuid': machine.id,
+                                        'host': host,
+                                        'result': ssh})
+        elif ssh is not None:
+            # Keep the last results around, marking when probing started
+            # failing.
+            ssh_probe = machine.ssh_probe or SSHProbe()
+            ssh_probe.updated_at = now
+            ssh_probe.unreachable_since = ssh_probe.unreachable_since or now
+            fields['ssh_probe'] = ssh_probe.to_mongo()
+        if fields:
+            updates.append(UpdateOne({'_id': machine.id}, {'$set': fields}))
+            updated_ids.append(machine.id)
+    if updates:
+        try:
+            Machine._get_collection().bulk_write(updates, ordered=False)
+        except BulkWriteError as exc:
+            # Unordered, so all other updates have still been applied.
+            for error in exc.details['writeErrors']:
+                log.error("Failed to store probe results of machine %s: %s",
+                          updated_ids[error['index']], error['errmsg'])
+        bump_list_versions(owner, ['machines'])
+    return len(updates)
+
+
 def create_machine(owner, cloud_id, key_id, machine_name, location_id,
                    image_id, size_id, image_extra, disk, image_name,
                    size_name, location_name, ips, monitoring, networks=[],
@@ -1154,14 +1330,24 @@ def destroy_machine(user, cloud_id, machine_id):
 
 
 # SEC
-def filter_list_machines(auth_context, cloud_id, machines=None, perm='read'):
+def filter_list_machines(auth_context, cloud_id, machines=None, perm='read',
+                         limit=0, after=None, fields=None):
     """Returns a list of machines.
 
     In case of non-Owners, the QuerySet only includes machines found in the
     RBAC Mappings of the Teams the current user is a member of.
+
+    If `limit` is set, at most that many machines are returned, sorted by id,
+    after the machine with id `after[0]`. Unless `fields` is None, only those
+    fields of each machine are returned. Such pages are queried from the
+    database, after listing the cloud's machines, unless continuing after a
+    previous page.
     """
     assert cloud_id
 
+    if machines is None and (limit or after or fields is not None):
+        return _filter_list_machines_page(auth_context, cloud_id, limit,
+                                          after, fields)
     if machines is None:
         machines = list_machines(auth_context.owner, cloud_id)
     if not machines:  # Exit early in case the cloud provider returned 0 nodes.
@@ -1181,3 +1367,31 @@ def filter_list_machines(auth_context, cloud_id, machines=None, perm='read'):
                     if machine['id'] in allowed_ids]
 
     return machines
+
+
+def _filter_list_machines_page(auth_context, cloud_id, limit=0, after=None,
+                               fields=None):
+    """Returns a page of machines, see `filter_list_machines`"""
+    if not auth_context.is_owner():
+        try:
+            auth_context.check_perm('cloud', 'read', cloud_id)
+        except PolicyUnauthorizedError:
+            return []
+    cloud = Cloud.objects.get(owner=auth_context.owner, id=cloud_id,
+                              deleted=None)
+    if not after:
+        cloud.ctl.compute.list_machines()
+
+    machines = Machine.objects(cloud=cloud, missing_since=None)
+    if not auth_context.is_owner():
+        machines = machines.filter(id__in=list(
+            auth_context.get_allowed_resources(rtype='machines')
+        ))
+    machines = paginate_query(machines, limit, after, fields,
+                              aliases={'parent_id': 'parent'})
+    if fields is None or 'tags' in fields:
+        tags = get_tags_for_resources(auth_context.owner, machines)
+    else:
+        tags = {}
+    return [machine.as_dict(fields=fields, tags=tags.get(machine.id))
+            for machine in machines]
@@ -109,6 +109,49 @@ class Cost(me.EmbeddedDocument):
         return json.loads(self.to_json())
 
 
+class PingProbe(me.EmbeddedDocument):
+    """Latest results of pinging a machine, as returned by `parse_ping`"""
+    packets_tx = me.IntField()
+    packets_rx = me.IntField()
+    packets_loss = me.FloatField()
+    rtt_min = me.FloatField()
+    rtt_avg = me.FloatField()
+    rtt_max = me.FloatField()
+
+    updated_at = me.IntField()  # timestamp: Last time it was pinged
+    unreachable_since = me.IntField()  # timestamp: First reply-less ping
+
+    def as_dict(self):
+        return json.loads(self.to_json())
+
+
+class SSHProbe(me.EmbeddedDocument):
+    """Latest results of probing a machine, as returned by `probe_ssh_only`"""
+    uptime = me.StringField()
+    loadavg = me.ListField()
+    cores = me.StringField()
+    users = me.StringField()
+    pub_ips = me.ListField()
+    priv_ips = me.ListField()
+    macs = me.ListField(me.DictField())  # [{'ip': ip, 'mac': mac}], since
+                                         # IPs can't be used as Mongo keys
+    df = me.StringField()
+    timestamp = me.FloatField()
+    kernel = me.StringField()
+    os = me.StringField()
+    os_version = me.StringField()
+    dirty_cow = me.BooleanField()
+
+    updated_at = me.IntField()  # timestamp: Last time it was probed
+    unreachable_since = me.IntField()  # timestamp: First failed probe
+
+    def as_dict(self):
+        probe = json.loads(self.to_json())
+        probe['macs'] = dict((mac['ip'], mac['mac'])
+                             for mac in probe.get('macs', []))
+        return probe
+
+
 class Machine(me.Document):
     """The basic machine model"""
 
@@ -154,6 +197,10 @@ class Machine(me.Document):
     monitoring = me.EmbeddedDocumentField(Monitoring,
                                           default=lambda: Monitoring())
 
+    # Updated by the periodic probe sweep of the machine's cloud.
+    ping_probe = me.EmbeddedDocumentField(PingProbe)
+    ssh_probe = me.EmbeddedDocumentField(SSHProbe)
+
     meta = {
         'collection': 'machines',
         'indexes': [
@@ -185,18 +232,24 @@ class Machine(me.Document):
         mist.api.tag.models.Tag.objects(resource=self).delete()
         self.owner.mapper.remove(self)
 
-    def as_dict(self):
-        # Return a dict as it will be returned to the API
+    def as_dict(self, fields=None, tags=None):
+        # Return a dict as it will be returned to the API. Unless `fields` is
+        # None, only those fields are returned, skipping any work needed for
+        # the rest. Tags are looked up, unless given.
+        def wanted(field):
+            return fields is None or field in fields
 
         # tags as a list return for the ui
-        tags = {tag.key: tag.value for tag in mist.api.tag.models.Tag.objects(
-            owner=self.cloud.owner, resource=self
-        ).only('key', 'value')}
-        # Optimize tags data structure for js...
-        if isinstance(tags, dict):
-            tags = [{'key': key, 'value': value}
-                    for key, value in tags.iteritems()]
-        return {
+        if tags is None and wanted('tags'):
+            tags = {tag.key: tag.value
+                    for tag in mist.api.tag.models.Tag.objects(
+                        owner=self.cloud.owner, resource=self
+                    ).only('key', 'value')}
+            # Optimize tags data structure for js...
+            if isinstance(tags, dict):
+                tags = [{'key': key, 'value': value}
+                        for key, value in tags.iteritems()]
+        machine = {
             'id': self.id,
             'hostname': self.hostname,
             'public_ips': self.public_ips,
@@ -206,23 +259,42 @@ class Machine(me.Document):
             'os_type': self.os_type,
             'rdp_port': self.rdp_port,
             'machine_id': self.machine_id,
-            'actions': {action: self.actions[action]
-                        for action in self.actions},
             'extra': self.extra,
-            'cost': self.cost.as_dict(),
             'image_id': self.image_id,
             'size': self.size,
             'state': self.state,
             'tags': tags,
-            'monitoring': self.monitoring.as_dict() if self.monitoring else '',
-            'key_associations': [ka.as_dict() for ka in self.key_associations],
-            'cloud': self.cloud.id,
             'last_seen': str(self.last_seen or ''),
             'missing_since': str(self.missing_since or ''),
             'created': str(self.created or ''),
             'machine_type': self.machine_type,
-            'parent_id': self.parent.id if self.parent is not None else '',
         }
+        if wanted('actions'):
+            machine['actions'] = {action: self.actions[action]
+                                  for action in self.actions}
+        if wanted('cost'):
+            machine['cost'] = self.cost.as_dict()
+        if wanted('monitoring'):
+            machine['monitoring'] = (self.monitoring.as_dict()
+                                     if self.monitoring else '')
+        if wanted('key_associations'):
+            machine['key_associations'] = [ka.as_dict()
+                                           for ka in self.key_associations]
+        if wanted('cloud'):
+            machine['cloud'] = self.cloud.id
+        if wanted('parent_id'):
+            machine['parent_id'] = (self.parent.id
+                                    if self.parent is not None else '')
+        if wanted('ping_probe'):
+            machine['ping_probe'] = (self.ping_probe.as_dict()
+                                     if self.ping_probe else {})
+        if wanted('ssh_probe'):
+            machine['ssh_probe'] = (self.ssh_probe.as_dict()
+                                    if self.ssh_probe else {})
+        if fields is not None:
+            machine = {key: value for key, value in machine.iteritems()
+                       if key in fields}
+        return machine
 
     def as_dict_old(self):
         # Return a dict as it was previously being returned by list_machines
@@ -11,6 +11,8 @@ from mist.api import tasks
 
 from mist.api.auth.methods import auth_context_from_request
 from mist.api.helpers import view_config, params_from_request
+from mist.api.helpers import etag_view
+from mist.api.helpers import list_params_from_request, set_next_cursor
 
 from mist.api.exceptions import RequiredParameterMissingError
 from mist.api.exceptions import BadRequestError, NotFoundError
@@ -30,10 +32,12 @@ log = logging.getLogger(__name__)
 
 @view_config(route_name='api_v1_machines',
              request_method='GET', renderer='json')
+@etag_view('clouds', 'machines', 'keys')
 def list_machines(request):
     """
     List machines on cloud
-    Gets machines and their metadata from a cloud
+    Gets machines and their metadata from a cloud. If there are more machines,
+    the cursor of the next page is returned in the X-Next-Cursor header.
     Check Permissions take place in filter_list_machines
     READ permission required on cloud.
     READ permission required on machine.
@@ -42,6 +46,18 @@ def list_machines(request):
       in: path
       required: true
       type: string
+    limit:
+      type: integer
+      required: false
+      description: limit the number of machines returned
+    cursor:
+      type: string
+      required: false
+      description: the X-Next-Cursor header of the previous page
+    fields:
+      type: string
+      required: false
+      description: comma separated list of the fields of each machine to return
     """
     auth_context = auth_context_from_request(request)
     cloud_id = request.matchdict['cloud']
@@ -52,9 +68,13 @@ def list_machines(request):
     except Cloud.DoesNotExist:
         raise NotFoundError('Cloud does not exist')
 
-    machines = methods.filter_list_machines(auth_context, cloud_id)
+    kwargs = list_params_from_request(request)
+    machines = methods.filter_list_machines(auth_context, cloud_id, **kwargs)
+    set_next_cursor(request, machines, kwargs['limit'])
 
-    if cloud.machine_count != len(machines):
+    # Only update the machine count if all machines were listed.
+    paginated = kwargs['limit'] or kwargs['after']
+    if not paginated and cloud.machine_count != len(machines):
         try:
             tasks.update_machine_count.delay(
                 auth_context.owner.id, cloud_id, len(machines))
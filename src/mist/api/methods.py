@@ -30,6 +30,8 @@ from mist.api.exceptions import *
 
 from mist.api.helpers import trigger_session_update
 from mist.api.helpers import amqp_publish_user
+from mist.api.helpers import bump_list_versions
+from mist.api.helpers import select_fields
 from mist.api.helpers import StdStreamCapture
 
 from mist.api.helpers import dirty_cow, parse_os_release
@@ -80,17 +82,42 @@ def ssh_command(owner, cloud_id, machine_id, host, command,
     Cloud.objects.get(owner=owner, id=cloud_id, deleted=None)
 
     shell = Shell(host)
-    key_id, ssh_user = shell.autoconfigure(owner, cloud_id, machine_id,
-                                           key_id, username, password, port)
-    retval, output = shell.command(command)
-    shell.disconnect()
+    try:
+        key_id, ssh_user = shell.autoconfigure(owner, cloud_id, machine_id,
+                                               key_id, username, password,
+                                               port)
+        retval, output = shell.command(command)
+    finally:
+        shell.disconnect()
     return output
 
 
-def list_images(owner, cloud_id, term=None):
-    """List images from each cloud"""
-    return Cloud.objects.get(owner=owner, id=cloud_id,
-                             deleted=None).ctl.compute.list_images(term)
+def list_images(owner, cloud_id, term=None, limit=0, after=None,
+                fields=None):
+    """List images from each cloud
+
+    Images are sorted starred first, then by name and id. If `limit` is set,
+    at most that many images are returned, after the image whose star, name
+    and id are `after`. Unless `fields` is None, only those fields of each
+    image are returned, besides its star, name and id.
+
+    """
+    images = Cloud.objects.get(owner=owner, id=cloud_id,
+                               deleted=None).ctl.compute.list_images(term)
+    if after:
+        try:
+            star, name, image_id = after
+        except ValueError:
+            raise BadRequestError('Invalid cursor')
+        images = [image for image in images
+                  if (not image['star'], image['name'], image['id']) >
+                  (not star, name, image_id)]
+    if limit:
+        images = images[:limit]
+    if fields is not None:
+        fields = set(fields) | set(['star', 'name', 'id'])
+        images = [select_fields(image, fields) for image in images]
+    return images
 
 
 def star_image(owner, cloud_id, image_id):
@@ -109,6 +136,7 @@ def star_image(owner, cloud_id, image_id):
         if image_id in cloud.unstarred:
             cloud.unstarred.remove(image_id)
     cloud.save()
+    bump_list_versions(owner, ['images'])
     task = mist.api.tasks.ListImages()
     task.clear_cache(owner.id, cloud_id)
     task.delay(owner.id, cloud_id)
@@ -606,9 +634,10 @@ echo "Restarting collectd"
 $sudo /opt/mistio-collectd/collectd.sh restart
 """ % {'plugin_id': plugin_id}
 
-    retval, stdout = shell.command(script)
-
-    shell.disconnect()
+    try:
+        retval, stdout = shell.command(script)
+    finally:
+        shell.disconnect()
 
     return {'metric_id': None, 'stdout': stdout}
 
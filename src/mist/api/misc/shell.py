@@ -16,3 +16,45 @@ class ShellCapture(me.Document):
     finished_at = me.FloatField()
     columns = me.IntField()
     rows = me.IntField()
+
+    # Captured events are stored separately in `ShellCaptureChunk` documents.
+    chunks = me.IntField(default=0)
+    size = me.IntField(default=0)
+    truncated = me.BooleanField(default=False)
+
+    meta = {
+        'indexes': ['capture_id'],
+    }
+
+    def iter_events(self):
+        """Lazily yield captured (offset, event, data) tuples, in order"""
+        chunks = ShellCaptureChunk.objects(
+            capture_id=self.capture_id
+        ).only('events').order_by('sequence')
+        for chunk in chunks:
+            for event in chunk.events:
+                yield tuple(event)
+
+
+class ShellCaptureChunk(me.Document):
+    """A bounded, sequential slice of a shell session's captured events
+
+    Each event is stored as an (offset, event, data) list, where offset is
+    the number of seconds since the capture's `started_at`.
+
+    """
+    capture_id = me.StringField(required=True)
+    sequence = me.IntField(required=True)
+    events = me.ListField()
+    size = me.IntField(default=0)
+
+    meta = {
+        'indexes': [
+            {
+                'fields': ['capture_id', 'sequence'],
+                'sparse': False,
+                'unique': True,
+                'cls': False,
+            },
+        ],
+    }
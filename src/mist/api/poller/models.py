@@ -240,3 +240,6 @@ class CloudPollingSchedule(PollingSchedule):
 class ListMachinesPollingSchedule(CloudPollingSchedule):
 
     task = 'mist.api.poller.tasks.list_machines'
+
+    # Last time the cloud's machines were pinged and probed over SSH.
+    last_probe_sweep = me.DateTimeField()
@@ -1,13 +1,17 @@
 import logging
 import datetime
 
-from mist.api.helpers import amqp_publish
+import mongoengine as me
+
+from mist.api.helpers import amqp_publish_many
 from mist.api.helpers import amqp_publish_user
 from mist.api.helpers import amqp_owner_listening
 
 from mist.api.methods import notify_user
 from mist.api.tasks import app
 
+from mist.api import config
+
 
 log = logging.getLogger(__name__)
 
@@ -95,6 +99,16 @@ def list_machines(schedule_id):
         sched.last_attempt_started = None
         cloud.save()
 
+    # Ping and probe the running machines, unless done recently. The
+    # schedule is updated atomically, so that only one sweep is triggered.
+    if config.PROBE_SWEEP_INTERVAL:
+        since = now - datetime.timedelta(seconds=config.PROBE_SWEEP_INTERVAL)
+        if ListMachinesPollingSchedule.objects(
+            me.Q(last_probe_sweep=None) | me.Q(last_probe_sweep__lt=since),
+            id=sched.id
+        ).update_one(set__last_probe_sweep=now):
+            probe_machines.delay(cloud.id)
+
     # Publish results to rabbitmq (for backwards compatibility).
     if amqp_owner_listening(cloud.owner.id):
         amqp_publish_user(cloud.owner.id, routing_key='list_machines',
@@ -103,10 +117,24 @@ def list_machines(schedule_id):
                                              for machine in machines]})
 
     # Push historic information for inventory and cost reporting.
+    messages = []
     for machine in machines:
         data = {'owner_id': machine.cloud.owner.id,
                 'machine_id': machine.id,
                 'cost_per_month': machine.cost.monthly}
         log.info("Will push to elastic: %s", data)
-        amqp_publish(exchange='machines_inventory', routing_key='',
-                     auto_delete=False, data=data)
+        messages.append(('', data))
+    if messages:
+        amqp_publish_many(exchange='machines_inventory', messages=messages,
+                          auto_delete=False)
+
+
+@app.task(time_limit=600, soft_time_limit=590)
+def probe_machines(cloud_id):
+    """Ping and probe over SSH all running machines of a cloud"""
+    # FIXME: resolve circular deps error
+    from mist.api.clouds.models import Cloud
+    from mist.api.machines.methods import probe_machines
+    cloud = Cloud.objects.get(id=cloud_id, deleted=None)
+    updated = probe_machines(cloud)
+    log.info("Probed %d machines of cloud %s", updated, cloud)
@@ -11,6 +11,7 @@ from mist.api.exceptions import RequiredParameterMissingError
 
 from mist.api.helpers import trigger_session_update
 from mist.api.helpers import view_config, params_from_request
+from mist.api.helpers import etag_view
 
 from mist.api.schedules.methods import filter_list_schedules
 
@@ -88,6 +89,7 @@ def add_schedule_entry(request):
 
 @view_config(route_name='api_v1_schedules', request_method='GET',
              renderer='json')
+@etag_view('schedules')
 def list_schedules_entries(request):
     """
     List user schedules entries, order by _id
@@ -1,7 +1,6 @@
 import logging
 import requests
 import datetime
-import StringIO
 import mongoengine as me
 from pyramid.response import Response
 from mist.api.exceptions import BadRequestError
@@ -196,10 +195,8 @@ class BaseScriptController(object):
 
     def run_script(self, shell, params=None, job_id=None):
         if self.script.location.type == 'inline':
-            path = "/tmp/mist_script_%s" % job_id
-            source = self.script.location.source_code
-            sftp = shell.ssh.open_sftp()
-            sftp.putfo(StringIO.StringIO(source), path)
+            # uploaded only if not already cached on the host
+            path, = shell.cache_files(self.script.location.source_code)
         else:
             path = self._url()
 
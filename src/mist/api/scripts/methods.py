@@ -1,21 +1,152 @@
-from mist.api.scripts.models import Script
-from mist.api.tag.methods import get_tags_for_resource
+import logging
+import threading
+from uuid import uuid4
 
+from mist.api.scripts.models import Script, ScriptOutputChunk
+from mist.api.tag.methods import get_tags_for_resources
 
-def list_scripts(owner):
+from mist.api.helpers import amqp_publish_user
+from mist.api.helpers import paginate_query
+
+from mist.api import config
+
+
+log = logging.getLogger(__name__)
+
+
+def list_scripts(owner, limit=0, after=None, fields=None, ids=None):
+    """List owner's scripts
+
+    If `limit` is set, at most that many scripts are returned, sorted by id,
+    after the script with id `after[0]`. Unless `fields` is None, only those
+    fields of each script are returned. Unless `ids` is None, only the
+    scripts with those ids are listed.
+
+    """
     scripts = Script.objects(owner=owner, deleted=None)
+    if ids is not None:
+        scripts = scripts.filter(id__in=ids)
+    scripts = paginate_query(scripts, limit, after, fields)
+    if fields is None or 'tags' in fields:
+        tags = get_tags_for_resources(owner, scripts)
     script_objects = []
     for script in scripts:
-        script_object = script.as_dict()
-        script_object["tags"] = get_tags_for_resource(owner, script)
+        script_object = script.as_dict(fields=fields)
+        if fields is None or 'tags' in fields:
+            script_object["tags"] = tags[script.id]
         script_objects.append(script_object)
     return script_objects
 
 
-def filter_list_scripts(auth_context, perm='read'):
-    """Return a list of scripts based on the user's RBAC map."""
-    scripts = list_scripts(auth_context.owner)
+def filter_list_scripts(auth_context, perm='read', **kwargs):
+    """Return a list of scripts based on the user's RBAC map.
+
+    Any keyword arguments, such as `limit`, `after` and `fields`, are passed
+    to `list_scripts`.
+
+    """
     if not auth_context.is_owner():
-        scripts = [script for script in scripts if script['id'] in
-                   auth_context.get_allowed_resources(rtype='scripts')]
-    return scripts
+        kwargs['ids'] = list(
+            auth_context.get_allowed_resources(rtype='scripts')
+        )
+    return list_scripts(auth_context.owner, **kwargs)
+
+
+class ScriptOutputStream(object):
+    """Persist and publish the output of a script run as it arrives
+
+    Written output is buffered and, once `SCRIPT_OUTPUT_CHUNK_SIZE` bytes have
+    accumulated or every `SCRIPT_OUTPUT_FLUSH_INTERVAL` seconds, stored as the
+    next `ScriptOutputChunk` of the run and published to the owner's socket
+    with routing key 'script_output'. Only the last `SCRIPT_OUTPUT_TAIL_SIZE`
+    bytes are kept around, in `tail`.
+
+    Use it like:
+        stream = ScriptOutputStream(owner.id, job_id)
+        stream.start()
+        shell.command(command, callback=stream.write)
+        stream.close()
+
+    """
+
+    def __init__(self, owner_id, job_id=''):
+        self.owner_id = owner_id
+        self.job_id = job_id
+        self.output_id = uuid4().hex
+        self.buffer = []
+        self.buffer_size = 0
+        self.size = 0
+        self.sequence = 0
+        self.tail = ''
+        self.lock = threading.Lock()  # guards the buffer
+        self.flush_lock = threading.Lock()  # keeps chunks in order
+        self.closed = threading.Event()
+        self.flusher = None
+
+    def start(self):
+        """Start flushing buffered output periodically"""
+        self.flusher = threading.Thread(target=self._flush_periodically)
+        self.flusher.daemon = True
+        self.flusher.start()
+
+    def _flush_periodically(self):
+        while not self.closed.wait(config.SCRIPT_OUTPUT_FLUSH_INTERVAL):
+            self.flush()
+
+    def write(self, data, stream='stdout'):
+        with self.lock:
+            self.buffer.append(data)
+            self.buffer_size += len(data)
+            self.size += len(data)
+            full = self.buffer_size >= config.SCRIPT_OUTPUT_CHUNK_SIZE
+        if full:
+            self.flush(blocking=False)
+
+    def flush(self, blocking=True):
+        """Store and publish buffered output
+
+        Writers only wait for the buffer to be swapped, not for storing and
+        publishing it. If `blocking` is False and another flush is in
+        progress, nothing is done.
+
+        """
+        if not self.flush_lock.acquire(blocking):
+            return
+        try:
+            with self.lock:
+                if not self.buffer:
+                    return
+                data = ''.join(self.buffer)
+                self.buffer, self.buffer_size = [], 0
+                sequence, self.sequence = self.sequence, self.sequence + 1
+            self.tail = (self.tail + data)[-config.SCRIPT_OUTPUT_TAIL_SIZE:]
+            try:
+                ScriptOutputChunk(owner_id=self.owner_id,
+                                  output_id=self.output_id,
+                                  job_id=self.job_id,
+                                  sequence=sequence, data=data).save()
+            except Exception as exc:
+                log.error("Error storing chunk %d of script output %s: %r",
+                          sequence, self.output_id, exc)
+            amqp_publish_user(self.owner_id, routing_key='script_output',
+                              data={'job_id': self.job_id,
+                                    'output_id': self.output_id,
+                                    'sequence': sequence,
+                                    'data': data.decode('utf-8', 'replace')})
+        finally:
+            self.flush_lock.release()
+
+    def close(self):
+        self.closed.set()
+        if self.flusher is not None:
+            self.flusher.join()
+        self.flush()
+
+
+def iter_script_output(owner_id, job_id, output_id):
+    """Lazily yield the stored output of a script run, chunk by chunk"""
+    chunks = ScriptOutputChunk.objects(
+        owner_id=owner_id, job_id=job_id, output_id=output_id
+    ).only('data').order_by('sequence')
+    for chunk in chunks:
+        yield chunk.data
@@ -1,4 +1,5 @@
 """Script entity model."""
+import json
 from uuid import uuid4
 import mongoengine as me
 import mist.api.tag.models
@@ -228,16 +229,24 @@ class Script(me.Document):
 
         return sdict
 
-    def as_dict(self):
-        """Data representation for api calls."""
+    def as_dict(self, fields=None):
+        """Data representation for api calls.
+
+        Unless `fields` is None, only those fields are returned.
+
+        """
 
         sdict = {
             'id': str(self.id),
             'name': self.name,
             'description': self.description,
             'exec_type': self.exec_type,
-            'location': self.location.as_dict(),
         }
+        if fields is None or 'location' in fields:
+            sdict['location'] = self.location.as_dict()
+        if fields is not None:
+            sdict = {key: value for key, value in sdict.iteritems()
+                     if key in fields}
 
         return sdict
 
@@ -266,3 +275,71 @@ class CollectdScript(Script):
     extra = me.DictField()
 
     _controller_cls = controllers.CollectdScriptController
+
+
+class ScriptOutputChunk(me.Document):
+    """A bounded, sequential slice of the output of a single script run
+
+    The full output of a run is the concatenation of all chunks sharing its
+    `output_id`, ordered by `sequence`. See `ScriptOutputStream`.
+
+    """
+    owner_id = me.StringField(required=True)
+    output_id = me.StringField(required=True)
+    job_id = me.StringField()
+    sequence = me.IntField(required=True)
+    data = me.BinaryField()
+
+    meta = {
+        'indexes': [
+            {
+                'fields': ['output_id', 'sequence'],
+                'sparse': False,
+                'unique': True,
+                'cls': False,
+            },
+        ],
+    }
+
+
+class GroupScriptRunTarget(me.EmbeddedDocument):
+    machine_uuid = me.StringField(required=True)
+    host = me.StringField()
+    # pending, running, succeeded or failed
+    state = me.StringField(default='pending')
+    error = me.StringField()
+    exit_code = me.StringField()
+    output_id = me.StringField()
+    started_at = me.FloatField()
+    finished_at = me.FloatField()
+
+
+class GroupScriptRun(me.Document):
+    """Progress of a script run on a group of machines
+
+    See `mist.api.tasks.group_run_script`.
+
+    """
+    id = me.StringField(primary_key=True, default=lambda: uuid4().hex)
+    owner_id = me.StringField(required=True)
+    job_id = me.StringField()
+    script_id = me.StringField()
+    schedule_id = me.StringField()
+    targets = me.EmbeddedDocumentListField(GroupScriptRunTarget)
+    started_at = me.FloatField()
+    finished_at = me.FloatField()
+
+    meta = {
+        'indexes': ['owner_id', 'job_id'],
+    }
+
+    def update_target(self, machine_uuid, **kwargs):
+        """Atomically update the progress of one of the targets"""
+        updates = {'set__targets__S__%s' % key: value
+                   for key, value in kwargs.iteritems()}
+        GroupScriptRun.objects(
+            id=self.id, targets__machine_uuid=machine_uuid
+        ).update_one(**updates)
+
+    def as_dict(self):
+        return json.loads(self.to_json())
@@ -18,9 +18,13 @@ from mist.api.exceptions import BadRequestError, NotFoundError
 from mist.api.exceptions import PolicyUnauthorizedError, UnauthorizedError
 
 from mist.api.helpers import view_config, params_from_request
+from mist.api.helpers import etag_view
+from mist.api.helpers import list_params_from_request, set_next_cursor
 from mist.api.helpers import mac_sign
 
 from mist.api.scripts.methods import filter_list_scripts
+from mist.api.scripts.methods import iter_script_output
+from mist.api.scripts.models import ScriptOutputChunk
 
 from mist.api.logs.methods import get_stories
 
@@ -33,14 +37,31 @@ OK = Response("OK", 200)
 
 @view_config(route_name='api_v1_scripts', request_method='GET',
              renderer='json')
+@etag_view('scripts')
 def list_scripts(request):
     """
     List user scripts
+    If there are more scripts, the cursor of the next page is returned in the
+    X-Next-Cursor header.
     READ permission required on each script.
     ---
+    limit:
+      type: integer
+      required: false
+      description: limit the number of scripts returned
+    cursor:
+      type: string
+      required: false
+      description: the X-Next-Cursor header of the previous page
+    fields:
+      type: string
+      required: false
+      description: comma separated list of the fields of each script to return
     """
     auth_context = auth_context_from_request(request)
-    scripts_list = filter_list_scripts(auth_context)
+    kwargs = list_params_from_request(request)
+    scripts_list = filter_list_scripts(auth_context, **kwargs)
+    set_next_cursor(request, scripts_list, kwargs['limit'])
     return scripts_list
 
 
@@ -433,6 +454,34 @@ def run_script(request):
     return {'job_id': job_id, 'job': job}
 
 
+@view_config(route_name='api_v1_job_output', request_method='GET')
+def show_job_output(request):
+    """
+    Download the full output of a script run.
+    The output_id is included in the job's script_finished event.
+    ---
+    job_id:
+      in: path
+      required: true
+      type: string
+    output_id:
+      in: path
+      required: true
+      type: string
+    """
+    auth_context = auth_context_from_request(request)
+    job_id = request.matchdict['job_id']
+    output_id = request.matchdict['output_id']
+    if not ScriptOutputChunk.objects(owner_id=auth_context.owner.id,
+                                     job_id=job_id,
+                                     output_id=output_id).count():
+        raise NotFoundError('Script output not found')
+    return Response(
+        app_iter=iter_script_output(auth_context.owner.id, job_id, output_id),
+        content_type='text/plain'
+    )
+
+
 @view_config(route_name='api_v1_script_url', request_method='GET',
              renderer='json')
 def url_script(request):
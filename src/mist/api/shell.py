@@ -4,16 +4,24 @@ This module contains everything that is need to communicate with machines via
 SSH.
 
 """
+import os
+import uuid
+import hashlib
 import paramiko
 import websocket
 import socket
 import thread
+import threading
 import ssl
+import select
 import tempfile
+import weakref
 import mongoengine as me
 
-from time import sleep
+from time import sleep, time
+from base64 import b64encode
 from StringIO import StringIO
+from memcache import Client as MemcacheClient
 
 from mist.api.clouds.models import Cloud
 from mist.api.machines.models import Machine, KeyAssociation
@@ -41,6 +49,209 @@ logging.basicConfig(level=config.PY_LOG_LEVEL,
 log = logging.getLogger(__name__)
 
 
+_AUTOCONFIGURE_CACHE = None
+
+
+def _autoconfigure_cache():
+    global _AUTOCONFIGURE_CACHE
+    if _AUTOCONFIGURE_CACHE is None:
+        _AUTOCONFIGURE_CACHE = MemcacheClient(config.MEMCACHED_HOST)
+    return _AUTOCONFIGURE_CACHE
+
+
+def _working_credentials_cache_key(cloud_id, machine_id):
+    return 'ssh-ok-%s' % b64encode('%s:%s' % (cloud_id, machine_id))
+
+
+def _failed_credentials_cache_key(host, port, ssh_user, key, generation):
+    return 'ssh-fail-%s' % b64encode('%s:%s:%s:%s:%s' % (
+        host, port, ssh_user, key.id, generation))
+
+
+def _failed_credentials_generation_key(cloud_id, machine_id):
+    return 'ssh-fail-gen-%s' % b64encode('%s:%s' % (cloud_id, machine_id))
+
+
+def forget_failed_credentials(cloud_id, machine_id):
+    """Retry credentials that recently failed to connect to a machine
+
+    Call this when the keys of a machine change, since credentials that
+    failed before may work now.
+
+    """
+    _autoconfigure_cache().set(
+        _failed_credentials_generation_key(cloud_id, machine_id),
+        uuid.uuid4().hex
+    )
+
+
+# host -> semaphore bounding concurrent ssh handshakes to it, since sshd drops
+# connections beyond MaxStartups unauthenticated ones
+_HOST_SEMAPHORES = weakref.WeakValueDictionary()
+_HOST_SEMAPHORES_LOCK = threading.Lock()
+
+
+def _host_semaphore(host):
+    with _HOST_SEMAPHORES_LOCK:
+        semaphore = _HOST_SEMAPHORES.get(host)
+        if semaphore is None:
+            semaphore = threading.BoundedSemaphore(
+                config.SSH_AUTOCONFIGURE_CONCURRENCY)
+            _HOST_SEMAPHORES[host] = semaphore
+        return semaphore
+
+
+def _cached_files(contents):
+    """Return (content, path) pairs of files to be cached on a host
+
+    Paths are relative to $HOME and named after the SHA256 hash of the
+    contents, which are encoded to UTF-8 if needed.
+
+    """
+    contents = [content.encode('utf-8')
+                if isinstance(content, unicode) else content
+                for content in contents]
+    return [(content, '.mist/cache/%s' % hashlib.sha256(content).hexdigest())
+            for content in contents]
+
+
+class PooledSSHClient(paramiko.SSHClient):
+    """SSHClient that can be attached to and detached from a shared transport
+    """
+
+    def attach_transport(self, transport):
+        self._transport = transport
+
+    def detach_transport(self):
+        transport, self._transport = self._transport, None
+        return transport
+
+
+class SSHTransportPool(object):
+    """Per process cache of authenticated SSH transports
+
+    Transports are keyed by (host, port, username, key_id). A cached
+    transport is handed out as long as it is alive and fewer than
+    `max_sessions` Shells currently use it. Transports left unused for more
+    than `max_idle` seconds are closed. At most `max_size` transports are
+    kept, the least recently used idle one is closed to make room for a new
+    one and if none is idle the new one isn't pooled.
+
+    """
+
+    def __init__(self, max_sessions=None, max_idle=None, max_size=None):
+        self.max_sessions = max_sessions
+        self.max_idle = max_idle
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+        # key -> list of [transport, sessions, last_used]
+        self.entries = {}
+
+    def _check_fork(self):
+        # transports inherited from the parent process must not be reused
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.entries = {}
+
+    @staticmethod
+    def _is_alive(transport):
+        if not (transport.is_active() and transport.is_authenticated()):
+            return False
+        try:
+            transport.send_ignore()
+        except Exception:
+            return False
+        return True
+
+    def _evict(self, now):
+        """Drop dead transports and close those idle for too long"""
+        for key in self.entries.keys():
+            entries = []
+            for entry in self.entries[key]:
+                transport, sessions, last_used = entry
+                if not transport.is_active():
+                    continue
+                if not sessions and now - last_used > self.max_idle:
+                    log.info("Closing idle ssh transport to %s:%s",
+                             key[0], key[1])
+                    transport.close()
+                    continue
+                entries.append(entry)
+            if entries:
+                self.entries[key] = entries
+            else:
+                self.entries.pop(key)
+
+    def _make_room(self):
+        """Close the least recently used idle transport if the pool is full
+
+        Returns False if the pool is full and all transports are in use.
+
+        """
+        if not self.max_size:
+            return True
+        entries = [(entry[2], key, entry)
+                   for key in self.entries for entry in self.entries[key]]
+        if len(entries) < self.max_size:
+            return True
+        idle = [item for item in entries if not item[2][1]]
+        if not idle:
+            return False
+        _, key, entry = min(idle)
+        log.info("Closing least recently used ssh transport to %s:%s",
+                 key[0], key[1])
+        entry[0].close()
+        self.entries[key].remove(entry)
+        if not self.entries[key]:
+            self.entries.pop(key)
+        return True
+
+    def acquire(self, key):
+        """Return a live cached transport for key, or None"""
+        if not self.max_sessions:
+            return None
+        with self.lock:
+            self._check_fork()
+            self._evict(time())
+            for entry in self.entries.get(key, []):
+                if entry[1] < self.max_sessions and self._is_alive(entry[0]):
+                    entry[1] += 1
+                    entry[2] = time()
+                    return entry[0]
+
+    def add(self, key, transport):
+        """Cache a newly authenticated transport, already in use once"""
+        if not self.max_sessions:
+            return False
+        with self.lock:
+            self._check_fork()
+            self._evict(time())
+            if not self._make_room():
+                return False
+            self.entries.setdefault(key, []).append([transport, 1, time()])
+        return True
+
+    def release(self, key, transport):
+        """Mark one use of a transport as finished"""
+        with self.lock:
+            self._check_fork()
+            for entry in self.entries.get(key, []):
+                if entry[0] is transport:
+                    entry[1] = max(entry[1] - 1, 0)
+                    entry[2] = time()
+                    break
+            else:
+                # not (or no longer) pooled, close it
+                transport.close()
+            self._evict(time())
+
+
+TRANSPORT_POOL = SSHTransportPool(max_sessions=config.SSH_POOL_MAX_SESSIONS,
+                                  max_idle=config.SSH_POOL_MAX_IDLE,
+                                  max_size=config.SSH_POOL_MAX_SIZE)
+
+
 class ParamikoShell(object):
     """sHell
 
@@ -62,6 +273,9 @@ class ParamikoShell(object):
 
     """
 
+    # bytes to read from the channel at a time
+    chunk_size = 32 * 1024
+
     def __init__(self, host, username=None, key=None, password=None, cert_file=None, port=22):
         """Initialize a Shell instance
 
@@ -75,8 +289,9 @@ class ParamikoShell(object):
             raise RequiredParameterMissingError('host not given')
         self.host = host
         self.sudo = False
+        self.pool_key = None
 
-        self.ssh = paramiko.SSHClient()
+        self.ssh = PooledSSHClient()
         self.ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
 
         # if username provided, try to connect
@@ -100,6 +315,18 @@ class ParamikoShell(object):
             raise RequiredParameterMissingError("neither key nor password "
                                                 "provided.")
 
+        self.release_transport()
+        pool_key = None
+        if key and key.id:
+            pool_key = (self.host, port, username, key.id)
+            transport = TRANSPORT_POOL.acquire(pool_key)
+            if transport is not None:
+                log.info("Reusing ssh transport to %s@%s:%s",
+                         username, self.host, port)
+                self.ssh.attach_transport(transport)
+                self.pool_key = pool_key
+                return
+
         if key:
             private = key.private
             if isinstance(key, SignedSSHKey) and cert_file:
@@ -125,6 +352,9 @@ class ParamikoShell(object):
                     look_for_keys=False,
                     timeout=10
                 )
+                if pool_key and TRANSPORT_POOL.add(pool_key,
+                                                   self.ssh.get_transport()):
+                    self.pool_key = pool_key
                 break
             except paramiko.AuthenticationException as exc:
                 log.error("ssh exception %r", exc)
@@ -143,9 +373,22 @@ class ParamikoShell(object):
                 if not attempts:
                     raise ServiceUnavailableError(repr(exc))
 
+    def release_transport(self):
+        """Hand a pooled transport back to the pool, without closing it"""
+        if self.pool_key is not None:
+            pool_key, self.pool_key = self.pool_key, None
+            transport = self.ssh.detach_transport()
+            if transport is not None:
+                TRANSPORT_POOL.release(pool_key, transport)
+
     def disconnect(self):
-        """Close the SSH connection."""
+        """Close the SSH connection.
+
+        Pooled transports are released to be reused by later connections.
+
+        """
         try:
+            self.release_transport()
             log.info("Closing ssh connection to %s", self.host)
             self.ssh.close()
         except:
@@ -178,7 +421,68 @@ class ParamikoShell(object):
         channel.exec_command(cmd)
         return stdout, stderr, channel
 
-    def command(self, cmd, pty=True):
+    def _read_output(self, channel, max_bytes=None, callback=None,
+                     pty=False, deadline=None):
+        """Read stdout and stderr of channel concurrently, in chunks
+
+        Both streams are read as soon as data is available on either of them,
+        so that the remote end never blocks on a full stderr pipe. At most
+        `max_bytes` of each stream are kept, the rest is read and discarded.
+        If `callback` is given, it is called with every chunk read and the
+        name of its stream, 'stdout' or 'stderr'. If `pty` is True, only
+        stdout is read, since both streams are combined in it.
+
+        Reading stops once the remote end has sent EOF, or closed the channel,
+        and all buffered output has been read. If no output arrives for as
+        long as the channel's timeout, or reading goes on past `deadline`, a
+        timestamp, `socket.timeout` is raised.
+
+        Returns a (stdout, stderr) tuple.
+
+        """
+        readers = {
+            'stdout': (channel.recv_ready, channel.recv, []),
+            'stderr': (channel.recv_stderr_ready, channel.recv_stderr, []),
+        }
+        sizes = {'stdout': 0, 'stderr': 0}
+        pending = set(['stdout'] if pty else readers)
+        timeout = channel.gettimeout()
+        while pending:
+            wait = timeout
+            if deadline is not None:
+                wait = deadline - time()
+                if wait <= 0:
+                    raise socket.timeout("Command time limit exceeded")
+                if timeout is not None:
+                    wait = min(wait, timeout)
+            # Check for EOF before the buffers, since any output received
+            # before it is buffered by then.
+            eof = channel.eof_received or channel.closed
+            ready = [name for name in pending if readers[name][0]()]
+            if not ready:
+                if eof:
+                    break
+                if not select.select([channel], [], [], wait)[0] and (
+                        deadline is None or time() < deadline):
+                    raise socket.timeout("Timed out reading command output")
+                continue
+            for name in ready:
+                data = readers[name][1](self.chunk_size)
+                if not data:
+                    # EOF
+                    pending.discard(name)
+                    continue
+                if callback is not None:
+                    callback(data, name)
+                if max_bytes is not None:
+                    data = data[:max(max_bytes - sizes[name], 0)]
+                if data:
+                    readers[name][2].append(data)
+                    sizes[name] += len(data)
+        return ''.join(readers['stdout'][2]), ''.join(readers['stderr'][2])
+
+    def command(self, cmd, pty=True, max_bytes=None, callback=None,
+                timeout=None):
         """Run command and return output.
 
         If pty is True, then it returns a string object that contains the
@@ -187,27 +491,69 @@ class ParamikoShell(object):
         If pty is False, then it returns a two string tupple, consisting of
         stdout and stderr.
 
+        Output is decoded as UTF-8, replacing any invalid bytes.
+
+        If max_bytes is given, output beyond that many bytes per stream is
+        discarded. If callback is given, it is called with each chunk of
+        output as it arrives, see `_read_output`.
+
+        If timeout is given and the command hasn't finished within that many
+        seconds, its channel is closed and socket.timeout is raised.
+
         """
         log.info("running command: '%s'", cmd)
+        deadline = time() + timeout if timeout is not None else None
         stdout, stderr, channel = self._command(cmd, pty)
-        line = stdout.readline()
-        out = ''
-        while line:
-            out += line
-            line = stdout.readline()
-
+        try:
+            out, err = self._read_output(channel, max_bytes=max_bytes,
+                                         callback=callback, pty=pty,
+                                         deadline=deadline)
+        except socket.timeout:
+            channel.close()
+            raise
+        retval = channel.recv_exit_status()
+        out = out.decode('utf-8', 'replace')
         if pty:
-            retval = channel.recv_exit_status()
             return retval, out
-        else:
-            line = stderr.readline()
-            err = ''
-            while line:
-                err += line
-                line = stderr.readline()
-            retval = channel.recv_exit_status()
+        return retval, out, err.decode('utf-8', 'replace')
+
+    def cache_files(self, *contents):
+        """Make sure files with the given contents exist on the host
 
-            return retval, out, err
+        Files are stored in ~/.mist/cache, named after the SHA256 hash of
+        their contents. A single command checks which of them are missing
+        and only those are uploaded. Returns the paths of the files, in the
+        same order as their contents, prefixed with $HOME so that they can
+        be used in commands.
+
+        """
+        files = _cached_files(contents)
+        paths = [path for content, path in files]
+        retval, out, err = self.command(
+            'cd && mkdir -p .mist/cache && '
+            'for f in %s; do [ -f "$f" ] || echo "$f"; done' % ' '.join(paths),
+            pty=False
+        )
+        missing = set(out.split())
+        if missing:
+            sftp = self.ssh.open_sftp()
+            try:
+                for content, path in files:
+                    if path not in missing:
+                        continue
+                    log.info("Uploading %s to %s", path, self.host)
+                    # upload under a temporary name first, so that no
+                    # partial file is ever mistaken for a cached one
+                    tmp_path = '%s.%s' % (path, uuid.uuid4().hex)
+                    sftp.putfo(StringIO(content), tmp_path)
+                    try:
+                        sftp.rename(tmp_path, path)
+                    except IOError:
+                        # uploaded concurrently by someone else
+                        sftp.remove(tmp_path)
+            finally:
+                sftp.close()
+        return ['$HOME/%s' % path for path in paths]
 
     def command_stream(self, cmd):
         """Run command and stream output line by line.
@@ -223,6 +569,130 @@ class ParamikoShell(object):
             yield line
             line = stdout.readline()
 
+    def _try_credentials(self, owner, key, ssh_user, port, password=None):
+        """Connect a new ParamikoShell to self.host using given credentials
+
+        Returns a (shell, ssh_user) tuple, where ssh_user may differ from the
+        one given if the server asked us to login as a different user.
+
+        """
+        shell = ParamikoShell(self.host)
+        # NAT by the OpenVPN server may rewrite both host and port
+        shell.host, nat_port = dnat(owner, self.host, port)
+        log.info("ssh -i %s %s@%s:%s", key.name, ssh_user, shell.host,
+                 nat_port)
+        cert_file = ''
+        if isinstance(key, SignedSSHKey):
+            cert_file = key.certificate
+        shell.connect(username=ssh_user, key=key, password=password,
+                      cert_file=cert_file, port=nat_port)
+        try:
+            retval, resp = shell.command('uptime')
+        except Exception:
+            shell.disconnect()
+            raise
+        new_ssh_user = None
+        if 'Please login as the user ' in resp:
+            new_ssh_user = resp.split()[5].strip('"')
+        elif 'Please login as the' in resp:
+            # for EC2 Amazon Linux machines, usually with ec2-user
+            new_ssh_user = resp.split()[4].strip('"')
+        if new_ssh_user:
+            log.info("retrying as %s", new_ssh_user)
+            shell.disconnect()
+            shell.connect(username=new_ssh_user, key=key, password=password,
+                          cert_file=cert_file, port=nat_port)
+            ssh_user = new_ssh_user
+        return shell, ssh_user
+
+    def _discover_credentials(self, owner, candidates, password=None,
+                              use_cache=True, generation=''):
+        """Try (key, ssh_user, port) candidates concurrently
+
+        At most `config.SSH_AUTOCONFIGURE_CONCURRENCY` candidates are tried
+        at the same time against the same host, across all Shells of this
+        process. As soon as one succeeds, no further candidates are tried and
+        it is returned, without waiting for the attempts still in progress.
+        Candidates that failed to authenticate recently, with the same
+        failures `generation`, are skipped if `use_cache` is True. Returns a
+        (shell, key, ssh_user, port, requested_user) tuple, where ssh_user is
+        the user logged in as and requested_user the one of the candidate, or
+        None if no candidate succeeded.
+
+        """
+        if use_cache:
+            candidates = [(key, ssh_user, port)
+                          for key, ssh_user, port in candidates
+                          if not _autoconfigure_cache().get(
+                              _failed_credentials_cache_key(
+                                  self.host, port, ssh_user, key,
+                                  generation))]
+        if not candidates:
+            return None
+        lock = threading.Lock()
+        done = threading.Event()
+        winner = []
+        errors = []
+        workers = [min(len(candidates), config.SSH_AUTOCONFIGURE_CONCURRENCY)]
+        semaphore = _host_semaphore(self.host)
+
+        def try_candidates():
+            try:
+                try_next_candidate()
+            finally:
+                with lock:
+                    workers[0] -= 1
+                    if not workers[0]:
+                        done.set()
+
+        def try_next_candidate():
+            while not done.is_set():
+                with lock:
+                    if not candidates:
+                        return
+                    key, ssh_user, port = candidates.pop(0)
+                try:
+                    with semaphore:
+                        if done.is_set():
+                            return
+                        shell, used_user = self._try_credentials(
+                            owner, key, ssh_user, port, password=password
+                        )
+                except MachineUnauthorizedError:
+                    _autoconfigure_cache().set(
+                        _failed_credentials_cache_key(self.host, port,
+                                                      ssh_user, key,
+                                                      generation),
+                        1, time=config.SSH_AUTOCONFIGURE_FAILURE_TTL
+                    )
+                    continue
+                except Exception as exc:
+                    # host unreachable, no point in trying other credentials
+                    with lock:
+                        errors.append(exc)
+                        done.set()
+                    return
+                with lock:
+                    if done.is_set():
+                        # too late, the caller has moved on
+                        shell.disconnect()
+                        return
+                    winner.append((shell, key, used_user, port, ssh_user))
+                    done.set()
+
+        for _ in range(workers[0]):
+            thread_ = threading.Thread(target=try_candidates)
+            thread_.daemon = True
+            thread_.start()
+        # Attempts still in progress disconnect themselves when they finish.
+        done.wait()
+        with lock:
+            if winner:
+                return winner[0]
+            if errors:
+                raise errors[0]
+        return None
+
     def autoconfigure(self, owner, cloud_id, machine_id,
                       key_id=None, username=None, password=None, port=22):
         """Autoconfigure SSH client.
@@ -234,6 +704,10 @@ class ParamikoShell(object):
         association information in the key with the current timestamp and the
         username used to connect.
 
+        The credentials that last worked for a machine are tried first. If
+        they fail, all candidate combinations of key, username and port are
+        tried concurrently.
+
         """
         log.info("autoconfiguring Shell for machine %s:%s",
                  cloud_id, machine_id)
@@ -267,78 +741,78 @@ class ParamikoShell(object):
                               for key_assoc in machine.key_associations]))
         if 22 not in ports:
             ports.append(22)
-        # store the original destination IP to prevent rewriting it when NATing
-        ssh_host = self.host
-        for key in keys:
-            for ssh_user in users:
-                for port in ports:
-                    try:
-                        # store the original ssh port in case of NAT
-                        # by the OpenVPN server
-                        ssh_port = port
-                        self.host, port = dnat(owner, ssh_host, port)
-                        log.info("ssh -i %s %s@%s:%s",
-                                 key.name, ssh_user, self.host, port)
-                        cert_file = ''
-                        if isinstance(key, SignedSSHKey):
-                            cert_file = key.certificate
-
-                        self.connect(username=ssh_user,
-                                     key=key,
-                                     password=password,
-                                     cert_file=cert_file,
-                                     port=port)
-                    except MachineUnauthorizedError:
-                        continue
-
-                    retval, resp = self.command('uptime')
-                    new_ssh_user = None
-                    if 'Please login as the user ' in resp:
-                        new_ssh_user = resp.split()[5].strip('"')
-                    elif 'Please login as the' in resp:
-                        # for EC2 Amazon Linux machines, usually with ec2-user
-                        new_ssh_user = resp.split()[4].strip('"')
-                    if new_ssh_user:
-                        log.info("retrying as %s", new_ssh_user)
-                        try:
-                            self.disconnect()
-                            cert_file = ''
-                            if isinstance(key, SignedSSHKey):
-                                cert_file = key.certificate
-                            self.connect(username=new_ssh_user,
-                                         key=key,
-                                         password=password,
-                                         cert_file=cert_file,
-                                         port=port)
-                            ssh_user = new_ssh_user
-                        except MachineUnauthorizedError:
-                            continue
-                    # we managed to connect successfully, return
-                    # but first update key
-                    updated = False
-                    for key_assoc in machine.key_associations:
-                        if key_assoc.keypair == key:
-                            key_assoc.ssh_user = ssh_user
-                            updated = True
-                            trigger_session_update_flag = True
-                            break
-                    if not updated:
-                        trigger_session_update_flag = True
-                        # in case of a private host do NOT update the key
-                        # associations with the port allocated by the OpenVPN
-                        # server, instead use the original ssh_port
-                        key_assoc = KeyAssociation(keypair=key,
-                                                   ssh_user=ssh_user,
-                                                   port=ssh_port,
-                                                   sudo=self.check_sudo())
-                        machine.key_associations.append(key_assoc)
-                    machine.save()
-
-                    if trigger_session_update_flag:
-                        trigger_session_update(owner.id, ['keys'])
-                    return key.name, ssh_user
-
-        raise MachineUnauthorizedError("%s:%s" % (cloud_id, machine_id))
+        candidates = [(key, ssh_user, port)
+                      for key in keys for ssh_user in users for port in ports]
+
+        # Try the credentials that worked last time on their own first. They
+        # are stored with the user logged in as, which differs from the one
+        # requested if the server asked us to login as another user.
+        result = None
+        cache_key = _working_credentials_cache_key(cloud_id, machine_id)
+        cached = _autoconfigure_cache().get(cache_key)
+        if cached and len(cached) == 4:
+            cached_key_id, cached_user, cached_port, requested_user = cached
+            matches = [(key, ssh_user, port)
+                       for key, ssh_user, port in candidates
+                       if key.id == cached_key_id and port == cached_port and
+                       ssh_user in (cached_user, requested_user)]
+            if matches:
+                for candidate in matches:
+                    candidates.remove(candidate)
+                result = self._discover_credentials(
+                    owner, [(matches[0][0], cached_user, cached_port)],
+                    password=password, use_cache=False
+                )
+                if result is not None:
+                    result = result[:4] + (requested_user, )
+        if result is None and cached:
+            _autoconfigure_cache().delete(cache_key)
+        if result is None:
+            # explicitly requested credentials bypass the failures cache
+            generation = _autoconfigure_cache().get(
+                _failed_credentials_generation_key(cloud_id, machine_id))
+            result = self._discover_credentials(owner, candidates,
+                                                password=password,
+                                                use_cache=not key_id,
+                                                generation=generation or '')
+        if result is None:
+            raise MachineUnauthorizedError("%s:%s" % (cloud_id, machine_id))
+
+        # adopt the winning shell's connection
+        shell, key, ssh_user, ssh_port, requested_user = result
+        self.disconnect()
+        self.host = shell.host
+        self.ssh.attach_transport(shell.ssh.detach_transport())
+        self.pool_key, shell.pool_key = shell.pool_key, None
+        _autoconfigure_cache().set(
+            cache_key, (key.id, ssh_user, ssh_port, requested_user),
+            time=config.SSH_AUTOCONFIGURE_SUCCESS_TTL
+        )
+
+        # we managed to connect successfully, return
+        # but first update key
+        updated = False
+        for key_assoc in machine.key_associations:
+            if key_assoc.keypair == key:
+                key_assoc.ssh_user = ssh_user
+                updated = True
+                trigger_session_update_flag = True
+                break
+        if not updated:
+            trigger_session_update_flag = True
+            # in case of a private host do NOT update the key
+            # associations with the port allocated by the OpenVPN
+            # server, instead use the original ssh_port
+            key_assoc = KeyAssociation(keypair=key,
+                                       ssh_user=ssh_user,
+                                       port=ssh_port,
+                                       sudo=self.check_sudo())
+            machine.key_associations.append(key_assoc)
+        machine.save()
+
+        if trigger_session_update_flag:
+            trigger_session_update(owner.id, ['keys'])
+        return key.name, ssh_user
 
     def __del__(self):
         self.disconnect()
@@ -414,10 +888,46 @@ class DockerShell(DockerWebSocket):
     """
     DockerShell achieved through the Docker host's API by opening a WebSocket
     """
+    # base64 characters written to a cached file by each command, so that
+    # commands fit in a terminal line
+    cache_chunk_size = 3 * 1024
+
     def __init__(self, host):
         self.host = host
         super(DockerShell, self).__init__()
 
+    def cache_files(self, *contents):
+        """Make sure files with the given contents exist in the container
+
+        Same as `ParamikoShell.cache_files`, but since there is no SFTP the
+        missing files are written base64 encoded, `cache_chunk_size`
+        characters at a time, and then decoded.
+
+        """
+        files = _cached_files(contents)
+        self.buffer = ""
+        # the marker is split in the command, so its echo isn't matched
+        retval, output = self.command(
+            'mkdir -p $HOME/.mist/cache && for f in %s; do '
+            '[ -f "$HOME/$f" ] || echo "mis""sing:$f"; done' %
+            ' '.join(path for content, path in files)
+        )
+        missing = set(line.strip()[len('missing:'):]
+                      for line in output.splitlines()
+                      if line.strip().startswith('missing:'))
+        for content, path in files:
+            if path not in missing:
+                continue
+            encoded = b64encode(content)
+            self.command(': > $HOME/%s.b64' % path)
+            for i in xrange(0, len(encoded), self.cache_chunk_size):
+                self.command("printf %%s '%s' >> $HOME/%s.b64" % (
+                    encoded[i:i + self.cache_chunk_size], path))
+            self.command('base64 -d $HOME/%s.b64 > $HOME/%s.tmp && '
+                         'mv $HOME/%s.tmp $HOME/%s; rm -f $HOME/%s.b64' %
+                         (path, path, path, path, path))
+        return ['$HOME/%s' % path for content, path in files]
+
     def autoconfigure(self, owner, cloud_id, machine_id, **kwargs):
         shell_type = 'logging' if kwargs.get('job_id', '') else 'interactive'
         config_method = '%s_shell' % shell_type
@@ -557,12 +1067,17 @@ class Shell(object):
     def disconnect(self):
         self._shell.disconnect()
 
-    def command(self, cmd, pty=True):
+    def command(self, cmd, pty=True, max_bytes=None, callback=None,
+                timeout=None):
         if isinstance(self._shell, ParamikoShell):
-            return self._shell.command(cmd, pty=pty)
+            return self._shell.command(cmd, pty=pty, max_bytes=max_bytes,
+                                       callback=callback, timeout=timeout)
         elif isinstance(self._shell, DockerShell):
             return self._shell.command(cmd)
 
+    def cache_files(self, *contents):
+        return self._shell.cache_files(*contents)
+
     def command_stream(self, cmd):
         if isinstance(self._shell, ParamikoShell):
             yield self._shell.command_stream(cmd)
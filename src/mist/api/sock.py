@@ -16,6 +16,7 @@ import traceback
 import datetime
 
 import tornado.gen
+import tornado.ioloop
 
 from sockjs.tornado import SockJSConnection, SockJSRouter
 from mist.api.sockjs_mux import MultiplexConnection
@@ -39,6 +40,8 @@ from mist.api.machines.methods import filter_list_machines
 from mist.api.scripts.methods import filter_list_scripts
 from mist.api.schedules.methods import filter_list_schedules
 
+from mist.api.helpers import set_owner_listening
+
 from mist.api import tasks
 from mist.api.hub.tornado_shell_client import ShellHubClient
 
@@ -149,6 +152,7 @@ class ShellConnection(MistConnection):
         super(ShellConnection, self).on_open(conn_info)
         self.hub_client = None
         self.ssh_info = {}
+        self.shell_buffer = []
 
     def on_shell_open(self, data):
         if self.ssh_info:
@@ -188,7 +192,17 @@ class ShellConnection(MistConnection):
         self.hub_client.resize(columns, rows)
 
     def emit_shell_data(self, data):
-        self.send('shell_data', data)
+        # Coalesce all shell output batches received from the hub within the
+        # same ioloop iteration into a single sockjs frame.
+        if not self.shell_buffer:
+            tornado.ioloop.IOLoop.current().add_callback(self.flush_shell_data)
+        self.shell_buffer.append(data)
+
+    def flush_shell_data(self):
+        if self.shell_buffer:
+            data = ''.join(self.shell_buffer)
+            self.shell_buffer = []
+            self.send('shell_data', data)
 
     def on_close(self, stale=False):
         if self.hub_client:
@@ -208,6 +222,7 @@ class OwnerUpdatesConsumer(Consumer):
             exchange_kwargs={'auto_delete': True},
             queue_kwargs={'auto_delete': True, 'exclusive': True},
         )
+        self.heartbeating = False
 
     def on_message(self, unused_channel, basic_deliver, properties, body):
         super(OwnerUpdatesConsumer, self).on_message(
@@ -219,8 +234,23 @@ class OwnerUpdatesConsumer(Consumer):
 
     def start_consuming(self):
         super(OwnerUpdatesConsumer, self).start_consuming()
+        if not self.heartbeating:
+            self.periodic_presence_heartbeat()
         self.sockjs_conn.start()
 
+    @tornado.gen.coroutine
+    def periodic_presence_heartbeat(self):
+        """Let workers know that the owner's updates are being consumed"""
+        self.heartbeating = True
+        while not (self._closing or self.sockjs_conn.closed):
+            try:
+                set_owner_listening(self.sockjs_conn.owner.id)
+            except Exception as exc:
+                log.error("Failed to mark %s as listening: %r",
+                          self.sockjs_conn.owner, exc)
+            yield tornado.gen.sleep(config.OWNER_PRESENCE_HEARTBEAT)
+        self.heartbeating = False
+
 
 class LogsConsumer(Consumer):
 
@@ -422,7 +452,8 @@ class MainConnection(MistConnection):
         log.info("Got %s", routing_key)
         if routing_key in set(['notify', 'probe', 'list_sizes', 'list_images',
                                'list_networks', 'list_machines', 'list_zones',
-                               'list_locations', 'list_projects', 'ping']):
+                               'list_locations', 'list_projects', 'ping',
+                               'script_output']):
             if routing_key == 'list_machines':
                 # probe newly discovered running machines
                 machines = result['machines']
@@ -460,24 +491,29 @@ class MainConnection(MistConnection):
                         if not ips:
                             continue
 
+                    # machines are pinged and probed periodically by the
+                    # poller, send the latest results, fresh ones will follow
                     machine_obj = Machine.objects(
-                        cloud=cloud,
-                        machine_id=machine['machine_id'],
-                        key_associations__not__size=0
-                    ).first()
-                    if machine_obj:
-                        cached = tasks.ProbeSSH().smart_delay(
-                            self.owner.id, cloud_id, machine['machine_id'],
-                            ips[0], machine['id']
-                        )
-                        if cached is not None:
-                            self.send('probe', cached)
-
-                    cached = tasks.Ping().smart_delay(
-                        self.owner.id, cloud_id, machine['machine_id'], ips[0]
-                    )
-                    if cached is not None:
-                        self.send('ping', cached)
+                        cloud=cloud, machine_id=machine['machine_id']
+                    ).only('id', 'ping_probe', 'ssh_probe').first()
+                    if machine_obj is None:
+                        continue
+                    if machine_obj.ssh_probe and \
+                            not machine_obj.ssh_probe.unreachable_since:
+                        self.send('probe', {
+                            'cloud_id': cloud_id,
+                            'machine_id': machine['machine_id'],
+                            'machine_uuid': machine_obj.id,
+                            'host': ips[0],
+                            'result': machine_obj.ssh_probe.as_dict(),
+                        })
+                    if machine_obj.ping_probe:
+                        self.send('ping', {
+                            'cloud_id': cloud_id,
+                            'machine_id': machine['machine_id'],
+                            'host': ips[0],
+                            'result': machine_obj.ping_probe.as_dict(),
+                        })
             else:
                 self.send(routing_key, result)
 
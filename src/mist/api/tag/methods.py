@@ -9,6 +9,25 @@ def get_tags_for_resource(owner, resource_obj, *args, **kwargs):
             Tag.objects(owner=owner, resource=resource_obj)]
 
 
+def get_tags_for_resources(owner, resources):
+    """Return the tags of each of the given resources, by resource id
+
+    The tags of all resources are fetched with a single query, without
+    dereferencing the resources they belong to.
+
+    """
+    tags = dict((resource.id, []) for resource in resources)
+    if not tags:
+        return tags
+    query = Tag.objects(owner=owner, resource__in=resources)
+    for tag in query.only('key', 'value', 'resource').as_pymongo():
+        resource_id = tag['resource']['_ref'].id
+        if resource_id in tags:
+            tags[resource_id].append({'key': tag['key'],
+                                      'value': tag.get('value')})
+    return tags
+
+
 def add_tags_to_resource(owner, resource_obj, tags, *args, **kwargs):
     """
     This function get a list of tags in the form
@@ -4,6 +4,7 @@ import uuid
 import json
 import logging
 from time import time
+from multiprocessing.pool import ThreadPool
 
 import paramiko
 
@@ -16,6 +17,7 @@ from memcache import Client as MemcacheClient
 from celery import group
 from celery import Celery, Task
 from celery.exceptions import SoftTimeLimitExceeded
+from celery.signals import worker_process_shutdown
 
 from paramiko.ssh_exception import SSHException
 
@@ -27,6 +29,8 @@ from mist.api.users.models import User, Owner, Organization
 from mist.api.clouds.models import Cloud
 from mist.api.machines.models import Machine
 from mist.api.scripts.models import Script
+from mist.api.scripts.models import GroupScriptRun, GroupScriptRunTarget
+from mist.api.scripts.methods import ScriptOutputStream
 from mist.api.schedules.models import Schedule
 from mist.api.dns.models import Zone, Record, RECORDS
 
@@ -39,6 +43,7 @@ from mist.api.helpers import amqp_log
 from mist.api.helpers import trigger_session_update
 
 from mist.api.logs.methods import log_event
+from mist.api.logs.methods import EVENT_WRITER
 
 from mist.api import config
 
@@ -52,16 +57,25 @@ app.conf.update(**config.CELERY_SETTINGS)
 app.autodiscover_tasks(['mist.api.poller'])
 
 
+@worker_process_shutdown.connect
+def flush_events(**kwargs):
+    """Write pending events before a pool process exits"""
+    EVENT_WRITER.flush()
+
+
 @app.task
 def ssh_command(owner_id, cloud_id, machine_id, host, command,
                       key_id=None, username=None, password=None, port=22):
 
     owner = Owner.objects.get(id=owner_id)
     shell = Shell(host)
-    key_id, ssh_user = shell.autoconfigure(owner, cloud_id, machine_id,
-                                           key_id, username, password, port)
-    retval, output = shell.command(command)
-    shell.disconnect()
+    try:
+        key_id, ssh_user = shell.autoconfigure(owner, cloud_id, machine_id,
+                                               key_id, username, password,
+                                               port)
+        retval, output = shell.command(command)
+    finally:
+        shell.disconnect()
     if retval:
         from mist.api.methods import notify_user
         notify_user(owner, "Async command failed for machine %s (%s)" %
@@ -1221,21 +1235,24 @@ def run_machine_action(owner_id, action, name, machine_uuid):
 @app.task
 def group_run_script(owner_id, script_id, name, machines_uuids):
     """
-    Accepts a list of lists in form  cloud_id,machine_id and pass them
-    to run_machine_action like a group
+    Run a script on a group of machines, tracking the progress of each one
+    in a GroupScriptRun document
+
+    Hosts are resolved for all machines before any script is run, with at
+    most one provider listing per cloud. At most SCRIPT_GROUP_CONCURRENCY
+    scripts run at the same time, each of them for at most
+    SCRIPT_GROUP_TIME_LIMIT seconds, after which its target is marked failed.
 
     :param owner_id:
     :param script_id:
     :param name
-    :param cloud_machines_pairs:
+    :param machines_uuids:
     :return:
     """
-    glist = []
-    job_id = uuid.uuid4().hex
-    for machine_uuid in machines_uuids:
-            glist.append(run_script.s(owner_id, script_id, machine_uuid,
-                                      job_id=job_id, job='schedule'))
+    from mist.api.machines.methods import find_machine_hosts
 
+    job_id = uuid.uuid4().hex
+    owner = Owner.objects.get(id=owner_id)
     schedule = Schedule.objects.get(owner=owner_id, name=name, deleted=None)
 
     log_dict = {
@@ -1258,7 +1275,46 @@ def group_run_script(owner_id, script_id, name, machines_uuids):
     log_event(action='Schedule started', **log_dict)
     log.info('Schedule started: %s', log_dict )
     try:
-        group(glist)()
+        machines = Machine.objects(id__in=machines_uuids,
+                                   state__ne='terminated').no_dereference()
+        hosts = find_machine_hosts(owner, machines)
+        group_run = GroupScriptRun(
+            owner_id=owner_id, job_id=job_id, script_id=script_id,
+            schedule_id=schedule.id, started_at=time(),
+            targets=[GroupScriptRunTarget(machine_uuid=machine_uuid,
+                                          host=hosts.get(machine_uuid, ''))
+                     for machine_uuid in machines_uuids]
+        )
+        group_run.save()
+        log_dict['group_run_id'] = group_run.id
+
+        def run_target(machine_uuid):
+            group_run.update_target(machine_uuid, state='running',
+                                    started_at=time())
+            try:
+                ret = run_script.run(owner, script_id, machine_uuid,
+                                     host=hosts.get(machine_uuid, ''),
+                                     job_id=job_id, job='schedule',
+                                     timeout=config.SCRIPT_GROUP_TIME_LIMIT)
+            except Exception as exc:
+                ret = {'error': str(exc)}
+            group_run.update_target(
+                machine_uuid,
+                state='failed' if ret['error'] else 'succeeded',
+                error=str(ret['error'] or ''),
+                exit_code=str(ret.get('exit_code', '')),
+                output_id=ret.get('output_id', ''),
+                finished_at=time(),
+            )
+
+        pool = ThreadPool(max(min(config.SCRIPT_GROUP_CONCURRENCY,
+                                  len(machines_uuids)), 1))
+        try:
+            pool.map(run_target, machines_uuids)
+        finally:
+            pool.close()
+            pool.join()
+        group_run.update(set__finished_at=time())
     except Exception as exc:
         log_dict['error'] = str(exc)
 
@@ -1271,18 +1327,57 @@ def group_run_script(owner_id, script_id, name, machines_uuids):
         log.info('Schedule run_script failed: %s', log_dict)
     else:
         log.info('Schedule run_script succeeded: %s', log_dict)
-    owner = Owner.objects.get(id=owner_id)
     trigger_session_update(owner, ['schedules'])
     return log_dict
 
 
+_RUN_SCRIPT_WRAPPER = None
+
+
+def _run_script_wrapper():
+    """Return the contents of the run_script wrapper, read once per worker"""
+    global _RUN_SCRIPT_WRAPPER
+    if _RUN_SCRIPT_WRAPPER is None:
+        with open(os.path.join(
+            os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(
+                os.path.abspath(__file__)
+            )))),
+            'run_script', 'run.py'
+        )) as fobj:
+            _RUN_SCRIPT_WRAPPER = fobj.read()
+    return _RUN_SCRIPT_WRAPPER
+
+
+def _parse_wrapper_output(wstdout):
+    """Return the script's stdout and extra output from the wrapper's output
+
+    Only the tail of the output may be given, in which case the marker that
+    starts the first part, the script's, may be missing.
+
+    """
+    end = re.search(r'-----part-end-([^-]*)-----\n', wstdout)
+    if end and '-----part-' not in wstdout[:end.start()]:
+        wstdout = '-----part-script-%s-----\n%s' % (end.group(1), wstdout)
+    parts = re.findall(r'-----part-([^-]*)-([^-]*)-----\n(.*?)'
+                       r'-----part-end-\2-----\n', wstdout, re.DOTALL)
+    if not parts or any(part[1] != parts[0][1] for part in parts):
+        return {}
+    result = {}
+    for name, _, data in parts:
+        if name == 'script':
+            result['stdout'] = data
+        elif name == 'outfile':
+            result['extra_output'] = data
+    return result
+
+
 @app.task(soft_time_limit=3600, time_limit=3630)
 def run_script(owner, script_id, machine_uuid, params='', host='',
                key_id='', username='', password='', port=22, job_id='', job='',
-               action_prefix='', su=False, env=""):
+               action_prefix='', su=False, env="", timeout=None):
     import mist.api.shell
     from mist.api.methods import notify_admin, notify_user
-    from mist.api.machines.methods import list_machines
+    from mist.api.machines.methods import find_machine_hosts
 
     if not isinstance(owner, Owner):
         owner = Owner.objects.get(id=owner)
@@ -1313,6 +1408,7 @@ def run_script(owner, script_id, machine_uuid, params='', host='',
     machine_name = ''
     cloud_id = ''
     machine_id=''
+    shell = None
 
     try:
         machine = Machine.objects.get(id=machine_uuid, state__ne='terminated')
@@ -1322,19 +1418,10 @@ def run_script(owner, script_id, machine_uuid, params='', host='',
         # cloud = Cloud.objects.get(owner=owner, id=cloud_id, deleted=None)
         script = Script.objects.get(owner=owner, id=script_id, deleted=None)
 
+        machine_name = machine.name
         if not host:
-            # FIXME machine.cloud.ctl.compute.list_machines()
-            for machine in list_machines(owner, cloud_id):
-                if machine['machine_id'] == machine_id:
-                    ips = [ip for ip in machine['public_ips'] if ':' not in ip]
-                    # get private IPs if no public IP is available
-                    if not ips:
-                        ips = [ip for ip in machine['private_ips'] if ':' not in ip]
-                    if ips:
-                        host = ips[0]
-                        ret['host'] = host
-                    machine_name = machine['name']
-                    break
+            host = find_machine_hosts(owner, [machine])[machine.id]
+            ret['host'] = host
         if not host:
             raise MistError("No host provided and none could be discovered.")
         shell = mist.api.shell.Shell(host)
@@ -1346,14 +1433,6 @@ def run_script(owner, script_id, machine_uuid, params='', host='',
                                                       params=params,
                                                       job_id=ret.get('job_id'))
 
-        with open(os.path.join(
-            os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(
-                os.path.abspath(__file__)
-            )))),
-            'run_script', 'run.py'
-        )) as fobj:
-            wscript = fobj.read()
-
         # check whether python exists
 
         exit_code, wstdout = shell.command("command -v python")
@@ -1361,44 +1440,53 @@ def run_script(owner, script_id, machine_uuid, params='', host='',
         if exit_code > 0:
             command = "/bin/bash %s %s" % (path, params)
         else:
-            command = "python - %s << EOF\n%s\nEOF\n" % (wparams, wscript)
+            wpath, = shell.cache_files(_run_script_wrapper())
+            command = "python %s %s" % (wpath, wparams)
         if su:
             command = 'sudo ' + command
         ret['command'] = command
     except Exception as exc:
         ret['error'] = str(exc)
+        if shell is not None:
+            shell.disconnect()
     log_event(event_type='job', action=action_prefix+'script_started', **ret)
     log.info('Script started: %s', ret)
     if not ret['error']:
+        output = ScriptOutputStream(owner.id, ret['job_id'])
+        ret['output_id'] = output.output_id
+        output.start()
+        wstdout = None
         try:
-            exit_code, wstdout = shell.command(command)
-            shell.disconnect()
-            wstdout = wstdout.encode('utf-8', 'ignore')
-            wstdout = wstdout.replace('\r\n', '\n').replace('\r', '\n')
-            ret['wrapper_stdout'] = wstdout
+            exit_code, wstdout = shell.command(
+                command, max_bytes=config.SCRIPT_OUTPUT_MAX_BYTES,
+                callback=output.write, timeout=timeout
+            )
             ret['exit_code'] = exit_code
-            ret['stdout'] = wstdout
-            try:
-                parts = re.findall(r'-----part-([^-]*)-([^-]*)-----\n(.*?)-----part-end-\2-----\n',
-                                   wstdout, re.DOTALL)
-                if parts:
-                    randid = parts[0][1]
-                    for part in parts:
-                        if part[1] != randid:
-                            raise Exception('Different rand ids')
-                    for part in parts:
-                        if part[0] == 'script':
-                            ret['stdout'] = part[2]
-                        elif part[0] == 'outfile':
-                            ret['extra_output'] = part[2]
-            except Exception as exc:
-                pass
             if exit_code > 0:
                 ret['error'] = 'Script exited with return code %s' % exit_code
         except SoftTimeLimitExceeded:
             ret['error'] = 'Script execution time limit exceeded'
         except Exception as exc:
             ret['error'] = str(exc)
+        finally:
+            shell.disconnect()
+            output.close()
+        if wstdout is not None:
+            if output.size > config.SCRIPT_OUTPUT_MAX_BYTES:
+                # only the start of the output was kept, while the parts
+                # of the wrapper end up in its tail
+                wstdout = output.tail.decode('utf-8', 'ignore')
+            wstdout = wstdout.encode('utf-8', 'ignore')
+            wstdout = wstdout.replace('\r\n', '\n').replace('\r', '\n')
+            ret['wrapper_stdout'] = wstdout
+            ret['stdout'] = wstdout
+            ret.update(_parse_wrapper_output(wstdout))
+        # the full output is available through ret['output_id']
+        tail = config.SCRIPT_OUTPUT_TAIL_SIZE
+        ret['output_size'] = output.size
+        ret['output_truncated'] = output.size > tail
+        for key in ('wrapper_stdout', 'stdout', 'extra_output'):
+            ret[key] = ret[key][-tail:]
     log_event(event_type='job', action=action_prefix+'script_finished', **ret)
     if ret['error']:
         log.info('Script failed: %s', ret)
@@ -1429,6 +1517,8 @@ def run_script(owner, script_id, machine_uuid, params='', host='',
 @app.task
 def revoke_token(token):
     from mist.api.auth.models import AuthToken
+    from mist.api.auth.methods import invalidate_tokens
     auth_token = AuthToken.objects.get(token=token)
     auth_token.invalidate()
     auth_token.save()
+    invalidate_tokens(tokens=[token])
@@ -58,6 +58,8 @@ from mist.api.helpers import encrypt, decrypt
 from mist.api.helpers import get_auth_header, params_from_request
 from mist.api.helpers import trigger_session_update, amqp_publish_user
 from mist.api.helpers import view_config, ip_from_request
+from mist.api.helpers import etag_view
+from mist.api.helpers import list_params_from_request, set_next_cursor
 from mist.api.helpers import send_email
 from mist.api.helpers import get_file
 from mist.api.helpers import mac_verify
@@ -66,6 +68,7 @@ from mist.api.auth.methods import auth_context_from_request
 from mist.api.auth.methods import user_from_request, session_from_request
 from mist.api.auth.methods import get_csrf_token
 from mist.api.auth.methods import reissue_cookie_session
+from mist.api.auth.methods import invalidate_tokens
 from mist.api.auth.models import get_secure_rand_token
 
 from mist.api.logs.methods import log_event
@@ -866,12 +869,14 @@ def list_specific_images(request):
 
 
 @view_config(route_name='api_v1_images', request_method='GET', renderer='json')
+@etag_view('clouds', 'images')
 def list_images(request):
     """
     List images of specified cloud
     List images from each cloud. Furthermore if a search_term is provided, we
     loop through each cloud and search for that term in the ids and the names
-    of the community images
+    of the community images. If there are more images, the cursor of the next
+    page is returned in the X-Next-Cursor header.
     READ permission required on cloud.
     ---
     cloud:
@@ -880,6 +885,18 @@ def list_images(request):
       type: string
     search_term:
       type: string
+    limit:
+      type: integer
+      required: false
+      description: limit the number of images returned
+    cursor:
+      type: string
+      required: false
+      description: the X-Next-Cursor header of the previous page
+    fields:
+      type: string
+      required: false
+      description: comma separated list of the fields of each image to return
     """
 
     cloud_id = request.matchdict['cloud']
@@ -893,7 +910,11 @@ def list_images(request):
         cloud = Cloud.objects.get(owner=auth_context.owner, id=cloud_id)
     except Cloud.DoesNotExist:
         raise NotFoundError('Cloud does not exist')
-    return methods.list_images(auth_context.owner, cloud_id, term)
+    kwargs = list_params_from_request(request)
+    images = methods.list_images(auth_context.owner, cloud_id, term, **kwargs)
+    set_next_cursor(request, images, kwargs['limit'],
+                    keys=('star', 'name', 'id'))
+    return images
 
 
 @view_config(route_name='api_v1_image', request_method='POST', renderer='json')
@@ -2642,6 +2663,9 @@ def delete_member_from_team(request):
     except me.OperationError:
         raise TeamOperationError()
 
+    if remove_from_org:
+        invalidate_tokens(user_id=user.id)
+
     if user != auth_context.user:
         tasks.send_email.delay(subject, body, user.email)
 
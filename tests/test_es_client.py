@@ -0,0 +1,83 @@
+"""Tests connection reuse of the shared Elasticsearch client"""
+
+import time
+import threading
+
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+
+import pytest
+
+from mist.api import config
+from mist.api import helpers
+
+
+RESPONSE = '{"took": 1, "timed_out": false, "hits": {"total": 0, "hits": []}}'
+
+
+class Handler(BaseHTTPRequestHandler):
+    """Answers every request with an empty search result, over keep-alive"""
+
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+
+    def do_GET(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        self.rfile.read(length)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(RESPONSE)))
+        self.end_headers()
+        self.wfile.write(RESPONSE)
+
+    do_POST = do_GET
+
+    def log_message(self, *args):
+        pass
+
+
+class Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    connections = 0
+
+
+@pytest.fixture
+def server(monkeypatch):
+    server = Server(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    monkeypatch.setitem(config.ELASTICSEARCH, 'elastic_host', '127.0.0.1')
+    monkeypatch.setitem(config.ELASTICSEARCH, 'elastic_port',
+                        server.server_address[1])
+    helpers._ES_CLIENTS.clear()
+    yield server
+    helpers._ES_CLIENTS.clear()
+    server.shutdown()
+    server.server_close()
+
+
+def search(client, num):
+    started_at = time.time()
+    for _ in range(num):
+        client().search(index='app-logs-*', body={'size': 0})
+    return time.time() - started_at
+
+
+def test_es_client_reuses_connections(server):
+    num = 200
+    assert helpers.es_client() is helpers.es_client()
+
+    new = search(helpers._new_es_client, num)
+    new_connections, server.connections = server.connections, 0
+    shared = search(helpers.es_client, num)
+
+    print "%d searches with new clients: %.3f secs, %d connections" % (
+        num, new, new_connections)
+    print "%d searches with the shared client: %.3f secs, %d connections" % (
+        num, shared, server.connections)
+    assert new_connections == num
+    assert server.connections == 1
@@ -0,0 +1,176 @@
+"""Tests port checks, pagination cursors and ETags of mist.api.helpers"""
+
+import socket
+import resource
+
+import pytest
+
+from pyramid.request import Request
+from pyramid.httpexceptions import HTTPNotModified
+
+from mist.api import helpers
+from mist.api.helpers import check_open_ports
+from mist.api.helpers import etag_view, bump_list_versions
+from mist.api.helpers import encode_cursor, decode_cursor
+from mist.api.helpers import list_params_from_request, select_fields
+from mist.api.exceptions import BadRequestError
+
+
+def listen():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    sock.listen(5)
+    return sock
+
+
+def closed_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def test_check_open_ports():
+    server = listen()
+    port = server.getsockname()[1]
+    try:
+        found = check_open_ports({
+            'open': [('127.0.0.1', closed_port()), ('127.0.0.1', port)],
+            'closed': [('127.0.0.1', closed_port())],
+            'empty': [],
+        })
+    finally:
+        server.close()
+    assert found == set(['open'])
+
+
+def test_check_open_ports_deadline():
+    # Once the backlog of a socket that never accepts is full, further
+    # connections to it hang until they time out.
+    server = listen()
+    server.listen(0)
+    address = server.getsockname()
+    filler = socket.create_connection(address)
+    other = listen()
+    targets = dict((i, [address] * 3) for i in range(20))
+    targets['open'] = [address, other.getsockname()]
+    try:
+        found = check_open_ports(targets, timeout=1)
+    finally:
+        filler.close()
+        server.close()
+        other.close()
+    assert found == set(['open'])
+
+
+def test_check_open_ports_high_fds():
+    # select can't handle file descriptors above FD_SETSIZE, 1024.
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard != resource.RLIM_INFINITY and hard < 1100:
+        pytest.skip("Can't open enough file descriptors")
+    resource.setrlimit(resource.RLIMIT_NOFILE, (max(soft, 1100), hard))
+    server = listen()
+    fillers = [socket.socket() for _ in range(1024)]
+    try:
+        found = check_open_ports({'open': [server.getsockname()],
+                                  'closed': [('127.0.0.1', closed_port())]})
+    finally:
+        for filler in fillers:
+            filler.close()
+        server.close()
+        resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
+    assert found == set(['open'])
+
+
+def test_cursor():
+    values = [1500000000000, 'a3f0c1']
+    assert decode_cursor(encode_cursor(values)) == values
+    for cursor in ('not a cursor', encode_cursor({'a': 1})):
+        with pytest.raises(BadRequestError):
+            decode_cursor(cursor)
+
+
+def test_list_params():
+    request = Request.blank('/api/v1/keys')
+    assert list_params_from_request(request) == {
+        'limit': 0, 'after': None, 'fields': None,
+    }
+    request = Request.blank('/api/v1/keys?limit=2&fields=name,%%20tags&'
+                            'cursor=%s' % encode_cursor(['a3f0c1']))
+    params = list_params_from_request(request)
+    assert params == {
+        'limit': 2, 'after': ['a3f0c1'], 'fields': set(['id', 'name', 'tags']),
+    }
+    key = {'id': 'a3f0c1', 'name': 'key', 'isDefault': False, 'tags': []}
+    assert select_fields(key, params['fields']) == {
+        'id': 'a3f0c1', 'name': 'key', 'tags': [],
+    }
+    assert select_fields(key, None) is key
+    for query in ('limit=-1', 'limit=two', 'cursor=invalid'):
+        with pytest.raises(BadRequestError):
+            list_params_from_request(Request.blank('/api/v1/keys?' + query))
+
+
+class Memcache(dict):
+    """In memory stand-in for the memcache client"""
+
+    def get_multi(self, keys):
+        return dict((key, self[key]) for key in keys if key in self)
+
+    def set(self, key, value, time=0):
+        self[key] = value
+        return True
+
+    def add(self, key, value, time=0):
+        return self.setdefault(key, value) is value
+
+    def incr(self, key):
+        if key in self:
+            self[key] += 1
+            return self[key]
+
+
+class Session(object):
+    user_id = 'user'
+    su = ''
+
+    def to_mongo(self):
+        return {'org': 'org'}
+
+
+def test_etag_view(monkeypatch):
+    monkeypatch.setattr(helpers, '_MEMCACHE', Memcache())
+    calls = []
+
+    @etag_view('clouds')
+    def list_clouds(request):
+        calls.append(request)
+        return []
+
+    def get(etag=''):
+        request = Request.blank('/api/v1/clouds')
+        request.environ['session'] = Session()
+        if etag:
+            request.headers['If-None-Match'] = '"%s"' % etag
+        return request, list_clouds(request)
+
+    request, result = get()
+    etag = request.response.etag
+    assert result == [] and etag
+
+    request, result = get(etag)
+    assert isinstance(result, HTTPNotModified)
+    assert result.etag == etag
+    assert len(calls) == 1
+
+    for collection in ('clouds', 'org'):
+        bump_list_versions('org', [collection])
+        request, result = get(etag)
+        assert result == []
+        assert request.response.etag != etag
+        etag = request.response.etag
+    bump_list_versions('org', ['keys'])
+    request, result = get(etag)
+    assert isinstance(result, HTTPNotModified)
+    assert len(calls) == 3
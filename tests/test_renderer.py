@@ -0,0 +1,133 @@
+"""Tests and benchmarks JSON encoding and compression of API responses"""
+
+import sys
+import json
+import time
+import zlib
+import types
+import datetime
+import collections
+
+from pyramid.request import Request
+from pyramid.response import Response
+
+from mist.api import config
+from mist.api.helpers import compress, json_serializer
+from mist.api.helpers import compression_tween_factory
+
+
+Point = collections.namedtuple('Point', ['x', 'y'])
+
+
+class Opaque(object):
+    """Mimics the libcloud objects found in a node's extra"""
+
+    def __str__(self):
+        return '<Opaque>'
+
+
+def string_adapter(obj):
+    # Same as the adapter added to the JSON renderer in `mist.api.main`.
+    return str(obj)
+
+
+def test_json_serializer(monkeypatch):
+    value = {
+        'date': datetime.datetime(2017, 1, 1), 'object': Opaque(),
+        'point': Point(1, 2), 'list': [1, 'a', None], 'bytes': 'caf\xc3\xa9',
+        'float': 0.1, 1: 'int key',
+    }
+    expected = json.loads(json.dumps(value, default=string_adapter))
+
+    broken = types.ModuleType('broken_json')
+    broken.dumps = lambda *args, **kwargs: 1 / 0
+    monkeypatch.setitem(sys.modules, 'broken_json', broken)
+
+    for name in ('json', 'simplejson', 'broken_json', 'no_such_module'):
+        dumps = json_serializer(name)
+        assert json.loads(dumps(value, default=string_adapter)) == expected
+
+
+def render(body, accept_encoding='', content_type='application/json'):
+    request = Request.blank('/api/v1/clouds/cloud/machines')
+    if accept_encoding:
+        request.headers['Accept-Encoding'] = accept_encoding
+
+    def handler(request):
+        response = Response(body=body, content_type=content_type)
+        response.etag = 'etag'
+        return response
+
+    return compression_tween_factory(handler, None)(request)
+
+
+def test_compression_tween():
+    body = json.dumps([{'id': i, 'name': 'machine'} for i in range(1000)])
+
+    response = render(body, 'gzip, deflate')
+    assert response.content_encoding == 'gzip'
+    assert zlib.decompress(response.body, 16 + zlib.MAX_WBITS) == body
+    assert 'Accept-Encoding' in response.vary
+    assert response.headers['ETag'] == 'W/"etag"'
+
+    response = render(body, 'deflate')
+    assert response.content_encoding == 'deflate'
+    assert zlib.decompress(response.body) == body
+
+    for response in (render(body), render(body, 'gzip;q=0, br'),
+                     render(body[:config.COMPRESS_MIN_SIZE - 1], 'gzip')):
+        assert not response.content_encoding
+        assert 'Accept-Encoding' in response.vary
+        assert response.headers['ETag'] == '"etag"'
+
+    response = render(body, 'gzip', 'application/octet-stream')
+    assert not response.content_encoding
+    assert not response.vary
+    assert response.headers['ETag'] == '"etag"'
+
+
+def payloads(machines, images, logs):
+    machines = [dict(machine, created=datetime.datetime(2017, 1, 1),
+                     volumes=[Opaque()])
+                for machine in machines.values()] * 100
+    images = [image for cloud in images.values() for image in cloud] * 10
+    logs = [log for story in logs.values() for log in story] * 100
+    return {'machines': machines, 'images': images, 'logs': logs}
+
+
+def test_json_encoding_benchmark(load_staging_l_machines,
+                                 load_staging_l_images, load_logs):
+    dumps = json_serializer()
+    for name, payload in sorted(payloads(load_staging_l_machines,
+                                         load_staging_l_images,
+                                         load_logs).items()):
+        started_at = time.time()
+        for _ in range(10):
+            body = json.dumps(payload, default=string_adapter)
+        before = time.time() - started_at
+
+        started_at = time.time()
+        for _ in range(10):
+            fast_body = dumps(payload, default=string_adapter)
+        after = time.time() - started_at
+        assert json.loads(fast_body) == json.loads(body)
+
+        print "Encoded %d %s 10 times with %s in %.3f secs, instead of " \
+              "%.3f" % (len(payload), name, config.JSON_ENCODER, after,
+                        before)
+
+
+def test_compression_benchmark(load_staging_l_machines,
+                               load_staging_l_images, load_logs):
+    for name, payload in sorted(payloads(load_staging_l_machines,
+                                         load_staging_l_images,
+                                         load_logs).items()):
+        body = json.dumps(payload, default=string_adapter)
+        for encoding in ('gzip', 'deflate'):
+            started_at = time.time()
+            compressed = compress(body, encoding, config.COMPRESS_LEVEL)
+            duration = time.time() - started_at
+            print "Compressed %d %s with %s from %d to %d bytes in " \
+                  "%.3f secs" % (len(payload), name, encoding, len(body),
+                                 len(compressed), duration)
+            assert len(compressed) < len(body) / 4
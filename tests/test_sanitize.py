@@ -0,0 +1,103 @@
+"""Tests and benchmarks sanitize on the machine and log fixtures"""
+
+import copy
+import json
+import time
+import datetime
+
+from mist.api.helpers import sanitize
+
+
+class Opaque(object):
+    """Mimics the libcloud objects found in a node's extra"""
+
+    def __str__(self):
+        return '<Opaque>'
+
+
+def python_object(obj):
+    return {'_python_object': str(obj)}
+
+
+def machine_extras(machines, num=1000):
+    """Returns `num` machine extra dicts, with some values not serializable"""
+    extras = []
+    for i in range(num):
+        machine = machines.values()[i % len(machines)]
+        extra = copy.deepcopy(machine['extra'])
+        extra['created'] = datetime.datetime(2017, 1, 1)
+        extra['volumes'] = [{'id': i, 'object': Opaque()}]
+        extra['security_groups'] = set(['default'])
+        extras.append(extra)
+    return extras
+
+
+def test_sanitize():
+    value = {
+        'int': 1, 'none': None, 'list': [1, ('a', 'b')], 'set': set([1]),
+        'object': Opaque(), 'bytes': '\xff', 1: 'int key', (1, 2): 'tuple key',
+        'nested': {'date': datetime.date(2017, 1, 1)},
+    }
+    result = sanitize(value)
+    assert result == {
+        'int': 1, 'none': None, 'list': [1, ['a', 'b']], 'set': 'set([1])',
+        'object': '<Opaque>', 'bytes': u'\ufffd', 1: 'int key',
+        '(1, 2)': 'tuple key', 'nested': {'date': '2017-01-01'},
+    }
+    json.dumps(result)
+
+    result = sanitize(value, default=python_object)
+    assert result['object'] == {'_python_object': '<Opaque>'}
+
+
+def test_sanitize_limits():
+    deep = {'a': {'b': {'c': {'d': 1}}}}
+    assert sanitize(deep, max_depth=2) == {'a': {'b': "{'c': {'d': 1}}"}}
+    assert sanitize(range(100), max_size=10) == range(10)
+
+
+def test_sanitize_fixtures(load_staging_l_machines, load_logs):
+    assert sanitize(load_staging_l_machines) == load_staging_l_machines
+    assert sanitize(load_logs) == load_logs
+
+
+def test_sanitize_machine_extras(load_staging_l_machines):
+    extras = machine_extras(load_staging_l_machines)
+
+    # The previous implementation, encoding every value of each extra dict.
+    started_at = time.time()
+    for extra in copy.deepcopy(extras):
+        for key, val in extra.items():
+            try:
+                json.dumps(val)
+            except TypeError:
+                extra[key] = str(val)
+    before = time.time() - started_at
+
+    started_at = time.time()
+    for extra in extras:
+        json.dumps(sanitize(extra))
+    after = time.time() - started_at
+
+    print "Sanitized %d machine extras in %.3f secs, instead of %.3f" % (
+        len(extras), after, before)
+
+
+def test_sanitize_log_events(load_logs):
+    events = [log for logs in load_logs.values() for log in logs] * 1000
+    events = [dict(event, created=datetime.datetime(2017, 1, 1))
+              for event in events]
+
+    # The previous implementation, encoding and parsing each event.
+    started_at = time.time()
+    for event in events:
+        json.loads(json.dumps(event, default=python_object))
+    before = time.time() - started_at
+
+    started_at = time.time()
+    for event in events:
+        json.dumps(sanitize(event, default=python_object))
+    after = time.time() - started_at
+
+    print "Sanitized %d log events in %.3f secs, instead of %.3f" % (
+        len(events), after, before)
@@ -1,5 +1,7 @@
 """Tests Script models and Controllers"""
 
+from mist.api.tasks import _parse_wrapper_output
+
 
 def test_edit(script):
 
@@ -23,3 +25,19 @@ def test_get_file(script):
     result = script.ctl.get_file()
     assert result, "Something bad happened"
     print "get_file succeeded"
+
+
+def test_parse_wrapper_output():
+    wstdout = ('downloading\n'
+               '-----part-script-ab12-----\nhello\nworld\n'
+               '-----part-end-ab12-----\n'
+               '-----part-outfile-ab12-----\nextra\n'
+               '-----part-end-ab12-----\n')
+    assert _parse_wrapper_output(wstdout) == {
+        'stdout': 'hello\nworld\n', 'extra_output': 'extra\n',
+    }
+    # the tail of a long output, without the start of the script part
+    assert _parse_wrapper_output(wstdout[40:]) == {
+        'stdout': 'ello\nworld\n', 'extra_output': 'extra\n',
+    }
+    assert _parse_wrapper_output('no parts\n') == {}
@@ -0,0 +1,199 @@
+"""Tests output collection of ParamikoShell.command"""
+
+import os
+import time
+import socket
+import threading
+
+import pytest
+
+from mist.api.shell import ParamikoShell
+
+
+class FakeChannel(object):
+    """Mimics the buffering of a paramiko channel
+
+    Like paramiko, output is only ready while buffered, `recv` returns ''
+    once the remote end has sent EOF and the channel's fileno stays readable
+    from then on, while before that it is only readable while any output is
+    buffered. Output and EOF are fed by `feed` and `feed_eof`, which may be
+    called from another thread.
+
+    """
+
+    def __init__(self, stdout='', stderr='', retval=0, eof=True):
+        self.buffers = {'stdout': '', 'stderr': ''}
+        self.offsets = {'stdout': 0, 'stderr': 0}
+        self.lock = threading.Lock()
+        self.pipe = os.pipe()
+        self.set = False
+        self.eof_received = False
+        self.closed = False
+        self.retval = retval
+        self.feed('stdout', stdout)
+        self.feed('stderr', stderr)
+        if eof:
+            self.feed_eof()
+
+    def _set(self):
+        if not self.set:
+            os.write(self.pipe[1], '*')
+            self.set = True
+
+    def _clear(self):
+        if self.set and not self.eof_received:
+            os.read(self.pipe[0], 1)
+            self.set = False
+
+    def feed(self, name, data):
+        with self.lock:
+            if data:
+                self.buffers[name] = (
+                    self.buffers[name][self.offsets[name]:] + data
+                )
+                self.offsets[name] = 0
+                self._set()
+
+    def feed_eof(self):
+        with self.lock:
+            self.eof_received = True
+            self._set()
+
+    def fileno(self):
+        return self.pipe[0]
+
+    def _recv(self, name, nbytes):
+        with self.lock:
+            offset = self.offsets[name]
+            data = self.buffers[name][offset:offset + nbytes]
+            if not data and not self.eof_received:
+                raise AssertionError("recv would block")
+            self.offsets[name] += len(data)
+            if not self._ready('stdout') and not self._ready('stderr'):
+                self._clear()
+            return data
+
+    def _ready(self, name):
+        return self.offsets[name] < len(self.buffers[name])
+
+    def recv_ready(self):
+        return self._ready('stdout')
+
+    def recv_stderr_ready(self):
+        return self._ready('stderr')
+
+    def recv(self, nbytes):
+        return self._recv('stdout', nbytes)
+
+    def recv_stderr(self, nbytes):
+        return self._recv('stderr', nbytes)
+
+    def gettimeout(self):
+        return 1
+
+    def close(self):
+        self.closed = True
+
+    def recv_exit_status(self):
+        return self.retval
+
+
+def run_command(channel, pty=False, **kwargs):
+    shell = ParamikoShell('localhost')
+    shell._command = lambda cmd, pty: (None, None, channel)
+    return shell.command('cat', pty=pty, **kwargs)
+
+
+def test_command_output():
+    retval, out, err = run_command(FakeChannel('out\n' * 10, 'err\n', 1))
+    assert retval == 1
+    assert out == 'out\n' * 10
+    assert err == 'err\n'
+
+
+def test_command_unicode():
+    retval, out, err = run_command(FakeChannel('caf\xc3\xa9\n', 'err \xff\n'))
+    assert out == u'caf\xe9\n'
+    assert err == u'err \ufffd\n'
+    # as done with the output of scripts
+    assert out.encode('utf-8', 'ignore') == 'caf\xc3\xa9\n'
+
+
+def test_command_max_bytes():
+    stdout = 'x' * (ParamikoShell.chunk_size * 3)
+    retval, out, err = run_command(FakeChannel(stdout, 'e' * 100),
+                                   max_bytes=40000)
+    assert out == stdout[:40000]
+    assert err == 'e' * 100
+
+
+def test_command_callback():
+    chunks = []
+    stdout = 'y' * (ParamikoShell.chunk_size * 2 + 1)
+    retval, out = run_command(FakeChannel(stdout), pty=True, max_bytes=0,
+                              callback=lambda data, name: chunks.append(data))
+    assert out == ''
+    assert len(chunks) == 3
+    assert ''.join(chunks) == stdout
+
+
+def test_command_throughput():
+    size = 16 * 1024 * 1024
+    stdout = ('z' * 79 + '\n') * (size / 80)
+    started_at = time.time()
+    retval, out, err = run_command(FakeChannel(stdout, stdout))
+    duration = time.time() - started_at
+    assert out == stdout and err == stdout
+    print "Read %d MB of output in %.3f secs (%.1f MB/s)" % (
+        2 * size / 1024 / 1024, duration, 2 * size / 1024 / 1024 / duration
+    )
+
+
+def test_command_eof():
+    channel = FakeChannel(eof=False)
+
+    def remote():
+        for i in range(3):
+            channel.feed('stdout', 'out %d\n' % i)
+            channel.feed('stderr', 'err %d\n' % i)
+        channel.feed_eof()
+
+    thread = threading.Thread(target=remote)
+    thread.start()
+    retval, out, err = run_command(channel)
+    thread.join()
+    assert out == 'out 0\nout 1\nout 2\n'
+    assert err == 'err 0\nerr 1\nerr 2\n'
+
+
+def test_command_pty_eof():
+    # With a pty, nothing is ever written to stderr.
+    channel = FakeChannel('out\n', eof=False)
+    threading.Timer(0.1, channel.feed_eof).start()
+    retval, out = run_command(channel, pty=True)
+    assert out == 'out\n'
+
+
+def test_command_timeout():
+    with pytest.raises(socket.timeout):
+        run_command(FakeChannel('out\n', eof=False))
+
+
+def test_command_time_limit():
+    # Output keeps arriving, so the channel's timeout is never reached.
+    channel = FakeChannel(eof=False)
+    stop = threading.Event()
+
+    def remote():
+        while not stop.wait(0.05):
+            channel.feed('stdout', 'out\n')
+
+    thread = threading.Thread(target=remote)
+    thread.start()
+    try:
+        with pytest.raises(socket.timeout):
+            run_command(channel, pty=True, timeout=0.3)
+    finally:
+        stop.set()
+        thread.join()
+    assert channel.closed
@@ -240,3 +240,26 @@ def test_close_story(load_logs):
         assert story['finished_at']
         assert story['type'] == story_type
         assert len(story['logs']) is 2
+
+
+def test_paginate_stories(load_logs):
+    """Test fetching stories page by page."""
+    owner_id = get_owner_id(load_logs)
+
+    stories = get_stories('incident', owner_id=owner_id)
+    assert len(stories) > 1
+
+    pages, after = [], ''
+    while True:
+        page = get_stories('incident', owner_id=owner_id, limit=1,
+                           after=after)
+        if not page:
+            break
+        assert len(page) is 1
+        pages.extend(page)
+        after = page[-1]['story_id']
+
+    assert [story['story_id'] for story in pages] == \
+        [story['story_id'] for story in stories]
+    for prev, story in zip(pages, pages[1:]):
+        assert prev['started_at'] >= story['started_at']